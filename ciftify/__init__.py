@@ -12,4 +12,9 @@ from . import niio
 from . import filenames
 from . import meants
 from . import report
+from . import surface
+from . import smoothing
+from . import clusters
+from . import ribbon
+from . import resample
 #from commands import *
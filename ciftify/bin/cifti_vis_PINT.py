@@ -206,20 +206,18 @@ class Vertex(PDDataframe):
         self.heat_map = vertex_corrpic
         return vertex_corrpic
 
-    def make_rois(self, network_csv, network_df, left_surface, right_surface,
-            seed_radius, output_dir):
-        self.xrois = os.path.join(output_dir, 'xrois.dscalar.nii')
-        self.__generate_roi(self.vert_type, network_csv, seed_radius,
-                left_surface, right_surface, self.xrois)
+    def make_rois(self, network_df, surface_rois, seed_radius, output_dir):
+        xrois = self.__generate_roi(self.vert_type, network_df, seed_radius,
+                surface_rois)
 
         if self.__needs_yrois(network_df):
-            self.yrois = os.path.join(output_dir, 'yrois.dscalar.nii')
-            self.__generate_roi('vertex_48', network_csv, seed_radius,
-                    left_surface, right_surface, self.yrois)
+            yrois = self.__generate_roi('vertex_48', network_df, seed_radius,
+                    surface_rois)
         else:
-            self.yrois = self.xrois
+            yrois = xrois
 
-        self.rois = self.__combine_rois_and_set_palette(output_dir)
+        self.rois = self.__combine_rois_and_set_palette(xrois, yrois,
+                surface_rois, output_dir)
 
     def __needs_yrois(self, network_df):
         if self.vert_type == 'tvertex':
@@ -231,22 +229,16 @@ class Vertex(PDDataframe):
             return False
         return True
 
-    def __generate_roi(self, vert_type, network_csv, seed_radius, l_surface,
-            r_surface, output):
-        ## make the overlaying ROIs
-        run(['ciftify_surface_rois', '--vertex-col', vert_type, network_csv,
-                str(seed_radius), l_surface, r_surface, output])
-        if not os.path.exists(output):
-            logger.error("Could not generate needed ROIs output file: "
-                    "{}".format(output))
-            sys.exit(1)
-        return
+    def __generate_roi(self, vert_type, network_df, seed_radius, surface_rois):
+        ## make the overlaying ROIs (like ciftify_surface_rois)
+        return surface_rois.bilateral_map(network_df.loc[:, vert_type].values,
+                network_df.loc[:, 'hemi'].values, float(seed_radius))
 
-    def __combine_rois_and_set_palette(self, output_dir):
+    def __combine_rois_and_set_palette(self, xrois, yrois, surface_rois,
+            output_dir):
         rois = os.path.join(output_dir, 'rois.dscalar.nii')
         ## combine xrois and yrois into one roi result
-        run(['wb_command -cifti-math "((x*2)+y)"', rois, '-var','x',
-                self.xrois, '-var', 'y', self.yrois],suppress_stdout=True)
+        surface_rois.write_dscalar(rois, (xrois * 2) + yrois)
         ## set the palette on the roi to power_surf (mostly grey)
         run(['wb_command', '-cifti-palette', rois, 'MODE_AUTO_SCALE', rois,
                 '-palette-name', 'Gray_Interp_Positive'])
@@ -341,6 +333,9 @@ def run_snaps(settings, qc_config, scene_dir, temp_dir):
 
     func_nifti = FakeNifti(settings.func, temp_dir)
     summary_data = SummaryData(settings.pint_summary, settings.pvertex_name)
+    ## the roi neighbourhoods of the surfaces are shared by every network
+    surface_rois = ciftify.surface.SurfaceRois(settings.left_surface,
+            settings.right_surface)
 
     qc_sub_html = os.path.join(qc_subdir, 'qc_sub.html')
     with open(qc_sub_html,'w') as qc_sub_page:
@@ -355,11 +350,9 @@ def run_snaps(settings, qc_config, scene_dir, temp_dir):
             network = pint_dict['network']
             NETWORK = pint_dict['NETWORK']
 
-            ## make a dscalar of the network map
-            network_csv = os.path.join(temp_dir, 'networkdf.csv')
+            ## the vertices of this network
             networkdf = summary_data.dataframe.loc[
                     summary_data.dataframe.loc[:,'NETWORK'] == NETWORK,:]
-            networkdf.to_csv(network_csv, index=False)
 
             qc_sub_page.write('<div class="container" style="width: 100%;">\n')
             qc_sub_page.write('  <h2>{} Network</h2>\n'.format(network))
@@ -368,8 +361,7 @@ def run_snaps(settings, qc_config, scene_dir, temp_dir):
                 logging.info('Running {} {} snaps:'.format(network,
                         vertex.vert_type))
 
-                vertex.make_rois(network_csv, networkdf,
-                        settings.left_surface, settings.right_surface,
+                vertex.make_rois(networkdf, surface_rois,
                         settings.roi_radius, temp_dir)
                 vertex.make_seed_corr(summary_data.dataframe, NETWORK,
                         func_nifti, temp_dir)
@@ -19,6 +19,8 @@ Options:
   --SmoothingFWHM FWHM     SmoothingFWHM argument given during ciftify_subject_fmri
   --smooth-conn FWHM       Add smoothing with this FWHM [default: 4] to connectivity images
                            if no smoothing was during ciftify_subject_fmri
+  --python-smoothing       Do the --smooth-conn smoothing with ciftify's (cached)
+                           smoothing kernels instead of wb_command
   --hcp-data-dir PATH      DEPRECATED, use --ciftify-work-dir instead
   -v, --verbose            Verbose logging
   --debug                  Debug logging
@@ -43,6 +45,9 @@ Gross patterns of connetivity as more visible with some surface smoothing.
 So connectivity are shown either on the smoothed dtseries files indicated by the
 '--SmoothingFWHM' option, or they using temporary files smoothed with the kernel
 indicated by the ('--smoothed-conn') option (default value 8mm).
+The temporary files are smoothed with wb_command -cifti-smoothing, or with
+'--python-smoothing' in python, with surface smoothing kernels that are saved in a
+smoothing_weights folder next to the subject's 32k midthickness surfaces.
 
 Written by Erin W Dickie, Feb 2016
 """
@@ -75,6 +80,7 @@ class UserSettings(VisSettings):
         self.dtseries_s0 = self.get_dtseries_s0()
         self.fwhm = self.get_fwhm(arguments)
         self.surf_mesh = '.32k_fs_LR'
+        self.python_smoothing = arguments['--python-smoothing']
 
     def get_dtseries_s0(self):
         dtseries_s0 = ''
@@ -251,16 +257,21 @@ def get_smoothed_dtseries_file(user_settings, temp_dir):
         Sigma = ciftify.utils.FWHM2Sigma(user_settings.fwhm)
         surfs_dir = os.path.join(user_settings.work_dir, user_settings.subject,
           'MNINonLinear', 'fsaverage_LR32k')
-        run(['wb_command', '-cifti-smoothing',
-            user_settings.dtseries_s0,
-            str(Sigma), str(Sigma), 'COLUMN',
-            dtseries_sm,
-            '-left-surface', os.path.join(surfs_dir,
-              '{}.L.midthickness{}.surf.gii'.format(user_settings.subject,
-                                                     user_settings.surf_mesh)),
-            '-right-surface', os.path.join(surfs_dir,
-              '{}.R.midthickness{}.surf.gii'.format(user_settings.subject,
-                                                     user_settings.surf_mesh))])
+        left_surface = os.path.join(surfs_dir, '{}.L.midthickness{}.surf.gii'.format(
+            user_settings.subject, user_settings.surf_mesh))
+        right_surface = os.path.join(surfs_dir, '{}.R.midthickness{}.surf.gii'.format(
+            user_settings.subject, user_settings.surf_mesh))
+        if user_settings.python_smoothing:
+            ciftify.smoothing.smooth_cifti_file(user_settings.dtseries_s0,
+                dtseries_sm, Sigma, Sigma, left_surface, right_surface,
+                n_cpus = int(ciftify.utils.get_number_cpus()))
+        else:
+            run(['wb_command', '-cifti-smoothing',
+                user_settings.dtseries_s0,
+                str(Sigma), str(Sigma), 'COLUMN',
+                dtseries_sm,
+                '-left-surface', left_surface,
+                '-right-surface', right_surface])
         return dtseries_sm
 
 
@@ -16,6 +16,8 @@ Options:
   --outputall            Output vertices from each iteration.
 
   --pre-smooth FWHM      Add smoothing [default: 0] for PINT iterations. See details.
+  --python-smoothing     Do the pre-smoothing with ciftify's (cached) smoothing
+                         kernels instead of wb_command. See details.
   --sampling-radius MM   Radius [default: 6] in mm of sampling rois
   --search-radius MM     Radius [default: 6] in mm of search rois
   --padding-radius MM    Radius [default: 12] in mm for min distance between roi centers
@@ -30,7 +32,9 @@ Options:
 DETAILS:
 The pre-smooth option will add smoothing in order to make larger resting state gradients
 more visible in noisy data. Final extration of the timeseries use the original (un-smoothed)
-functional input.
+functional input. The pre-smoothing is done with wb_command -metric-smoothing, or with
+--python-smoothing in python, with smoothing kernels that are saved in a smoothing_weights
+folder next to the input surfaces.
 
 Written by Erin W Dickie, April 2016
 """
@@ -65,6 +69,7 @@ def run_PINT(arguments, tmpdir):
     pcorr         = arguments['--pcorr']
     corr         = arguments['--corr']
     pre_smooth_fwhm = arguments['--pre-smooth']
+    python_smoothing = arguments['--python-smoothing']
     outputall     = arguments['--outputall']
     RADIUS_SAMPLING = arguments['--sampling-radius']
     RADIUS_SEARCH = arguments['--search-radius']
@@ -111,6 +116,12 @@ def run_PINT(arguments, tmpdir):
     if 'roiidx' not in df.columns:
         df.loc[:,'roiidx'] = pd.Series(np.arange(1,len(df.index)+1), index=df.index)
 
+    ## python smoothing kernels are kept next to the input surfaces (not their tmpdir copies)
+    smoothing_cache_dirs = None
+    if python_smoothing:
+        smoothing_cache_dirs = (ciftify.smoothing.smoothing_cache_dir(surfL),
+                                ciftify.smoothing.smoothing_cache_dir(surfR))
+
     ## cp the surfaces to the tmpdir - this will cut down on i-o is tmpdir is ramdisk
     tmp_surfL = os.path.join(tmpdir, 'surface.L.surf.gii')
     tmp_surfR = os.path.join(tmpdir, 'surface.R.surf.gii')
@@ -122,7 +133,8 @@ def run_PINT(arguments, tmpdir):
     ## run the main iteration
     df, max_distance, distance_outcol, iter_num = iterate_pint(df, 'tvertex',
                                                         func, surfL, surfR,
-                                                        pcorr, pre_smooth_sigma)
+                                                        pcorr, pre_smooth_sigma,
+                                                        smoothing_cache_dirs)
 
     if outputall:
         cols_to_export = list(df.columns.values)
@@ -175,8 +187,12 @@ def log_build_environment():
     logger.info("---### End of Environment Settings ###---{}".format(os.linesep))
 ## measuring distance
 
-def read_func_data(func, smooth_sigma, surfL, surfR):
-    ''' read in the functional surface data (with or without pre-smoothing)'''
+def read_func_data(func, smooth_sigma, surfL, surfR, smoothing_cache_dirs = None):
+    '''
+    read in the functional surface data (with or without pre-smoothing)
+    the smoothing is done with wb_command, or in python if the (left, right)
+    smoothing_cache_dirs for its kernels are given
+    '''
 
     ## separate the cifti file into left and right surfaces
     with ciftify.utils.TempDir() as lil_tempdir:
@@ -189,8 +205,8 @@ def read_func_data(func, smooth_sigma, surfL, surfR):
             '-metric', 'CORTEX_LEFT', L_data_surf, '-roi', L_roi,
             '-metric', 'CORTEX_RIGHT', R_data_surf, '-roi', R_roi])
 
-        ## do the optional smoothing
-        if smooth_sigma > 0:
+        ## do the optional wb_command smoothing
+        if smooth_sigma > 0 and smoothing_cache_dirs is None:
             # smooth the data using the roi output from the cifti file
             L_data_sm = os.path.join(lil_tempdir, 'Ldata_sm.func.gii')
             R_data_sm = os.path.join(lil_tempdir, 'Rdata_sm.func.gii')
@@ -203,12 +219,22 @@ def read_func_data(func, smooth_sigma, surfL, surfR):
             L_data_sm = L_data_surf
             R_data_sm = R_data_surf
 
-        ## load both surfaces and concatenate them together
+        ## load both surfaces and their rois
         func_dataL = ciftify.niio.load_gii_data(L_data_sm)
         func_dataR = ciftify.niio.load_gii_data(R_data_sm)
         Lroi_data = ciftify.niio.load_gii_data(L_roi)
         Rroi_data = ciftify.niio.load_gii_data(R_roi)
 
+    ## or do the python smoothing, using the roi output from the cifti file
+    if smooth_sigma > 0 and smoothing_cache_dirs is not None:
+        n_cpus = int(ciftify.utils.get_number_cpus())
+        func_dataL = ciftify.smoothing.smooth_metric(func_dataL, surfL,
+                            smooth_sigma, roi = Lroi_data, n_cpus = n_cpus,
+                            cache_dir = smoothing_cache_dirs[0])
+        func_dataR = ciftify.smoothing.smooth_metric(func_dataR, surfR,
+                            smooth_sigma, roi = Rroi_data, n_cpus = n_cpus,
+                            cache_dir = smoothing_cache_dirs[1])
+
     ## stack the left and right surfaces
     num_Lverts = func_dataL.shape[0]
     func_data = np.vstack((func_dataL, func_dataR))
@@ -419,7 +445,8 @@ def pint_move_vertex(df, idx, vertex_incol, vertex_outcol,
     ## return the df
     return df
 
-def iterate_pint(df, vertex_incol, func, surfL, surfR, pcorr, smooth_sigma = 0):
+def iterate_pint(df, vertex_incol, func, surfL, surfR, pcorr, smooth_sigma = 0,
+                 smoothing_cache_dirs = None):
     '''
     The main bit of pint
 
@@ -430,13 +457,15 @@ def iterate_pint(df, vertex_incol, func, surfL, surfR, pcorr, smooth_sigma = 0):
       func_data_mask: a mask of non-zero values from the func data
       pcorr: wether or not to use partial correlation
       smooth_sigma: the pre-smoothing sigma
+      smoothing_cache_dirs: the (left, right) folders of the python smoothing
+        kernels (by default the pre-smoothing is done with wb_command)
 
     Return:
         the summary dataframe
     '''
 
     func_data, func_zeros, num_Lverts = read_func_data(func, smooth_sigma,
-                                                        surfL, surfR)
+                                                        surfL, surfR, smoothing_cache_dirs)
 
     iter_num = 0
     max_distance = 10
@@ -42,24 +42,13 @@ config_path = os.path.join(os.path.dirname(ciftify.config.find_ciftify_global())
 logging.config.fileConfig(config_path, disable_existing_loggers=False)
 logger = logging.getLogger(os.path.basename(__file__))
 
-def load_LR_vertex_areas(surf_settings):
-    ''' loads the vertex areas and stacks the dataframes'''
-    surf_va_L = ciftify.niio.load_gii_data(surf_settings.L.vertex_areas)
-    surf_va_R = ciftify.niio.load_gii_data(surf_settings.R.vertex_areas)
-    surf_va_LR = np.vstack((surf_va_L, surf_va_R))
-    return(surf_va_LR)
-
-
 def report_atlas_overlap(df, label_data, atlas, surf_va_LR, min_percent_overlap = 5):
     # read the atlas
-    atlas_data, atlas_dict = ciftify.niio.load_LR_label(atlas['path'],
-                                                    int(atlas['map_number']))
+    atlas_data, atlas_dict = ciftify.report.load_LR_atlas_labels(atlas)
     # write an overlap report to the outputfile
     o_col = '{}_overlap'.format(atlas['name'])
-    df[o_col] = ""
-    for pd_idx in df.index.get_values():
-        df.loc[pd_idx, o_col] = ciftify.report.get_label_overlap_summary(
-                        pd_idx, label_data, atlas_data, atlas_dict, surf_va_LR,
+    df[o_col] = ciftify.report.get_label_overlap_summaries(
+                        df.index, label_data, atlas_data, atlas_dict, surf_va_LR,
                         min_percent_overlap = min_percent_overlap)
     return(df)
 
@@ -86,7 +75,7 @@ def run_ciftify_dlabel_report(arguments, tmpdir):
         logger.info('Output table: {}'.format(outputcsv))
 
     ## load the vertex areas
-    surf_va_LR = load_LR_vertex_areas(surf_settings)
+    surf_va_LR = ciftify.report.load_LR_vertex_areas(surf_settings)
 
     ## assert that the dimensions match
     if not (label_data.shape[0] == surf_va_LR.shape[0]):
@@ -101,10 +90,8 @@ def run_ciftify_dlabel_report(arguments, tmpdir):
 
 
     # calculate a column of the surface area for row ROIs
-    df['area'] = -999
-    for pd_idx in df.index.get_values():
-        df.loc[pd_idx, 'area']  = ciftify.report.calc_cluster_area(pd_idx,
-                                                        label_data, surf_va_LR)
+    label_areas = ciftify.report.calc_label_areas(label_data, surf_va_LR)
+    df['area'] = [label_areas.get(int(pd_idx), 0) for pd_idx in df.index]
 
     for atlas in atlas_settings.values():
         df = report_atlas_overlap(df, label_data, atlas,
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 """
-Will use nilearn.image.clean_img to do filtering and confound regression according
-to user settings. Optional smoothing can also be added
+Does filtering and confound regression (the same steps as nilearn.image.clean_img)
+according to user settings. Optional smoothing can also be added
 
 Usage:
     ciftify_clean_img [options] <func_input>
+    ciftify_clean_img batch [options] <manifest>
 
 Options:
   --output-file=<filename>  Path to output cleaned image
@@ -25,34 +26,74 @@ Options:
   --smooth-fwhm=<FWHM>      The full width half max of the smoothing kernel if desired
   --left-surface=<gii>      Left surface file (required for smoothing)
   --right-surface=<GII>     Right surface file (required for smoothing)
+  --python-smoothing        Smooth cifti inputs with ciftify's (cached) smoothing
+                            kernels instead of wb_command (see DETAILS)
+  --summary-tsv=<FILE>      For batch mode, path to write the per run summary
+                            (default will append _summary to the manifest)
+  --n_cpus INT              For batch mode, the number of runs to clean at once.
+                            Defaults to the value of the OMP_NUM_THREADS environment variable
+  --mem-budget=<GB>         For batch mode, the memory (in GB) the runs cleaned at once
+                            may use together (default is the available memory)
 
   -v,--verbose              Verbose logging
   --debug                   Debug logging
   -h, --help                Prints this message
 
 DETAILS:
-
-
+The cleaning steps (detrending, filtering, confound regression and standardizing)
+are done in the same order and with the same math as nilearn.signal.clean. The
+parts that depend only on the timepoints (i.e. the confound regressors) are
+computed once, and the image is then cleaned in blocks of voxels (or
+grayordinates) read from disk so that only a small part of the data is ever in memory.
+
+Cifti (dtseries) inputs are cleaned directly as a grayordinates x timepoints
+matrix and written out as a dtseries, without converting to a nifti. They are
+smoothed with wb_command -cifti-smoothing by default. With --python-smoothing the
+smoothing is done in python instead, as one sparse grayordinates x grayordinates
+matrix product on the cleaned data, with surface smoothing kernels that are saved
+in a smoothing_weights folder next to the surfaces.
+
+In batch mode, many runs are cleaned with the same settings. The <manifest> is
+a tab separated file with a "func" column, and optional "confounds" and
+"output" columns (the --confounds-tsv and --output-file for each run). The
+cleaning config is read and checked once, and runs are cleaned in parallel
+(by up to --n_cpus processes) as long as their estimated memory use fits in
+--mem-budget. The time taken and the success or failure of each run is
+written to the --summary-tsv.
 
 """
 import os
 import sys
+import time
+import gzip
+import shutil
+import numpy as np
 import pandas as pd
 import json
 import yaml
 import logging
 from docopt import docopt
+from concurrent import futures
 
 import ciftify.niio
+import ciftify.smoothing
 from ciftify.meants import NibInput
 import ciftify.utils
 import nilearn.image
+import nilearn.signal
+from scipy import linalg
 
 import nibabel as nib
 
 logger = logging.getLogger('ciftify')
 logger.setLevel(logging.DEBUG)
 
+# the largest block of data (in bytes) to be cleaned at once
+# (filtering needs a few float64 copies of the block)
+CLEAN_BLOCK_BYTES = 256 * 1024**2
+# the (rough) memory used by a cleaning process before it reads any data
+RUN_OVERHEAD_BYTES = 256 * 1024**2
+
 class UserSettings:
     def __init__(self, arguments):
         self.args = self.__update_clean_config(arguments)
@@ -68,7 +109,8 @@ class UserSettings:
         self.high_pass = self.__parse_bandpass_filter_flag(self.args['--high-pass'])
         self.low_pass = self.__parse_bandpass_filter_flag(self.args['--low-pass'])
         self.func.tr = self.__get_tr(self.args['--tr'])
-        self.smooth = Smoothing(self.args['--smooth-fwhm'], self.func.type, self.args['--left-surface'], self.args['--right-surface'])
+        self.smooth = Smoothing(self.args['--smooth-fwhm'], self.func.type, self.args['--left-surface'], self.args['--right-surface'],
+                                self.args.get('--python-smoothing', False))
         self.output_func, self.output_json = self.__get_output_file(self.args['--output-file'])
 
     def __update_clean_config(self, user_args):
@@ -147,9 +189,10 @@ class UserSettings:
                 else:
                     tr = tr_ms
             if self.func.type == "cifti":
-                tr_out = ciftify.utils.get_stdout(['wb_command','-file-information',
-                        '-only-step-interval', self.func.path])
-                tr = float(tr_out.strip())
+                tr = ciftify.niio.cifti_series_step(nib.load(self.func.path).header)
+                if not tr:
+                    logger.error("Could not read the TR from {}, please specify it with --tr".format(self.func.path))
+                    sys.exit(1)
         if tr > 150:
             logger.warning("TR should be specified in seconds, improbable value {} given".format(tr))
         return tr
@@ -199,11 +242,13 @@ class Smoothing:
 
     Initialized with the user arg of FWHM or None
     '''
-    def __init__(self, smoothing_arg, func_type, left_surf_arg, right_surf_arg):
+    def __init__(self, smoothing_arg, func_type, left_surf_arg, right_surf_arg,
+                 python_smoothing = False):
         self.fwhm = 0
         self.sigma = 0
         self.left_surface = left_surf_arg
         self.right_surface = right_surf_arg
+        self.python_smoothing = python_smoothing
         self.outname = '0'
         if smoothing_arg:
             self.outname = smoothing_arg
@@ -234,61 +279,181 @@ def run_ciftify_clean_img(arguments,tmpdir):
     # check the confounds define the true confounds for nilearn
     confound_signals = mangle_confounds(settings)
 
-    # if input is cifti - we convert to fake nifti
-    ## convert to nifti
-    if settings.func.type == "cifti":
-        input_nifti = os.path.join(tmpdir,'func_fnifti.nii.gz')
-        ciftify.utils.run(['wb_command','-cifti-convert','-to-nifti',settings.func.path, input_nifti])
-    else:
-        input_nifti = settings.func.path
-
-    # load image as nilearn image
-    nib_image = nilearn.image.load_img(input_nifti)
-
-    if settings.start_from_tr > 0:
-        trimmed_nifti = image_drop_dummy_trs(nib_image, settings.start_from_tr)
-    else:
-        trimmed_nifti = nib_image
-
-    # the nilearn cleaning step..
-    clean_output = clean_image_with_nilearn(trimmed_nifti, confound_signals, settings)
-
-    # or nilearn image smooth if nifti input
+    # nifti input is cleaned, one block of voxels at a time, into an uncompressed nifti
     if settings.func.type == "nifti":
+        clean_output_nifti = os.path.join(tmpdir, 'clean_fnifti.nii')
+        clean_nifti_in_blocks(settings.func.path, clean_output_nifti,
+                              confound_signals, settings, tmpdir)
+        # or nilearn image smooth if nifti input
         if settings.smooth.fwhm > 0 :
-            smoothed_vol = nilearn.image.smooth_img(clean_output, settings.smooth.fwhm)
-            smoothed_vol.to_filename(settings.output_func)
-        else:
-            clean_output.to_filename(settings.output_func)
+            smooth_nifti_in_blocks(clean_output_nifti, settings.smooth.fwhm)
+        write_nifti_output(clean_output_nifti, settings.output_func)
 
-    # if input cifti - convert back to nifti
+    # cifti input is cleaned as a grayordinates by timepoints matrix
     if settings.func.type == "cifti":
-        clean_output_nifti = os.path.join(tmpdir, 'clean_fnifti.nii.gz')
-        clean_output.to_filename(clean_output_nifti)
-
-        if settings.smooth.fwhm > 0:
+        if settings.smooth.fwhm > 0 and not settings.smooth.python_smoothing:
             clean_output_cifti = os.path.join(tmpdir, 'cleaned.dtseries.nii')
-        else:
-            clean_output_cifti = settings.output_func
-
-        ## convert back not need a template with the same dimensions as the output
-        ciftify.utils.run(['wb_command','-cifti-convert','-from-nifti',
-            clean_output_nifti,
-            settings.func.path,
-            clean_output_cifti,
-            '-reset-timepoints', str(settings.func.tr),
-            str(settings.start_from_tr)])
-
-        if settings.smooth.fwhm > 0:
-            ciftify.utils.run(['wb_command', '-cifti-smoothing',
-                clean_output_cifti,
-                str(settings.smooth.sigma),
-                str(settings.smooth.sigma),
-                'COLUMN',
+            clean_cifti_in_blocks(settings.func.path, clean_output_cifti,
+                                  confound_signals, settings, tmpdir)
+            ciftify.utils.run(['wb_command', '-cifti-smoothing', clean_output_cifti,
+                str(settings.smooth.sigma), str(settings.smooth.sigma), 'COLUMN',
                 settings.output_func,
                 '-left-surface', settings.smooth.left_surface,
                 '-right-surface', settings.smooth.right_surface])
+        else:
+            clean_cifti_in_blocks(settings.func.path, settings.output_func,
+                                  confound_signals, settings, tmpdir)
+
+def run_batch_clean_img(arguments):
+    '''
+    cleans every run in the manifest with the same settings, in parallel processes
+    within the memory budget, and writes the status and timing of each run to a tsv
+    '''
+    batch_args = read_batch_settings(arguments)
+    manifest = read_manifest(arguments['<manifest>'])
+    summary_tsv = arguments['--summary-tsv']
+    if not summary_tsv:
+        manifest_base = os.path.splitext(arguments['<manifest>'])[0]
+        summary_tsv = '{}_summary.tsv'.format(manifest_base)
+    ciftify.utils.check_output_writable(summary_tsv)
+
+    n_cpus = int(ciftify.utils.get_number_cpus(arguments['--n_cpus']))
+    mem_budget = get_memory_budget(arguments['--mem-budget'])
+    runs = [run_arguments(batch_args, row) for _, row in manifest.iterrows()]
+    estimates = [estimate_run_memory(run['<func_input>']) for run in runs]
+    logger.info('Cleaning {} runs with up to {} processes'.format(len(runs), n_cpus))
+
+    results = schedule_runs(clean_run, runs, estimates, n_cpus, mem_budget)
+
+    summary = manifest.copy()
+    summary['status'] = [result[0] for result in results]
+    summary['message'] = [result[1] for result in results]
+    summary['seconds'] = [round(result[2], 2) for result in results]
+    summary.to_csv(summary_tsv, sep = '\t', index = False)
+
+    n_failed = (summary['status'] != 'done').sum()
+    if n_failed > 0:
+        logger.error('{} of {} runs failed, see {}'.format(n_failed, len(runs), summary_tsv))
+        return 1
+    return 0
+
+def read_batch_settings(arguments):
+    '''merges the cleaning config into the arguments once, and checks the settings shared by all runs'''
+    batch_args = dict(arguments)
+    if batch_args['--clean-config']:
+        try:
+            user_config = load_json_file(batch_args['--clean-config'])
+        except:
+            logger.critical("Could not load the json config file")
+            sys.exit(1)
+        batch_args = merge(batch_args, user_config)
+        batch_args['--clean-config'] = None
+    for flag in ['--high-pass', '--low-pass', '--tr', '--smooth-fwhm', '--drop-dummy-TRs']:
+        if batch_args.get(flag):
+            try:
+                float(batch_args[flag])
+            except (TypeError, ValueError):
+                logger.error("Unable to parse {} argument {}".format(flag, batch_args[flag]))
+                sys.exit(1)
+    for surf_flag in ['--left-surface', '--right-surface']:
+        if batch_args.get(surf_flag):
+            ciftify.utils.check_input_readable(batch_args[surf_flag])
+    return batch_args
+
+def read_manifest(manifest_tsv):
+    '''reads the batch manifest, a tsv with a func column and optional confounds and output columns'''
+    ciftify.utils.check_input_readable(manifest_tsv)
+    try:
+        manifest = pd.read_csv(manifest_tsv, sep = '\t', dtype = str)
+    except:
+        logger.critical("Failed to read manifest tsv {}".format(manifest_tsv))
+        sys.exit(1)
+    if 'func' not in manifest.columns:
+        logger.critical('The manifest {} needs a "func" column'.format(manifest_tsv))
+        sys.exit(1)
+    for column in ['confounds', 'output']:
+        if column not in manifest.columns:
+            manifest[column] = None
+    return manifest[['func', 'confounds', 'output']].where(manifest.notnull(), None)
+
+def run_arguments(batch_args, run):
+    '''the arguments for one run of the batch'''
+    run_args = dict(batch_args)
+    run_args['<func_input>'] = run['func']
+    run_args['--output-file'] = run['output']
+    if run['confounds']:
+        run_args['--confounds-tsv'] = run['confounds']
+    return run_args
+
+def get_memory_budget(mem_budget_arg):
+    '''the memory budget in bytes from the user argument (in GB) or the available memory'''
+    if mem_budget_arg:
+        try:
+            return float(mem_budget_arg) * 1024**3
+        except ValueError:
+            logger.error("Unable to parse --mem-budget {}".format(mem_budget_arg))
+            sys.exit(1)
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
 
+def estimate_run_memory(func_path):
+    '''
+    a rough estimate of the memory needed to clean one run, the data is cleaned in
+    blocks so this is the largest block (and its filtering copies) not the whole file
+    '''
+    try:
+        data_bytes = 8 * int(np.prod(nib.load(func_path).shape))
+    except:
+        data_bytes = CLEAN_BLOCK_BYTES
+    return RUN_OVERHEAD_BYTES + 4 * min(data_bytes, CLEAN_BLOCK_BYTES)
+
+def clean_run(run_args):
+    '''cleans one run of a batch, returning (status, message, seconds) instead of exiting'''
+    start_time = time.time()
+    status, message = 'done', ''
+    try:
+        with ciftify.utils.TempDir() as tmpdir:
+            run_ciftify_clean_img(run_args, tmpdir)
+    except SystemExit as e:
+        if e.code:
+            status, message = 'failed', 'exited with an error, see the log'
+    except Exception as e:
+        status, message = 'failed', '{}: {}'.format(type(e).__name__, e)
+    if status == 'failed':
+        logger.error('Cleaning {} failed: {}'.format(run_args['<func_input>'], message))
+    return status, message, time.time() - start_time
+
+def schedule_runs(run_function, runs, estimates, n_workers, mem_budget):
+    '''
+    runs run_function on each run in a pool of n_workers processes, only starting
+    a run when the estimated memory of all the running runs fits in the budget
+    (a run larger than the whole budget is run on its own)
+    returns the results in the order of the runs
+    '''
+    if n_workers <= 1:
+        return [run_function(run) for run in runs]
+
+    results = [None] * len(runs)
+    pending = list(range(len(runs)))
+    running = {}
+    with futures.ProcessPoolExecutor(max_workers = n_workers) as executor:
+        while pending or running:
+            while pending and len(running) < n_workers:
+                in_use = sum(estimates[i] for i in running.values())
+                if running and mem_budget and in_use + estimates[pending[0]] > mem_budget:
+                    break
+                i = pending.pop(0)
+                running[executor.submit(run_function, runs[i])] = i
+            done, _ = futures.wait(running, return_when = futures.FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    results[i] = ('failed', '{}: {}'.format(type(e).__name__, e), 0.0)
+    return results
 
 def merge(dict_1, dict_2):
     """Merge two dictionaries.
@@ -298,57 +463,289 @@ def merge(dict_1, dict_2):
     return {str(key): dict_1.get(key) or dict_2.get(key)
                 for key in set(dict_2) | set(dict_1)}
 
-def image_drop_dummy_trs(nib_image, start_from_tr):
-    ''' use nilearn to drop the number of trs from the image'''
-    img_out = nib_image.slicer[:,:,:, start_from_tr:]
-    return img_out
-
 def mangle_confounds(settings):
     '''mangle the confounds according to user settings
     insure that output matches length of func input and NA's are not present..'''
-    # square a column in pandas df['c'] = df['b']**2
-    # or np.square(x) (is faster) pandas.Series.diff for lags
-    # start by removing the tr's
     if settings.confounds is None:
         return None
+    return expand_confounds(settings)
+
+def expand_confounds(settings):
+    '''
+    builds the confounds design (the columns, then the squares, lags and squared lags)
+    as one array, starting from the first tr kept
+    '''
+    df = settings.confounds.iloc[settings.start_from_tr:, :]
+    lag_cols = list(settings.cf_td_cols) + list(settings.cf_sqtd_cols)
+    # the lags are the differences within the kept trs (the first is set to zero below)
+    lag_values = df.loc[:, lag_cols].values.astype(np.float64)
+    lags = np.full(lag_values.shape, np.nan)
+    lags[1:, :] = np.diff(lag_values, axis = 0)
+    n_td = len(settings.cf_td_cols)
+    design = np.hstack((df.loc[:, settings.cf_cols].values.astype(np.float64),
+                        df.loc[:, settings.cf_sq_cols].values.astype(np.float64)**2,
+                        lags[:, :n_td],
+                        lags[:, n_td:]**2))
+    design[np.isnan(design)] = 0 # added at the request of Colin
+    colnames = (list(settings.cf_cols) +
+                ['{}_sq'.format(c) for c in settings.cf_sq_cols] +
+                ['{}_lag'.format(c) for c in settings.cf_td_cols] +
+                ['{}_sqlag'.format(c) for c in settings.cf_sqtd_cols])
+    return pd.DataFrame(design, columns = colnames, index = df.index)
+
+def cleaning_required(confound_signals, settings):
+    '''returns True if any of the cleaning steps are asked for'''
+    return any((settings.detrend == True,
+               settings.standardize == True,
+               confound_signals is not None,
+               settings.high_pass is not None,
+               settings.low_pass is not None))
+
+class CleaningDesign:
+    '''
+    The parts of the cleaning that only depend on the timepoints, built once and
+    then applied to blocks of timepoints x voxels.
+
+    The steps follow nilearn.signal.clean: detrending, butterworth filtering
+    (of both the signals and the confounds), removing the projection on the
+    (standardized) confounds and finally standardizing.
+    '''
+    def __init__(self, n_timepoints, confound_signals, settings):
+        self.n_timepoints = n_timepoints
+        self.detrend = settings.detrend
+        self.standardize = settings.standardize
+        self.low_pass = settings.low_pass
+        self.high_pass = settings.high_pass
+        self.tr = settings.func.tr
+        self.filter = self.low_pass is not None or self.high_pass is not None
+        self.trend_basis = self.__get_trend_basis() if self.detrend else None
+        self.confound_basis = self.__get_confound_basis(confound_signals)
+        self.projection_basis = self.__get_projection_basis()
+
+    def __get_trend_basis(self):
+        '''an orthonormal basis for the mean and linear trend'''
+        ramp = np.arange(self.n_timepoints, dtype = np.float64)
+        ramp -= ramp.mean()
+        if np.sqrt((ramp**2).sum()) > 0:
+            ramp /= np.sqrt((ramp**2).sum())
+        constant = np.ones(self.n_timepoints) / np.sqrt(self.n_timepoints)
+        return np.column_stack((constant, ramp))
+
+    def __get_confound_basis(self, confound_signals):
+        '''
+        an orthonormal basis for the confounds, after they are detrended,
+        filtered and standardized the same way as nilearn.signal.clean
+        '''
+        if confound_signals is None:
+            return None
+        confounds = np.array(confound_signals, dtype = np.float64)
+        if confounds.ndim == 1:
+            confounds = confounds[:, np.newaxis]
+        if confounds.shape[0] != self.n_timepoints:
+            logger.critical("The confounds have {} rows, but the image has {} "
+                "timepoints after dropping dummy TRs".format(confounds.shape[0],
+                self.n_timepoints))
+            sys.exit(1)
+        if self.detrend:
+            confounds = project_out(confounds, self.trend_basis)
+        if self.filter:
+            confounds = self.butterworth(confounds)
+        confounds = zscore_columns(confounds)
+        Q, R, _ = linalg.qr(confounds, mode='economic', pivoting=True)
+        return Q[:, np.abs(np.diag(R)) > np.finfo(np.float64).eps * 100.]
+
+    def __get_projection_basis(self):
+        '''
+        without filtering between them, the detrending and confound regression
+        are one projection (the confounds are already orthogonal to the trend)
+        '''
+        if self.filter:
+            return self.confound_basis
+        bases = [b for b in [self.trend_basis, self.confound_basis] if b is not None]
+        if not bases:
+            return None
+        return np.hstack(bases)
+
+    def butterworth(self, signals):
+        '''butterworth filter the timepoints x signals array, like nilearn'''
+        return nilearn.signal.butterworth(signals, sampling_rate = 1. / self.tr,
+                                          low_pass = self.low_pass,
+                                          high_pass = self.high_pass)
+
+    def clean(self, signals):
+        '''clean a float32 timepoints x voxels block, returns a float32 block'''
+        signals = np.array(signals, dtype = np.float32)
+        if self.filter:
+            if self.detrend:
+                signals = project_out(signals, self.trend_basis)
+            signals = self.butterworth(signals).astype(np.float32)
+        if self.projection_basis is not None:
+            signals = project_out(signals, self.projection_basis)
+        if self.standardize:
+            signals = zscore_columns(signals)
+        return signals
+
+def project_out(signals, basis):
+    '''removes the projection of the columns of signals on an orthonormal basis'''
+    basis = basis.astype(signals.dtype)
+    signals -= basis.dot(basis.T.dot(signals))
+    return signals
+
+def zscore_columns(signals):
+    '''demean and scale the columns to unit variance (constant columns are left at zero)'''
+    signals = signals - signals.mean(axis = 0)
+    std = signals.std(axis = 0)
+    std[std < np.finfo(np.float64).eps] = 1.
+    signals /= std
+    return signals
+
+def load_nifti_memmap(nifti_path, tmpdir):
+    '''loads a nifti so that its data is a memory map, decompressing it into the tmpdir if needed'''
+    if nifti_path.endswith('.gz'):
+        uncompressed = os.path.join(tmpdir, 'input_uncompressed.nii')
+        with gzip.open(nifti_path, 'rb') as f_in, open(uncompressed, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        nifti_path = uncompressed
+    return nib.load(nifti_path, mmap = True)
+
+def open_nifti_memmap(nifti_path, header, shape):
+    '''
+    writes a header (copied from the input) for a float32 uncompressed nifti of
+    this shape, and returns the data part of the new file as a writeable memory map
+    '''
+    header = header.copy()
+    header.extensions = type(header.extensions)()
+    header.set_data_shape(shape)
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1, 0)
+    offset = header.single_vox_offset
+    header.set_data_offset(offset)
+    with open(nifti_path, 'wb') as f:
+        header.write_to(f)
+        f.write(b'\x00' * (offset - f.tell()))
+        f.truncate(offset + int(np.prod(shape)) * 4)
+    return np.memmap(nifti_path, dtype = header.get_data_dtype(), mode = 'r+',
+                     offset = offset, shape = shape, order = 'F')
+
+def clean_rows_in_blocks(input_data, output_data, confound_signals, settings,
+                         slope = 1, inter = 0):
+    '''
+    cleans a rows (voxels or grayordinates) x timepoints array one block of rows at
+    a time, each block is read from the input (i.e. a memory map) and written to the
+    output as soon as it is cleaned
+    '''
+    n_rows, n_input_timepoints = input_data.shape
     start_tr = settings.start_from_tr
-    df = settings.confounds.iloc[start_tr:, :]
-    # then select the columns of interest
-    outdf = df.loc[:,settings.cf_cols]
-    # then add the squares
-    for colname in settings.cf_sq_cols:
-        outdf.loc[:,'{}_sq'.format(colname)] = df.loc[:,colname]**2
-    # then add the lags
-    for colname in settings.cf_td_cols:
-        outdf.loc[:,'{}_lag'.format(colname)] = df.loc[:,colname].diff().fillna(0)
-    # then add the squares of the lags
-    for colname in settings.cf_sqtd_cols:
-        x = df.loc[:,colname].diff().fillna(0)
-        outdf.loc[:,'{}_sqlag'.format(colname)] = x**2
-    outdf = outdf.fillna(0) # added at the request of Colin
-    return outdf
-
-def clean_image_with_nilearn(input_img, confound_signals, settings):
-    '''clean the image with nilearn.image.clean()
+    n_timepoints = n_input_timepoints - start_tr
+
+    do_cleaning = cleaning_required(confound_signals, settings)
+    if do_cleaning:
+        design = CleaningDesign(n_timepoints, confound_signals, settings)
+
+    block_size = max(1, CLEAN_BLOCK_BYTES // (8 * n_input_timepoints))
+    for block_start in range(0, n_rows, block_size):
+        block = slice(block_start, min(block_start + block_size, n_rows))
+        # the dummy TRs are dropped as a slice of the input
+        signals = np.asarray(input_data[block, start_tr:].T, dtype = np.float32)
+        if slope != 1 or inter != 0:
+            signals = signals * np.float32(slope) + np.float32(inter)
+        if do_cleaning:
+            signals = design.clean(signals)
+        output_data[block, :] = signals.T
+
+def clean_nifti_in_blocks(input_nifti, output_nifti, confound_signals, settings, tmpdir):
+    '''
+    cleans a 4D nifti one block of voxels at a time, from a memory map of the
+    input into a memory map of the (uncompressed) output nifti
     '''
-    # first determiner if cleaning is required
-    if any((settings.detrend == True,
-           settings.standardize == True,
-           confound_signals is not None,
-           settings.high_pass is not None,
-           settings.low_pass is not None)):
-
-        # the nilearn cleaning step..
-        clean_output = nilearn.image.clean_img(input_img,
-                            detrend=settings.detrend,
-                            standardize=settings.standardize,
-                            confounds=confound_signals.values,
-                            low_pass=settings.low_pass,
-                            high_pass=settings.high_pass,
-                            t_r=settings.func.tr)
-        return clean_output
+    input_img = load_nifti_memmap(input_nifti, tmpdir)
+    x, y, z, t = input_img.shape
+    n_voxels = x * y * z
+    n_timepoints = t - settings.start_from_tr
+
+    # voxels x timepoints views of the files (fortran ordered, as on disk)
+    input_data = input_img.dataobj.get_unscaled().reshape((n_voxels, t), order = 'F')
+    output_data = open_nifti_memmap(output_nifti, input_img.header,
+                                    (x, y, z, n_timepoints))
+    clean_rows_in_blocks(input_data,
+                         output_data.reshape((n_voxels, n_timepoints), order = 'F'),
+                         confound_signals, settings,
+                         slope = input_img.dataobj.slope,
+                         inter = input_img.dataobj.inter)
+    output_data.flush()
+    del output_data
+
+class GrayordinateRows:
+    '''
+    a grayordinates x timepoints view of the (timepoints x grayordinates) data
+    proxy of a dtseries, slicing it only reads those grayordinates from disk
+    '''
+    def __init__(self, dataobj):
+        self.dataobj = dataobj
+        self.shape = tuple(dataobj.shape[::-1])
+
+    def __getitem__(self, index):
+        rows, columns = index
+        return np.asarray(self.dataobj[columns, rows]).T
+
+def clean_cifti_in_blocks(input_cifti, output_cifti, confound_signals, settings, tmpdir):
+    '''
+    cleans the grayordinates x timepoints matrix of a dtseries one block of
+    grayordinates at a time (read from disk as it is needed) and writes the
+    result as a dtseries (smoothed here if settings.smooth.python_smoothing)
+    '''
+    input_dataobj, input_header = ciftify.niio.load_cifti2_proxy(input_cifti)
+    input_data = GrayordinateRows(input_dataobj)
+    n_grayordinates, t = input_data.shape
+    n_timepoints = t - settings.start_from_tr
+
+    # the cleaned data is held in a memory map (in the on disk, timepoints x grayordinates, order)
+    output_data = np.memmap(os.path.join(tmpdir, 'clean_dtseries.dat'),
+                            dtype = np.float32, mode = 'w+',
+                            shape = (n_timepoints, n_grayordinates))
+    clean_rows_in_blocks(input_data, output_data.T, confound_signals, settings)
+
+    # python smoothing is one sparse grayordinates x grayordinates matrix product
+    if settings.smooth.fwhm > 0 and settings.smooth.python_smoothing:
+        operator = ciftify.smoothing.cifti_smoothing_operator(input_header.get_axis(1),
+            settings.smooth.sigma, settings.smooth.sigma,
+            settings.smooth.left_surface, settings.smooth.right_surface)
+        smoothed_data = np.memmap(os.path.join(tmpdir, 'smooth_dtseries.dat'),
+                                  dtype = np.float32, mode = 'w+',
+                                  shape = (n_timepoints, n_grayordinates))
+        ciftify.smoothing.apply_operator(operator, output_data.T,
+            n_cpus = int(ciftify.utils.get_number_cpus()), out = smoothed_data.T)
+        del output_data
+        output_data = smoothed_data
+
+    series_axis = input_header.get_axis(0)
+    ciftify.niio.write_cifti2_dtseries(output_cifti, output_data.T,
+        input_header.get_axis(1), step = settings.func.tr,
+        start = series_axis.start + settings.start_from_tr * settings.func.tr)
+    del output_data
+
+def smooth_nifti_in_blocks(nifti_path, fwhm):
+    '''smooth an uncompressed nifti in place, with nilearn, a block of timepoints at a time'''
+    img = nib.load(nifti_path, mmap = True)
+    x, y, z, t = img.shape
+    data = np.memmap(nifti_path, dtype = img.get_data_dtype(), mode = 'r+',
+                     offset = img.dataobj.offset, shape = img.shape,
+                     order = 'F')
+    block_size = max(1, CLEAN_BLOCK_BYTES // (8 * x * y * z))
+    for block_start in range(0, t, block_size):
+        block = slice(block_start, min(block_start + block_size, t))
+        vols = nib.Nifti1Image(np.asarray(data[:, :, :, block]), img.affine)
+        data[:, :, :, block] = nilearn.image.smooth_img(vols, fwhm).get_fdata(dtype = np.float32)
+    data.flush()
+    del data
+
+def write_nifti_output(clean_nifti, output_file):
+    '''move the uncompressed cleaned nifti to the output, compressing it if asked for'''
+    if output_file.endswith('.gz'):
+        with open(clean_nifti, 'rb') as f_in, gzip.open(output_file, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
     else:
-        return input_img
+        shutil.move(clean_nifti, output_file)
 
 def main():
     arguments = docopt(__doc__)
@@ -370,10 +767,13 @@ def main():
     logger.info('{}{}'.format(ciftify.utils.ciftify_logo(),
         ciftify.utils.section_header('Starting ciftify_clean_img')))
 
-    with ciftify.utils.TempDir() as tmpdir:
-        logger.info('Creating tempdir:{} on host:{}'.format(tmpdir,
-                    os.uname()[1]))
-        ret = run_ciftify_clean_img(arguments, tmpdir)
+    if arguments['batch']:
+        ret = run_batch_clean_img(arguments)
+    else:
+        with ciftify.utils.TempDir() as tmpdir:
+            logger.info('Creating tempdir:{} on host:{}'.format(tmpdir,
+                        os.uname()[1]))
+            ret = run_ciftify_clean_img(arguments, tmpdir)
 
     logger.info(ciftify.utils.section_header('Done ciftify_clean_img'))
     sys.exit(ret)
@@ -17,19 +17,38 @@ Options:
   --max-total-freq 0.25  Max total frequency range value Hz [default: 0.25]
   --mask-file <maskfile.nii.gz>  Input brain mask
   --calc-alff  Calculates amplitude of low frequency fluctuations (ALFF) instead of fALFF
+  --bands LIST  Comma separated list of maps to calculate in one pass (see details)
+  --tr SEC  Repetition time in seconds (read from the input header when not given)
+  --censor-file <censor.1D>  One value per TR, 0 for TRs to censor and 1 for TRs to keep
   --debug  Debug logging
   -h,--help  Print help
 
+DETAILS
+Frequencies are in Hz, using the TR from the header of the input file
+(the dtseries time step, or the 4th voxel dimension of a nifti).
+
+When a --censor-file is given, the amplitude spectrum is estimated from the kept
+TRs only, using the Lomb-Scargle periodogram for unevenly sampled data.
+
+The --bands option computes the spectrum once and writes one map per entry of
+the list (a multi-map dscalar for cifti input, a 4D nifti for nifti input).
+Each entry is a metric (alff or falff) with an optional band after a colon,
+either one of the named slow bands (slow2, slow3, slow4, slow5) or a
+<min>-<max> range in Hz. Without a band, the --min/max-low-freq range is used.
+fALFF maps are always divided by the --min/max-total-freq range.
+
+For example, to write ALFF, fALFF, slow-4 and slow-5 ALFF and a custom fALFF band:
+    ciftify_falff func.dtseries.nii out.dscalar.nii --bands alff,falff,alff:slow4,alff:slow5,falff:0.01-0.1
+
 """
 
 import os
 import numpy as np
 import nibabel as nib
-from scipy.fftpack import fft
 from docopt import docopt
-from ciftify.utils import run, TempDir
 from ciftify.meants import NibInput
 import ciftify.config
+import ciftify.niio
 import logging
 import sys
 
@@ -37,6 +56,15 @@ config_path = os.path.join(os.path.dirname(ciftify.config.find_ciftify_global())
 logging.config.fileConfig(config_path, disable_existing_loggers=False)
 logger = logging.getLogger(os.path.basename(__file__))
 
+# the largest chunk of spectra (in bytes) held in memory at once
+FFT_CHUNK_BYTES = 256 * 1024**2
+
+# named slow frequency bands (Hz) from Zuo et al. (2010) NeuroImage 49(2)
+SLOW_BANDS = {'slow2': (0.198, 0.25),
+              'slow3': (0.073, 0.198),
+              'slow4': (0.027, 0.073),
+              'slow5': (0.01, 0.027)}
+
 def main():
     ''''''
     arguments = docopt(__doc__)
@@ -48,6 +76,9 @@ def main():
     max_total_freq = arguments['--max-total-freq']
     maskfile = arguments['--mask-file']
     calc_alff = arguments['--calc-alff']
+    bands_arg = arguments['--bands']
+    tr_arg = arguments['--tr']
+    censorfile = arguments['--censor-file']
 
     logger.setLevel(logging.WARNING)
 
@@ -57,133 +88,314 @@ def main():
 
     logger.info(arguments)
 
-    with ciftify.utils.TempDir() as tmpdir:
-
-        # IF INPUT IS A NIFTI FILE
-        # Sets input funcfile equal to inputfile
-        func = NibInput(funcfile)
-
-
-        # IF INPUT IS CIFTI FILE
-        # Convert cifti input file to nifti input file
-        if func.type == "cifti":
-            inputfile = convert_cifti_to_nifti(func.path, tmpdir)
-            if maskfile:
-                maskinput = convert_cifti_to_nifti(maskfile, tmpdir)
-            else:
-                maskinput = None
-        elif func.type == "nifti":
-            inputfile = func.path
-            if maskfile:
-                maskinput = maskfile
-            else:
-                maskinput = None
-        else:
-            logger.critical("Could not read <func.nii.gz> as nifti or cifti file")
-            sys.exit(1)
-
-
-        falff_nifti_output = calc_nifti(inputfile, maskinput, min_low_freq, max_low_freq, min_total_freq, max_total_freq, tmpdir, calc_alff)
-
-        # Convert nifti output file to cifti output file
-        if func.type == "cifti":
-            convert_nifti_to_cifti(falff_nifti_output, funcfile, outputname)
+    if bands_arg:
+        bands = parse_bands(bands_arg, min_low_freq, max_low_freq)
+    else:
+        bands = [AmplitudeBand('alff' if calc_alff else 'falff',
+                               calc_alff, min_low_freq, max_low_freq)]
 
-        # IF INPUT IS NIFTI FILE
-        # If funcfile was not cifti file, save as nifti file to outputname
-        if func.type == "nifti":
-            run("mv {} {}".format(falff_nifti_output, outputname))
+    func = NibInput(funcfile)
 
+    if func.type == "cifti":
+        calc_cifti(func.path, maskfile, outputname, bands, min_total_freq,
+                   max_total_freq, tr_arg, censorfile)
+    elif func.type == "nifti":
+        calc_nifti(func.path, maskfile, outputname, bands, min_total_freq,
+                   max_total_freq, tr_arg, censorfile)
+    else:
+        logger.critical("Could not read <func.nii.gz> as nifti or cifti file")
+        sys.exit(1)
+
+def define_tr(tr_arg, header_tr, funcfile):
+    '''use the TR given by the user, otherwise the TR from the input header'''
+    if tr_arg:
+        return float(tr_arg)
+    if not header_tr:
+        logger.critical("Could not read the TR from the header of {}, "
+                        "please give it with --tr".format(funcfile))
+        sys.exit(1)
+    logger.info("Using a TR of {} seconds from the header of {}".format(header_tr, funcfile))
+    return header_tr
+
+def nifti_tr(func_img):
+    '''the TR in seconds from the header of a nifti image, or None if it is not set'''
+    zooms = func_img.header.get_zooms()
+    if len(zooms) < 4 or zooms[3] <= 0:
+        return None
+    time_unit = func_img.header.get_xyzt_units()[1]
+    if time_unit == 'msec':
+        return float(zooms[3]) / 1000
+    if time_unit == 'usec':
+        return float(zooms[3]) / 1000000
+    return float(zooms[3])
+
+def read_censor_file(censorfile, n_timepoints):
+    '''
+    reads the censor file as a boolean mask of the TRs to keep
+    returns None when no TRs are censored
+    '''
+    if not censorfile:
+        return None
+    sample_mask = np.loadtxt(censorfile).ravel() != 0
+    if len(sample_mask) != n_timepoints:
+        logger.critical("The censor file {} has {} values but the input has {} TRs"
+                        "".format(censorfile, len(sample_mask), n_timepoints))
+        sys.exit(1)
+    if sample_mask.sum() < 3:
+        logger.critical("Less than 3 TRs are left after censoring with {}".format(censorfile))
+        sys.exit(1)
+    if sample_mask.all():
+        return None
+    logger.info("Estimating the spectrum from {} of {} TRs".format(sample_mask.sum(), n_timepoints))
+    return sample_mask
+
+class AmplitudeBand(object):
+    '''one output map, alff or falff within a frequency band'''
+    def __init__(self, name, calc_alff, min_freq, max_freq):
+        self.name = name
+        self.calc_alff = calc_alff
+        self.min_freq = float(min_freq)
+        self.max_freq = float(max_freq)
+
+def parse_bands(bands_arg, min_low_freq, max_low_freq):
+    '''
+    parse the --bands list into AmplitudeBand objects
+    each entry is <metric>[:<band>] where band is a SLOW_BANDS name or <min>-<max>
+    '''
+    bands = []
+    for entry in bands_arg.split(','):
+        entry = entry.strip()
+        metric, _, band = entry.partition(':')
+        if metric.lower() not in ['alff', 'falff']:
+            logger.critical('Could not read --bands entry {}, metric must be '
+                            'alff or falff'.format(entry))
+            sys.exit(1)
+        if not band:
+            min_freq, max_freq = min_low_freq, max_low_freq
+        elif band.lower() in SLOW_BANDS:
+            min_freq, max_freq = SLOW_BANDS[band.lower()]
+        else:
+            try:
+                min_freq, max_freq = [float(f) for f in band.split('-')]
+            except ValueError:
+                logger.critical('Could not read --bands entry {}, the band should '
+                    'be one of {} or <min>-<max>'.format(entry, ', '.join(sorted(SLOW_BANDS))))
+                sys.exit(1)
+        bands.append(AmplitudeBand(entry, metric.lower() == 'alff', min_freq, max_freq))
+    return bands
+
+
+def calc_cifti(inputfile, maskfile, outputname, bands, min_total_freq,
+               max_total_freq, tr_arg, censorfile):
+    '''
+    calculates falff from the grayordinates of a dtseries and writes a dscalar output
+    with one map per band
+    '''
+    # Load in functional data as grayordinates by timepoints
+    func_data, func_header = ciftify.niio.load_cifti2(inputfile)
+    tr = define_tr(tr_arg, ciftify.niio.cifti_series_step(func_header), inputfile)
+    sample_mask = read_censor_file(censorfile, func_data.shape[1])
 
-# If input is cifti - convert to fake nifti (fake_nifti_input)
-# Convert to nifti
-def convert_cifti_to_nifti(funcfile, tmpdir):
-    fake_nifti_input = os.path.join(tmpdir, 'input_fake.nii.gz')
-    run('wb_command -cifti-convert -to-nifti {} {} '.format(funcfile, fake_nifti_input))
-    return fake_nifti_input
+    # If given input of mask, load in mask file
+    # OR if not given input of mask, create mask using std
+    if maskfile:
+        mask = ciftify.niio.load_cifti2(maskfile)[0][:, 0]
+        if len(mask) != func_data.shape[0]:
+            logger.critical("The mask {} does not have the same grayordinates as {}"
+                            "".format(maskfile, inputfile))
+            sys.exit(1)
+    else:
+        mask = calc_std_in_chunks(func_data)
 
-# If input is cifti - convert nifti output (falff_nifti_output) back to cifti
-# Convert to cifti
-def convert_nifti_to_cifti(falff_nifti_output, funcfile, outputname):
-    run('wb_command -cifti-convert -from-nifti {} {} {} -reset-scalars'.format(falff_nifti_output, funcfile, outputname))
+    falff_data = calc_masked_amplitudes(func_data, mask, bands, min_total_freq,
+                                        max_total_freq, tr, sample_mask)
 
+    ciftify.niio.write_cifti2_dscalar(outputname, falff_data,
+                                      func_header.get_axis(1),
+                                      [band.name for band in bands])
 
-def calc_nifti(inputfile, maskfile, min_low_freq, max_low_freq, min_total_freq, max_total_freq, tmpdir, calc_alff):
+def calc_nifti(inputfile, maskfile, outputname, bands, min_total_freq,
+               max_total_freq, tr_arg, censorfile):
     '''
-    calculates falff from nifti input and retruns nifti output
-
-    Takes input files to give to falff function and returns output file
+    calculates falff from nifti input and writes a nifti output
+    with one volume per band
     '''
     # Load in functional data
     func_img = nib.load(inputfile)
     func_data = func_img.get_data()
 
-    # If given input of mask, load in mask file
-    # OR if not given input of mask, create mask using std
-    if maskfile:
-        #1. Given input of mask file
-        mask = (nib.load(maskfile)).get_data()
-    else:
-        #2. Manually create mask
-        mask = np.std(func_data, axis=3)
-
-    # Find indices where mask does not = 0
-    indx,indy,indz = np.where(mask != 0)
-
     # Define affine array
     affine = func_img.affine
 
     # Define x,y,z,t coordinates
     x,y,z,t = func_data.shape
 
-    # Create empty array to save values
-    falff_vol = np.zeros((x,y,z))
+    tr = define_tr(tr_arg, nifti_tr(func_img), inputfile)
+    sample_mask = read_censor_file(censorfile, t)
 
-    # Loop through x,y,z indices, send to calculate_falff function
-    for x,y,z in zip(indx,indy,indz):
-        falff_vol[x,y,z] = calculate_falff(func_data[x,y,z,:], min_low_freq, max_low_freq, min_total_freq, max_total_freq, calc_alff)
-
-    # Save falff values to fake nifti output temp file
-    output_3D = nib.Nifti1Image(falff_vol, affine)
-    falff_nifti_output = os.path.join(tmpdir, 'output_fake.nii.gz') # Make temp directory for nifti output
-    output_3D.to_filename(falff_nifti_output)
+    # Reshape to voxels by timepoints (in the on disk, fortran, order so that no copy is made)
+    func_data = func_data.reshape((x*y*z, t), order = 'F')
 
-    return falff_nifti_output
+    # If given input of mask, load in mask file
+    # OR if not given input of mask, create mask using std
+    if maskfile:
+        #1. Given input of mask file
+        mask = (nib.load(maskfile)).get_data().reshape(x*y*z, order = 'F')
+    else:
+        #2. Manually create mask
+        mask = calc_std_in_chunks(func_data)
 
-# CALCULATES FALFF
-def calculate_falff(timeseries, min_low_freq, max_low_freq, min_total_freq, max_total_freq, calc_alff):
-    ''' this will calculate falff from a timeseries'''
+    falff_vol = calc_masked_amplitudes(func_data, mask, bands, min_total_freq,
+                                       max_total_freq, tr, sample_mask)
+    falff_vol = falff_vol.reshape((x,y,z,len(bands)), order = 'F')
+    if len(bands) == 1:
+        falff_vol = falff_vol[:,:,:,0]
 
-    n = len(timeseries)
-    time = (np.arange(n))*2
+    # Save falff values to nifti output
+    output_3D = nib.Nifti1Image(falff_vol, affine)
+    output_3D.to_filename(outputname)
 
-    # Takes fast Fourier transform of timeseries
-    fft_timeseries = fft(timeseries)
-    # Calculates frequency scale
-    freq_scale = np.fft.fftfreq(n, 1/1)
+def calc_masked_amplitudes(func_data, mask, bands, min_total_freq, max_total_freq,
+                           tr, sample_mask):
+    '''
+    calculates the band maps for the rows of func_data inside the mask,
+    rows outside the mask are left as zero
+    '''
+    # Find indices where mask does not = 0
+    mask_idx = np.flatnonzero(mask)
+
+    result = np.zeros((func_data.shape[0], len(bands)))
+    result[mask_idx, :] = calculate_amplitude_maps(func_data, bands,
+                                                   min_total_freq, max_total_freq,
+                                                   rows = mask_idx, tr = tr,
+                                                   sample_mask = sample_mask)
+    return result
+
+def chunk_slices(n_rows, n_timepoints, chunk_bytes = FFT_CHUNK_BYTES):
+    '''yields slices over the rows so that each chunk\'s spectrum fits in chunk_bytes'''
+    # the complex spectrum takes 16 bytes per frequency
+    chunk_rows = max(1, int(chunk_bytes // (16 * n_timepoints)))
+    for start in range(0, n_rows, chunk_rows):
+        yield slice(start, min(start + chunk_rows, n_rows))
+
+def calc_std_in_chunks(func_data):
+    '''the standard deviation of each row of the voxels by timepoints matrix'''
+    std_data = np.zeros(func_data.shape[0])
+    for chunk in chunk_slices(func_data.shape[0], func_data.shape[1]):
+        std_data[chunk] = np.std(func_data[chunk, :], axis=1)
+    return std_data
+
+def frequency_band_weights(n, min_freq, max_freq, tr = 1.0):
+    '''
+    for a frequency band (in Hz) of the full (two sided) fft frequency scale,
+    returns how many times each frequency from the real fft (np.fft.rfft) is counted
+    '''
+    freq_scale = np.fft.fftfreq(n, tr)
+    band_ind = np.where((float(min_freq) <= freq_scale) & (freq_scale <= float(max_freq)))[0]
+    # negative frequencies have the same amplitude as their positive pair
+    rfft_ind = np.minimum(band_ind, n - band_ind)
+    return np.bincount(rfft_ind, minlength = n // 2 + 1).astype(float)
 
-    # Calculates power of fft
-    mag = (abs(fft_timeseries))**0.5
+def fft_amplitudes(timeseries):
+    '''the amplitude of the real fft of each row of timeseries'''
+    return np.abs(np.fft.rfft(timeseries, axis=1))
 
-    # Finds low frequency range (0.01-0.08) and total frequency range (0.0-0.25)
-    low_ind = np.where((float(min_low_freq) <= freq_scale) & (freq_scale <= float(max_low_freq)))
-    total_ind = np.where((float(min_total_freq) <= freq_scale) & (freq_scale <= float(max_total_freq)))
+class LombScargleAmplitudes(object):
+    '''
+    Estimates the amplitudes of the real fft (on the frequencies of the full
+    length timeseries) from only the kept timepoints, using the Lomb-Scargle
+    periodogram. Called on a rows by timepoints array, like fft_amplitudes.
 
-    # Indexes power to low frequency index, total frequency range
-    low_power = mag[low_ind]
-    total_power = mag[total_ind]
-    # Calculates sum of lower power and total power
-    low_pow_sum = np.sum(low_power)
-    total_pow_sum = np.sum(total_power)
+    The cosine and sine bases only depend on the sample times, so they are built
+    once and the periodogram of every row is two matrix products.
+    '''
+    def __init__(self, n, tr, sample_mask):
+        self.sample_mask = np.asarray(sample_mask, dtype = bool)
+        self.n_kept = self.sample_mask.sum()
+        times = np.arange(n)[self.sample_mask] * tr
+        omega = 2 * np.pi * np.fft.rfftfreq(n, tr)[1:]
+        wt = np.outer(times, omega)
+        tau = np.arctan2(np.sin(2 * wt).sum(axis = 0),
+                         np.cos(2 * wt).sum(axis = 0)) / (2 * omega)
+        phase = wt - omega * tau
+        self.cos_basis = self.__normalise_columns(np.cos(phase))
+        self.sin_basis = self.__normalise_columns(np.sin(phase))
+        # scales the periodogram to fft amplitudes, frequencies with no
+        # sine term (i.e. the nyquist) put all their power in the cosine
+        self.scale = np.where(self.sin_basis.any(axis = 0), self.n_kept / 2.0, self.n_kept)
+
+    def __normalise_columns(self, basis):
+        '''scale each column to unit length, columns that are (nearly) all zero are left as zero'''
+        norms = np.sqrt((basis**2).sum(axis = 0))
+        out = np.zeros(basis.shape)
+        np.divide(basis, norms, out = out, where = norms > 1e-8 * np.sqrt(self.n_kept))
+        return out
+
+    def __call__(self, timeseries):
+        kept = timeseries[:, self.sample_mask]
+        # the zero frequency term is the sum, like the fft
+        dc = np.abs(kept.sum(axis = 1))
+        demeaned = kept - kept.mean(axis = 1)[:, np.newaxis]
+        power = demeaned.dot(self.cos_basis)**2 + demeaned.dot(self.sin_basis)**2
+        return np.column_stack((dc, np.sqrt(self.scale * power)))
+
+def calculate_amplitude_maps(func_data, bands, min_total_freq, max_total_freq,
+                             rows = None, tr = 1.0, sample_mask = None):
+    '''
+    calculates falff (or alff) for every band and every row of a voxels by timepoints matrix
 
-    # Calculates alff as the sum of amplitudes within the low frequency range
-    if calc_alff:
-        calc = low_pow_sum
-    # Calculates falff as the sum of power in low frequnecy range divided by sum of power in the total frequency range
+    The fft is taken once along the time axis, for chunks of rows at a time,
+    and shared by all the bands. Returns an array of rows by bands.
+    Pass an index array as rows to only calculate for those rows of func_data.
+    Pass a boolean sample_mask of the timepoints to keep to estimate the
+    spectrum with censored timepoints.
+    '''
+    if rows is None:
+        rows = np.arange(func_data.shape[0])
+    n = func_data.shape[1]
+
+    # Finds the band frequency ranges and total frequency range once for all rows
+    band_weights = np.column_stack([frequency_band_weights(n, band.min_freq, band.max_freq, tr)
+                                    for band in bands])
+    total_weights = frequency_band_weights(n, min_total_freq, max_total_freq, tr)
+    is_falff = np.array([not band.calc_alff for band in bands])
+
+    if sample_mask is None:
+        amplitudes = fft_amplitudes
     else:
-        calc = np.divide(low_pow_sum, total_pow_sum)
+        amplitudes = LombScargleAmplitudes(n, tr, sample_mask)
+
+    result = np.zeros((len(rows), len(bands)))
+    for chunk in chunk_slices(len(rows), n):
+        # Calculates power of the fft of the timeseries
+        mag = amplitudes(func_data[rows[chunk], :])**0.5
+        # Calculates alff as the sum of amplitudes within each band
+        result[chunk, :] = mag.dot(band_weights)
+        # Calculates falff as the sum of power in the band divided by sum of power in the total frequency range
+        if is_falff.any():
+            total_pow_sum = mag.dot(total_weights)
+            result[chunk, is_falff] = np.divide(result[chunk, is_falff],
+                                                total_pow_sum[:, np.newaxis])
+    return result
+
+def calculate_falff_matrix(func_data, min_low_freq, max_low_freq, min_total_freq,
+                           max_total_freq, calc_alff, rows = None, tr = 1.0):
+    '''
+    calculates falff (or alff) for every row of a voxels by timepoints matrix
+    '''
+    band = AmplitudeBand('alff' if calc_alff else 'falff', calc_alff,
+                         min_low_freq, max_low_freq)
+    result = calculate_amplitude_maps(func_data, [band], min_total_freq,
+                                      max_total_freq, rows = rows, tr = tr)
+    return result[:, 0]
 
-    return calc
+# CALCULATES FALFF
+def calculate_falff(timeseries, min_low_freq, max_low_freq, min_total_freq, max_total_freq, calc_alff, tr = 1.0):
+    ''' this will calculate falff from a timeseries'''
+    timeseries = np.asarray(timeseries).reshape(1, -1)
+    calc = calculate_falff_matrix(timeseries, min_low_freq, max_low_freq,
+                                  min_total_freq, max_total_freq, calc_alff, tr = tr)
+    return calc[0]
 
 if __name__=='__main__':
     main()
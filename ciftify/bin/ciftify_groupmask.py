@@ -13,6 +13,10 @@ Arguments:
 Options:
   --percent-thres <Percent>  Lower threshold [default: 5] applied to all files to make mask.
   --cifti-column <column>    Lower threshold [default: 1] applied to all files to make mask.
+  --coverage-map <dscalar>   Also write a map of the number of files each
+                             grayordinate is valid in
+  --n_cpus INT               Number of files to read at once. Defaults to the value
+                             of the OMP_NUM_THREADS environment variable
   --debug                    Debug logging in Erin's very verbose style
   --help                     Print help
 
@@ -23,15 +27,20 @@ a mask, for each subject, of valid voxels (i.e. voxels of signal above the perce
 Then, for each voxel/vertex we take the minimum value across the population.
 Therefore our mask contains 1 for each vertex that is valid for all participants and 0 otherwise.
 
+Only the selected column of each file is read, and the files are combined as
+they are read, so no temporary files are written. The optional coverage map
+counts, for each vertex/voxel, the number of participants it is valid for.
+
 Written by Erin W Dickie, April 15, 2016
 """
 import sys
-import subprocess
 import os
-import glob
 import logging
 import logging.config
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+import nibabel as nib
 from docopt import docopt
 
 import ciftify
@@ -41,16 +50,49 @@ config_path = os.path.join(os.path.dirname(__file__), "logging.conf")
 logging.config.fileConfig(config_path, disable_existing_loggers=False)
 logger = logging.getLogger(os.path.basename(__file__))
 
-
-
-## function for getting a percentile value from a cifti file
-def get_cifti_percentile(ciftifile, percentile, column):
-    pctl = ciftify.utils.get_stdout(['wb_command', '-cifti-stats',
-                      ciftifile,
-                      '-percentile', str(percentile),
-                      '-column', str(column)])
-    pctl = pctl.replace('\n','')
-    return pctl
+def read_cifti_column(ciftifile, column):
+    '''
+    reads one column (1-based, as in wb_command) of a cifti file without
+    reading the rest of the file, returns it with the file's brain models
+    '''
+    try:
+        cifti = nib.load(ciftifile)
+        brain_models = cifti.header.get_axis(1)
+        data = np.asarray(cifti.dataobj[int(column) - 1, :], dtype = np.float64)
+    except Exception as e:
+        logger.error("Cannot read column {} of {}: {}".format(column, ciftifile, e))
+        sys.exit(1)
+    return data, brain_models
+
+def above_percentile(ciftifile, percentile, column):
+    '''
+    the mask of a file's column above the percentile of its values
+    (the same interpolated percentile as wb_command -cifti-stats -percentile)
+    '''
+    data, brain_models = read_cifti_column(ciftifile, column)
+    pctl = np.nanpercentile(data, float(percentile))
+    logger.debug('{} percentile {}: {}'.format(ciftifile, percentile, pctl))
+    return data > pctl, brain_models
+
+def calc_group_mask(filelist, percentile, column, n_cpus = 1):
+    '''
+    the group mask (valid in every file) and coverage count (the number of
+    files each grayordinate is valid in), combined as the files are read
+    '''
+    coverage = None
+    with ThreadPoolExecutor(max_workers = max(1, int(n_cpus))) as executor:
+        results = executor.map(lambda f: above_percentile(f, percentile, column), filelist)
+        for ciftifile, (valid, brain_models) in zip(filelist, results):
+            if coverage is None:
+                coverage = np.zeros(valid.shape, dtype = np.int32)
+                group_brain_models = brain_models
+            elif brain_models != group_brain_models:
+                logger.error("{} does not have the same grayordinates as {}".format(
+                    ciftifile, filelist[0]))
+                sys.exit(1)
+            coverage += valid
+    mask = coverage == len(filelist)
+    return mask, coverage, group_brain_models
 
 def main():
 
@@ -59,6 +101,7 @@ def main():
     filelist = arguments['<input.dtseries.nii>']
     column = arguments['--cifti-column']
     percentile = arguments['--percent-thres']
+    coverage_map = arguments['--coverage-map']
     debug = arguments['--debug']
 
     if debug:
@@ -69,33 +112,20 @@ def main():
         ciftify.utils.section_header('Starting ciftify_groupmask')))
     ciftify.utils.log_arguments(arguments)
 
-    with ciftify.utils.TempDir() as tempdir:
-        logger.info('Creating tempdir:{} on host:{}'.format(tempdir,
-                    os.uname()[1]))
-
-        ## start the merge command
-        merge_cmd = ['wb_command', '-cifti-merge',
-           os.path.join(tempdir, 'mergedfile.dscalar.nii')]
-
-        for i in range(len(filelist)):
-            '''
-            for each file, threshold and binarize then add to the merge_cmd filelist
-            '''
-            ciftifile = filelist[i]
-            pctl = get_cifti_percentile(ciftifile, percentile, column)
-            ciftify.utils.run(['wb_command', '-cifti-math', 'x > {}'.format(pctl),
-                   os.path.join(tempdir, 'tmp{}.dscalar.nii'.format(i)),
-                   '-var','x',ciftifile, '-select', '1', str(column)])
-            merge_cmd.append('-cifti')
-            merge_cmd.append(os.path.join(tempdir, 'tmp{}.dscalar.nii'.format(i)))
-
-        ## merge the files and take the minimum (i.e. 100 good voxels = mask)
-        ciftify.utils.run(merge_cmd)
-        ciftify.utils.run(['wb_command', '-cifti-reduce',
-              os.path.join(tempdir, 'mergedfile.dscalar.nii'),
-              'MIN', outputmask])
-
-        logger.info(ciftify.utils.section_header('Done ciftify_groupmask'))
+    for ciftifile in filelist:
+        ciftify.utils.check_input_readable(ciftifile)
+    n_cpus = ciftify.utils.get_number_cpus(arguments['--n_cpus'])
+
+    mask, coverage, brain_models = calc_group_mask(filelist, percentile,
+                                                   column, n_cpus)
+    logger.info('{} of {} grayordinates are in the mask'.format(mask.sum(), len(mask)))
+
+    ciftify.niio.write_cifti2_dscalar(outputmask, mask, brain_models, ['mask'])
+    if coverage_map:
+        ciftify.niio.write_cifti2_dscalar(coverage_map, coverage, brain_models,
+                                          ['coverage'])
+
+    logger.info(ciftify.utils.section_header('Done ciftify_groupmask'))
 
 if __name__ == "__main__":
     main()
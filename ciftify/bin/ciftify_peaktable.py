@@ -17,6 +17,10 @@ Options:
 
     --outputbase prefix    Output prefix (with path) to output documents
     --no-cluster-dlabel    Do not output a dlabel map of the clusters
+    --maps LIST            Comma separated list of the maps (by number, starting at 1,
+                           or by name) to make tables for. Defaults to all maps
+    --n_cpus INT           Number of maps to make tables for at once. Defaults to the
+                           value of the OMP_NUM_THREADS environment variable
 
     --left-surface GII     Left surface file (default is HCP S1200 Group Average)
     --right-surface GII    Right surface file (default is HCP S1200 Group Average)
@@ -28,9 +32,7 @@ Options:
     -h, --help             Prints this message
 
 DETAILS
-Note: at the moment generates separate outputs for surface.
-Uses -cifti-separate in combination with FSL's clusterize to get information from
-the subcortical space.
+Note: at the moment generates separate outputs for surface and subcortical peaks.
 
 Ouptputs a results csv with several headings:
   + clusterID: Integer for the cluster this peak is from (corresponds to dlabel.nii)
@@ -45,6 +47,11 @@ Ouptputs a results csv with several headings:
   + Yeo7_overlap: The proportion of the cluster (clusterID) that overlaps with this Yeo7 network label
   + MMP: The label from the Glasser et al (2016) Multi-Modal Parcellation
   + MMP_overlap: The proportion of the cluster (clusterID) that overlaps with the MMP atlas label
+  + <atlas>_nearest: The nearest labelled vertex of each atlas to the peak (the label
+     at the peak, unless the peak is not inside any label i.e. in the medial wall)
+  + <atlas>_nearest_mm: The distance (in mm) from the peak to that labelled vertex
+The x,y,z coordinates are those of the surface given (for the default HCP S1200
+midthickness surfaces these are MNI coordinates).
 
 If no surfaces of surface area files are given. The midthickness surfaces from
 the HCP S1200 Group Mean will be used, as well as it's vertex-wise
@@ -58,6 +65,24 @@ be written to the same folder as the outputcsv to aid in visualication of the re
 This dlable map with have a name ending in '_clust.dlabel.nii'.
 (i.e. func_peaks.csv & func_clust.dlabel.nii)
 
+Tables are made for every map of the input (or the '--maps' given). With more
+than one map '_map<number>' is added to the output prefix of each map's outputs
+(i.e. func_map2_cortex.csv) and the cortex tables of all maps are also written
+to one long table ending in '_cortex_long.csv', with map_number and map_name
+columns. The maps are run in parallel by up to '--n_cpus' processes.
+
+Subcortical peaks are written to a second csv (ending in '_subcortical.csv')
+with one row per peak:
+  + clusterID: Integer for the cluster this peak is from (corresponds to dlabel.nii)
+  + structure: The subcortical structure the peak is in (i.e. THALAMUS_LEFT)
+  + i,j,k: The voxel indices of the peak
+  + x,y,z: The coordinates of the peak
+  + peak_value: The intensity (value) at that voxel in the func.dscalar.nii
+  + cluster_volume: The volume of the cluster (in mm^3)
+Subcortical clusters are face connected voxels (across structures) and
+their peaks are the largest (or smallest) value of their cluster within the
+--volume-distance. Every cluster has at least one peak.
+
 Atlas References:
 Yeo, BT. et al. 2011. 'The Organization of the Human Cerebral Cortex
 Estimated by Intrinsic Functional Connectivity.' Journal of Neurophysiology
@@ -88,7 +113,6 @@ from docopt import docopt
 
 import ciftify
 from ciftify.utils import run
-from ciftify.niio import load_hemisphere_data
 
 config_path = os.path.join(os.path.dirname(ciftify.config.find_ciftify_global()), 'bin', "logging.conf")
 logging.config.fileConfig(config_path, disable_existing_loggers=False)
@@ -130,199 +154,178 @@ def run_ciftify_peak_table(tmpdir):
     if not outputbase:
         outputbase = data_file.replace('.dscalar.nii','')
 
+    ## grab surface files from the HCP group average if they are not specified
+    surf_settings = define_surface_settings(arguments, tmpdir)
+
+    ## load the input maps and pick the ones to make tables for
+    input_data, input_header = ciftify.niio.load_cifti2(data_file)
+    map_names = list(input_header.get_axis(0).name)
+    maps = ciftify.report.define_maps(arguments['--maps'], map_names)
+
+    ## the neighbours of every grayordinate are found once for all maps
+    cifti_graph = build_cifti_graph(input_header.get_axis(1), surf_settings)
+    for hemi in ['L', 'R']:
+        cifti_graph.surface_graph(hemi)
+    settings = PeakTableSettings(data_file, cifti_graph, surf_settings, atlas_settings,
+        surf_distance, volume_distance, min_threshold, max_threshold,
+        area_threshold, dont_output_clusters)
+
+    ## with more than one map, each map gets its own outputs
+    map_jobs = []
+    for map_idx in maps:
+        map_outputbase = outputbase if len(maps) == 1 else '{}_map{}'.format(outputbase, map_idx + 1)
+        map_jobs.append((input_data[:, map_idx], map_outputbase))
+
+    n_cpus = int(ciftify.utils.get_number_cpus(arguments['--n_cpus']))
+    all_tables = ciftify.report.run_map_jobs(write_map_peak_tables, map_jobs,
+                                             settings, n_cpus)
+
+    if len(maps) > 1:
+        ciftify.report.write_long_table('{}_cortex_long.csv'.format(outputbase),
+                                        maps, map_names, all_tables)
+
+    logger.info(ciftify.utils.section_header('Done ciftify_peaktable'))
+
+
+class PeakTableSettings:
+    '''the inputs shared by the peak tables of every map'''
+    def __init__(self, data_file, cifti_graph, surf_settings, atlas_settings,
+                 surf_distance, volume_distance, min_threshold, max_threshold,
+                 area_threshold, dont_output_clusters):
+        self.data_file = data_file
+        self.cifti_graph = cifti_graph
+        self.surf_settings = surf_settings
+        self.atlas_settings = atlas_settings
+        self.surf_distance = surf_distance
+        self.volume_distance = volume_distance
+        self.min_threshold = min_threshold
+        self.max_threshold = max_threshold
+        self.area_threshold = area_threshold
+        self.dont_output_clusters = dont_output_clusters
+
+def write_map_peak_tables(input_data, outputbase, settings):
+    '''
+    writes the cortex and subcortical peak tables (and cluster dlabel) of one map
+    returns [({}, cortex table)] for the long table of all maps
+    '''
+    cifti_graph = settings.cifti_graph
+    atlas_settings = settings.atlas_settings
     outputcsv_cortex = '{}_cortex.csv'.format(outputbase)
     outputcsv_sub = '{}_subcortical.csv'.format(outputbase)
 
-    ## grab surface files from the HCP group average if they are not specified
-    surf_settings = define_surface_settings(arguments, tmpdir)
+    ## find the peak locations (like wb_command -cifti-extrema)
+    extrema = cifti_graph.find_extrema(input_data, settings.surf_distance,
+                                       settings.volume_distance,
+                                       settings.min_threshold, settings.max_threshold)
 
-    ## run wb_command -cifti-extrema to find the peak locations
-    extrema_dscalar = os.path.join(tmpdir,'extrema.dscalar.nii')
-    run(['wb_command','-cifti-extrema',
-           data_file,
-           str(surf_distance), str(volume_distance),'COLUMN',
-           extrema_dscalar,
-           '-left-surface', surf_settings['L']['surface'],
-           '-right-surface', surf_settings['R']['surface'],
-           '-threshold', str(min_threshold), str(max_threshold)])
-
-    ## also run clusterize with the same settings to get clusters
-    pcluster_dscalar = os.path.join(tmpdir,'pclusters.dscalar.nii')
-
-    wb_cifti_clusters(data_file, pcluster_dscalar, surf_settings,
-                      max_threshold, area_threshold,
-                      less_than = False, starting_label=1)
-
-    ## load both cluster files to determine the max value
-    pos_clust_data = ciftify.niio.load_concat_cifti_surfaces(pcluster_dscalar)
-    max_pos = int(np.max(pos_clust_data))
-
-    ## now get the negative clusters
-    ncluster_dscalar = os.path.join(tmpdir,'nclusters.dscalar.nii')
-    wb_cifti_clusters(data_file, ncluster_dscalar, surf_settings,
-                      min_threshold, area_threshold,
-                      less_than = True, starting_label=max_pos + 1)
-
-    ## add the positive and negative together to make one cluster map
-    clusters_dscalar = os.path.join(tmpdir,'clusters.dscalar.nii')
-    run(['wb_command', '-cifti-math "(x+y)"',
-        clusters_dscalar,
-        '-var','x',pcluster_dscalar, '-var','y',ncluster_dscalar])
-
-    ## multiply the cluster labels by the extrema to get the labeled exteama
-    lab_extrema_dscalar = os.path.join(tmpdir,'lab_extrema.dscalar.nii')
-    run(['wb_command', '-cifti-math "(abs(x*y))"',
-        lab_extrema_dscalar,
-        '-var','x',clusters_dscalar, '-var','y',extrema_dscalar])
+    ## find the positive and negative clusters with the same settings
+    cluster_labels = cifti_graph.find_signed_clusters(input_data,
+                    float(settings.min_threshold), float(settings.max_threshold),
+                    min_area = float(settings.area_threshold),
+                    min_volume = float(settings.area_threshold))
+
+    ## label the extrema with the cluster they are in
+    lab_extrema = np.abs(cluster_labels * extrema)
 
     ## run left and right dfs... then concatenate them
-    dfL = build_hemi_results_df(surf_settings['L'], atlas_settings,
-                              data_file, lab_extrema_dscalar, clusters_dscalar)
-    dfR = build_hemi_results_df(surf_settings['R'], atlas_settings,
-                              data_file, lab_extrema_dscalar, clusters_dscalar)
-    df = dfL.append(dfR, ignore_index = True)
+    dfs = []
+    for hemi in ['L', 'R']:
+        n_vertices = cifti_graph.n_vertices[hemi]
+        dfs.append(build_hemi_results_df(settings.surf_settings[hemi], atlas_settings,
+                    cifti_graph.surface_data(input_data, hemi, n_vertices),
+                    cifti_graph.surface_data(lab_extrema, hemi, n_vertices),
+                    cifti_graph.surface_data(cluster_labels, hemi, n_vertices)))
+    df = dfs[0].append(dfs[1], ignore_index = True)
 
     ## write the table out to the outputcsv
-    output_columns = ['clusterID','hemisphere','vertex', 'peak_value', 'area']
-    decimals_out = {"clusterID":0, 'peak_value':3, 'area':0}
+    output_columns = ['clusterID','hemisphere','vertex', 'x', 'y', 'z', 'peak_value', 'area']
+    decimals_out = {"clusterID":0, 'x':1, 'y':1, 'z':1, 'peak_value':3, 'area':0}
     for atlas in atlas_settings.keys():
         atlas_name = atlas_settings[atlas]['name']
         output_columns.append(atlas_name)
         output_columns.append('{}_overlap'.format(atlas_name))
+        output_columns.append('{}_nearest'.format(atlas_name))
+        output_columns.append('{}_nearest_mm'.format(atlas_name))
         decimals_out['{}_overlap'.format(atlas_name)] = 3
+        decimals_out['{}_nearest_mm'.format(atlas_name)] = 1
 
     df = df.round(decimals_out)
     df.to_csv(outputcsv_cortex,
           columns = output_columns,index=False)
 
-    if not dont_output_clusters:
+    if not settings.dont_output_clusters:
         cluster_dlabel = '{}_clust.dlabel.nii'.format(outputbase)
-        empty_labels = os.path.join(tmpdir, 'empty_labels.txt')
-        run('touch {}'.format(empty_labels))
-        run(['wb_command', '-cifti-label-import',
-            clusters_dscalar, empty_labels, cluster_dlabel])
-
-    ## run FSL's cluster on the subcortical bits
-    ## now to run FSL's cluster on the subcortical bits
-    cinfo = ciftify.niio.cifti_info(data_file)
-    if cinfo['maps_to_volume']:
-        subcortical_vol = os.path.join(tmpdir, 'subcortical.nii.gz')
-        run(['wb_command', '-cifti-separate', data_file, 'COLUMN', '-volume-all', subcortical_vol])
-        fslcluster_cmd = ['cluster',
-            '--in={}'.format(subcortical_vol),
-            '--thresh={}'.format(max_threshold),
-            '--peakdist={}'.format(volume_distance)]
-        peak_table = ciftify.utils.get_stdout(fslcluster_cmd)
-        with open(outputcsv_sub, "w") as text_file:
-            text_file.write(peak_table.replace('/t',','))
+        ciftify.niio.write_cifti2_dlabel(cluster_dlabel, cluster_labels,
+                                         cifti_graph.brain_models)
+
+    ## the subcortical clusters and peaks
+    if cifti_graph.brain_models.volume_mask.any():
+        df_sub = ciftify.clusters.volume_peak_table(input_data, cifti_graph.brain_models,
+                                                    settings.min_threshold, settings.max_threshold,
+                                                    settings.volume_distance,
+                                                    float(settings.area_threshold),
+                                                    cluster_labels = cluster_labels)
+        df_sub = df_sub.round({'x': 1, 'y': 1, 'z': 1, 'peak_value': 3, 'cluster_volume': 0})
+        df_sub.to_csv(outputcsv_sub, index = False)
     else:
-        logger.info('No subcortical volume data in {}'.format(data_file))
-
-    logger.info(ciftify.utils.section_header('Done ciftify_peaktable'))
+        logger.info('No subcortical volume data in {}'.format(settings.data_file))
 
+    return [({}, df[output_columns])]
 
-def load_hemisphere_labels(filename, wb_structure, map_number = 1):
-    '''separates dlabel file into left and right and loads label data'''
-
-    with ciftify.utils.TempDir() as little_tempdir:
-        ## separate the cifti file into left and right surfaces
-        labels_gii = os.path.join(little_tempdir, 'data.label.gii')
-        run(['wb_command','-cifti-separate', filename, 'COLUMN',
-            '-label', wb_structure, labels_gii])
-
-        # loads label table as dict and data as numpy array
-        gifti_img = nibabel.gifti.giftiio.read(labels_gii)
-        atlas_data = gifti_img.getArraysFromIntent('NIFTI_INTENT_LABEL')[map_number - 1].data
-
-        atlas_dict = gifti_img.get_labeltable().get_labels_as_dict()
-        atlas_df = pd.DataFrame.from_dict(atlas_dict, orient = "index")
-
-    return atlas_data, atlas_df
-
-
-def wb_cifti_clusters(input_cifti, output_cifti, surf_settings,
-                      value_threshold, minimun_size,less_than, starting_label=1):
-    '''runs wb_command -cifti-find-clusters'''
-    wb_arglist = ['wb_command', '-cifti-find-clusters',
-            input_cifti,
-            str(value_threshold), str(minimun_size),
-            str(value_threshold), str(minimun_size),
-            'COLUMN',
-            output_cifti,
-            '-left-surface', surf_settings['L']['surface'],
-            '-corrected-areas', surf_settings['L']['vertex_areas'],
-            '-right-surface', surf_settings['R']['surface'],
-            '-corrected-areas', surf_settings['R']['vertex_areas'],
-            '-start', str(starting_label)]
-    if less_than : wb_arglist.append('-less-than')
-    cinfo = ciftify.niio.cifti_info(input_cifti)
-    if cinfo['maps_to_volume']: wb_arglist.append('-merged-volume')
-    run(wb_arglist)
+def build_cifti_graph(brain_models, surf_settings):
+    '''the neighbours of every grayordinate of the input, for finding clusters and peaks'''
+    return ciftify.clusters.CiftiGraph(brain_models,
+        surfaces = {hemi: surf_settings[hemi]['surface'] for hemi in ['L', 'R']},
+        vertex_areas = {hemi: ciftify.report.load_vertex_areas(surf_settings[hemi]['vertex_areas'])
+                        for hemi in ['L', 'R']})
 
 def calc_cluster_areas(df, clust_labs, surf_va):
     '''
     calculates the surface area column of the peaks table
     needs hemisphere specific inputs
     '''
-    for cID in df.clusterID.unique():
-        idx = np.where(clust_labs == cID)[0]
-        area = sum(surf_va[idx])
-        df.loc[df.loc[:,'clusterID']==cID,'area'] = area
+    clust_areas = ciftify.report.calc_label_areas(clust_labs, surf_va)
+    df['area'] = clust_areas.reindex(df.clusterID.values, fill_value = 0).values
     return(df)
 
-def calc_atlas_overlap(df, wb_structure, clust_label_array, surf_va, atlas_settings):
+def calc_atlas_overlap(df, surf_settings, clust_label_array, surf_va, atlas_settings):
     '''
-    calculates the surface area column of the peaks table
+    calculates the atlas label at each peak, the proportion of its cluster
+    that overlaps with that label and the nearest label to the peak,
     needs hemisphere specific inputs
     '''
 
     ## load atlas
-    atlas_label_array, atlas_df = load_hemisphere_labels(atlas_settings['path'],
-                                                       wb_structure,
-                                                       map_number = atlas_settings['map_number'])
+    atlas_label_array, atlas_dict = ciftify.report.load_atlas_labels(atlas_settings,
+                                                    surf_settings['wb_structure'])
     atlas_prefix = atlas_settings['name']
 
-    ## create new cols to hold the data
-    df[atlas_prefix] = pd.Series('not_calculated', index = df.index)
-    overlap_col = '{}_overlap'.format(atlas_prefix)
-    df[overlap_col] = pd.Series(-99.0, index = df.index)
-
-    for pd_idx in df.index.tolist():
-        ## atlas interger label is the integer at the vertex
-        atlas_label = atlas_label_array[df.loc[pd_idx, 'vertex']]
+    ## atlas interger label is the integer at the vertex
+    peak_labels = atlas_label_array[df['vertex'].values]
 
-        ## the atlas column holds the labelname for this label
-        df.loc[pd_idx, atlas_prefix] = atlas_df.iloc[atlas_label, 0]
+    ## the atlas column holds the labelname for this label
+    df[atlas_prefix] = [atlas_dict[label] for label in peak_labels]
 
-        ## overlap indices are the intersection of the cluster and the atlas integer masks
-        clust_mask = np.where(clust_label_array == df.loc[pd_idx, 'clusterID'])[0]
-        atlas_mask = np.where(atlas_label_array == atlas_label)[0]
-        overlap_mask = np.intersect1d(clust_mask,atlas_mask)
+    ## overlap area is the area of the overlaping region over the total cluster area
+    df['{}_overlap'.format(atlas_prefix)] = ciftify.report.calc_peak_overlaps(
+        df['clusterID'].values, peak_labels, clust_label_array, atlas_label_array, surf_va)
 
-        ## overlap area is the area of the overlaping region over the total cluster area
-        clust_area = df.loc[pd_idx, 'area']
-        overlap_area = sum(surf_va[overlap_mask])
-        df.loc[pd_idx, overlap_col] = overlap_area/clust_area
+    ## the nearest labelled vertex, for peaks that are not in a label
+    df = ciftify.report.calc_nearest_labels(df, surf_settings['surface'],
+            surf_settings['wb_structure'], atlas_prefix, atlas_label_array, atlas_dict)
 
     return(df)
 
 
 def build_hemi_results_df(surf_settings, atlas_settings,
-                          input_dscalar, extreama_dscalar, clusters_dscalar):
-
-    ## read in the extrema file from above
-    extrema_array = load_hemisphere_data(extreama_dscalar, surf_settings['wb_structure'])
-    vertices = np.nonzero(extrema_array)[0]  # indices - vertex id for peaks in hemisphere
+                          input_data_array, extrema_array, clust_array):
 
-    ## read in the original data for the value column
-    input_data_array = load_hemisphere_data(input_dscalar, surf_settings['wb_structure'])
-
-    ## load both cluster indices
-    clust_array = load_hemisphere_data(clusters_dscalar, surf_settings['wb_structure'])
+    ## the labelled extrema - vertex id for peaks in hemisphere
+    vertices = np.nonzero(extrema_array)[0]
 
     ## load the coordinates
     coords =  nibabel.gifti.giftiio.read(surf_settings['surface']).getArraysFromIntent('NIFTI_INTENT_POINTSET')[0].data
-    surf_va = ciftify.niio.load_gii_data(surf_settings['vertex_areas'])
+    surf_va = ciftify.report.load_vertex_areas(surf_settings['vertex_areas'])
 
     ## put all this info together into one pandas dataframe
     df = pd.DataFrame({"clusterID": np.reshape(extrema_array[vertices],(len(vertices),)),
@@ -331,12 +334,15 @@ def build_hemi_results_df(surf_settings, atlas_settings,
                     'peak_value': [round(x,3) for x in np.reshape(input_data_array[vertices],(len(vertices),))],
                     'area': -99.0})
 
+    ## the coordinates of the peaks
+    df['x'], df['y'], df['z'] = coords[vertices, 0], coords[vertices, 1], coords[vertices, 2]
+
     ## calculate the area of the clusters
     df = calc_cluster_areas(df, clust_array, surf_va)
 
     ## look at atlas overlap
     for atlas in atlas_settings.keys():
-        df = calc_atlas_overlap(df, surf_settings['wb_structure'], clust_array, surf_va, atlas_settings[atlas])
+        df = calc_atlas_overlap(df, surf_settings, clust_array, surf_va, atlas_settings[atlas])
 
     return(df)
 
@@ -15,6 +15,8 @@ Options:
   --surfR SURFACE            The right surface to to measure distances on (see details)
   --no-distance-calc         Will not calculate the distance from the template vertex
   --pvertex-col COLNAME      The column [default: pvertex] to read the personlized vertices
+  --n_cpus INT               Number of summary files to read at once (defaults to the
+                             value of the OMP_NUM_THREADS environment variable)
   --debug                    Debug logging in Erin's very verbose style
   -n,--dry-run               Dry run
   --help                     Print help
@@ -26,13 +28,19 @@ HCP S1200 Average mid-surface.
 In old versions of PINT (2017 and earlier) the pvertex colname was "ivertex".
 Use the option '--pvertex-col ivertex' to process these files.
 
+If the <concatenated-pint> output ends in ".parquet" the result is written
+as a parquet file (requires pyarrow) instead of a csv.
+
 Written by Erin W Dickie, April 28, 2017
 """
 import os
 import sys
+import itertools
+import concurrent.futures
 import logging
 import logging.config
 
+import numpy as np
 import pandas as pd
 from docopt import docopt
 
@@ -54,6 +62,7 @@ def main():
     surfR = arguments['--surfR']
     NO_TVERTEX_MM = arguments['--no-distance-calc']
     pvertex_colname = arguments['--pvertex-col']
+    n_cpus = int(ciftify.utils.get_number_cpus(arguments['--n_cpus']))
     DEBUG = arguments['--debug']
     DRYRUN = arguments['--dry-run']
 
@@ -68,17 +77,15 @@ def main():
                 ciftify.utils.section_header("Starting ciftify_postPINT1_concat")))
     ciftify.utils.log_arguments(arguments)
 
-    ## read all the dfs into a tupley thing
-    all_dfs = (read_process_PINT_summary(f, pvertex_colname) for f in summary_csvs)
-    ## concatenate all the summarycvs
-    concatenated_df = pd.concat(all_dfs, ignore_index=True)
+    if allvertices_csv.endswith('.parquet'):
+        check_parquet_support()
+
+    ## read all the summary csvs (n_cpus at a time) into one dataframe
+    concatenated_df = read_PINT_summaries(summary_csvs, pvertex_colname, n_cpus)
     concat_df_columns = ['subid', 'hemi','NETWORK', 'roiidx','tvertex',pvertex_colname,
                             'dist_49','vertex_48']
 
-    if NO_TVERTEX_MM:
-        ## if done, write to file
-        concatenated_df.to_csv(allvertices_csv, index = False, columns = concat_df_columns)
-    else:
+    if not NO_TVERTEX_MM:
         ## define the surface fo measuring..
         distance_col = 'std_distance'
         if not surfL:
@@ -87,23 +94,13 @@ def main():
             surfR = os.path.join(ciftify.config.find_HCP_S1200_GroupAvg(),
                 'S1200.R.midthickness_MSMAll.32k_fs_LR.surf.gii')
 
-        ## for each roi, calculated the distance from the tvertex to the ivertex
-        concatenated_df[distance_col] = -99.0
-        for roi in concatenated_df.roiidx.unique():
-            hemi = concatenated_df.hemi[concatenated_df.roiidx==roi].unique()[0]
-            orig_vertex = concatenated_df.tvertex[concatenated_df.roiidx==roi].unique()[0]
-            if hemi == "L": surf = surfL
-            if hemi == "R": surf = surfR
-            roi_distances =  ciftify.niio.get_surf_distances(surf, orig_vertex)
-            roi_idx = concatenated_df.loc[concatenated_df.roiidx==roi].index
-            concatenated_df.loc[roi_idx,distance_col] = roi_distances[concatenated_df.loc[roi_idx,pvertex_colname].values]
-
-        ## replace any values where ivertex == tvertex with a 0 (tends to be -1)
-        concatenated_df.loc[concatenated_df.loc[:, pvertex_colname] == concatenated_df.tvertex,distance_col] = 0
-
-        ## write to file
+        ## calculate the distance from the tvertex to the pvertex for every row
+        concatenated_df[distance_col] = calc_tvertex_distances(concatenated_df,
+                                            pvertex_colname, surfL, surfR)
         concat_df_columns.append(distance_col)
-        concatenated_df.to_csv(allvertices_csv, index = False, columns = concat_df_columns)
+
+    ## write to file
+    write_concatenated_pint(concatenated_df, allvertices_csv, concat_df_columns)
 
     logger.info(ciftify.utils.section_header('Done ciftify_postPINT1_concat'))
 
@@ -112,7 +109,8 @@ def read_process_PINT_summary(inputcsv, pvertex_colname):
     reads in one PINT summary csv and does a little cleaning of the result..
     add an extra column that is only the PINT output prefix
     '''
-    thisdf = pd.read_csv(inputcsv)
+    vertex_dtypes = {'roiidx': np.int64, 'tvertex': np.int64, pvertex_colname: np.int64}
+    thisdf = pd.read_csv(inputcsv, dtype = vertex_dtypes)
     this_subid = os.path.basename(inputcsv)
     this_subid = this_subid.replace('_summary.csv','')
     thisdf['subid'] = this_subid
@@ -122,6 +120,60 @@ def read_process_PINT_summary(inputcsv, pvertex_colname):
     output_df = thisdf.loc[:,('subid', 'hemi','NETWORK', 'roiidx','tvertex',pvertex_colname,'dist_49','vertex_48')]
     return(output_df)
 
+def read_PINT_summaries(summary_csvs, pvertex_colname, n_cpus = 1):
+    '''
+    reads all the PINT summary csvs, n_cpus files at a time,
+    and concatenates them into one dataframe
+    '''
+    with concurrent.futures.ThreadPoolExecutor(max_workers = n_cpus) as executor:
+        all_dfs = executor.map(read_process_PINT_summary, summary_csvs,
+                               itertools.repeat(pvertex_colname))
+        concatenated_df = pd.concat(all_dfs, ignore_index=True)
+    ## the repeated string columns are stored as categories
+    for colname in ['subid', 'hemi']:
+        concatenated_df[colname] = concatenated_df[colname].astype('category')
+    return(concatenated_df)
+
+def calc_tvertex_distances(concatenated_df, pvertex_colname, surfL, surfR,
+                           radius_search = 100):
+    '''
+    calculates the distance from the tvertex to the pvertex for every row
+
+    The distances from each template vertex are measured once (per hemisphere)
+    and then looked up for all subjects.
+    Distances greater than radius_search are set to -1 (as per wb_command)
+    '''
+    distances = np.full(len(concatenated_df), -99.0)
+    for hemi, surf in (('L', surfL), ('R', surfR)):
+        hemi_rows = np.where(concatenated_df.hemi == hemi)[0]
+        if len(hemi_rows) == 0:
+            continue
+        tvertices, tvertex_idx = np.unique(concatenated_df.tvertex.values[hemi_rows],
+                                           return_inverse = True)
+        surf_graph = ciftify.surface.SurfaceGraph(surf)
+        tvertex_distances = surf_graph.distances(tvertices, limit = radius_search)
+        pvertices = concatenated_df[pvertex_colname].values[hemi_rows]
+        hemi_distances = tvertex_distances[tvertex_idx, pvertices]
+        hemi_distances[np.isinf(hemi_distances)] = -1
+        distances[hemi_rows] = hemi_distances
+    return(distances)
+
+def check_parquet_support():
+    '''exits if pyarrow (needed for writing parquet files) is not installed'''
+    try:
+        import pyarrow
+    except ImportError:
+        logger.critical("Writing parquet output requires the pyarrow package. "
+            "Install pyarrow or write the output to a csv.")
+        sys.exit(1)
+
+def write_concatenated_pint(concatenated_df, output_path, columns):
+    '''write the result to a parquet file if that extension is given, otherwise csv'''
+    if output_path.endswith('.parquet'):
+        concatenated_df.loc[:, columns].to_parquet(output_path, index = False)
+    else:
+        concatenated_df.to_csv(output_path, index = False, columns = columns)
+
 
 
 if __name__ == '__main__':
@@ -35,6 +35,8 @@ Options:
   --hcp-data-dir PATH         DEPRECATED, use --ciftify-work-dir instead
   --n_cpus INT                Number of cpu's available. Defaults to the value
                               of the OMP_NUM_THREADS environment variable
+  --python-resampling         Resample the metric files with ciftify's (cached)
+                              resampling weights instead of wb_command (see DETAILS)
   -v,--verbose                Verbose logging
   --debug                     Debug logging in Erin's very verbose style
   -n,--dry-run                Dry run
@@ -72,6 +74,11 @@ flatmaps will be symbolic links from a folder ($CIFTIFY_WORKDIR/zz_templates) to
 subject's output folder. If the '--no-symlinks' flag is indicated, these files will be
 copied into the subject folder insteadself.
 
+The metric files (i.e. sulc, curvature, thickness) are resampled to the other meshes
+with wb_command -metric-resample ADAP_BARY_AREA by default. With '--python-resampling'
+this is done in python instead, with resampling weights that are built once and saved
+in a resample_weights folder of the source mesh, for all of the metric files.
+
 Written by Erin W Dickie
 """
 import os
@@ -96,6 +103,7 @@ logger.setLevel(logging.DEBUG)
 DRYRUN = False
 N_CPUS = 1
 FS_LICENSE = None
+PYTHON_RESAMPLING = False
 
 def run_ciftify_recon_all(temp_dir, settings):
     subject = settings.subject
@@ -261,6 +269,7 @@ class Settings(WorkFlowSettings):
         self.reg_name = self.__set_registration_mode(arguments)
         self.resample = arguments['--resample-to-T1w32k']
         self.no_symlinks = arguments['--no-symlinks']
+        self.python_resampling = arguments['--python-resampling']
         self.fs_root_dir = self.__set_fs_subjects_dir(arguments)
         self.subject = self.__get_subject(arguments)
         self.ciftify_data_dir = ciftify.config.find_ciftify_global()
@@ -1439,7 +1448,9 @@ def resample_and_mask_metric(subject_id, dscalar, hemisphere, source_mesh,
         dest_mesh, current_sphere='sphere', dest_sphere='sphere'):
     '''
     Resample the metric files to a different mesh and then mask out the medial
-    wall. Uses wb_command -metric-resample with 'ADAP_BARY_AREA' method.
+    wall. Uses wb_command -metric-resample with 'ADAP_BARY_AREA' method (or the
+    same method with the resampling weights saved in the source mesh folder,
+    if PYTHON_RESAMPLING).
     To remove masking steps the roi can be set to None
 
     Arguments:
@@ -1462,19 +1473,35 @@ def resample_and_mask_metric(subject_id, dscalar, hemisphere, source_mesh,
     dest_sphere_surf = surf_file(subject_id, dest_sphere, hemisphere,
             dest_mesh)
 
+    if not PYTHON_RESAMPLING:
+        if dscalar['mask_medialwall']:
+            run(['wb_command', '-metric-resample', metric_in, current_sphere_surf,
+                dest_sphere_surf, 'ADAP_BARY_AREA', metric_out,
+                '-area-surfs', current_midthickness, new_midthickness,
+                '-current-roi', medial_wall_roi_file(subject_id, hemisphere,
+                source_mesh)])
+            run(['wb_command', '-metric-mask', metric_out,
+                medial_wall_roi_file(subject_id, hemisphere, dest_mesh), metric_out],
+                dryrun=DRYRUN)
+        else:
+            run(['wb_command', '-metric-resample', metric_in, current_sphere_surf,
+                dest_sphere_surf, 'ADAP_BARY_AREA', metric_out,
+                '-area-surfs', current_midthickness, new_midthickness])
+        return
+    if DRYRUN:
+        return
+    current_roi = None
     if dscalar['mask_medialwall']:
-        run(['wb_command', '-metric-resample', metric_in, current_sphere_surf,
-            dest_sphere_surf, 'ADAP_BARY_AREA', metric_out,
-            '-area-surfs', current_midthickness, new_midthickness,
-            '-current-roi', medial_wall_roi_file(subject_id, hemisphere,
-            source_mesh)])
-        run(['wb_command', '-metric-mask', metric_out,
-            medial_wall_roi_file(subject_id, hemisphere, dest_mesh), metric_out],
-            dryrun=DRYRUN)
-    else:
-        run(['wb_command', '-metric-resample', metric_in, current_sphere_surf,
-            dest_sphere_surf, 'ADAP_BARY_AREA', metric_out,
-            '-area-surfs', current_midthickness, new_midthickness])
+        current_roi = medial_wall_roi_file(subject_id, hemisphere, source_mesh)
+    ## the weights are built once and reused for all of the maps
+    weights = ciftify.resample.resampling_weights(current_sphere_surf,
+            dest_sphere_surf, current_midthickness, new_midthickness,
+            current_roi = current_roi, cache_dir = resample_weights_dir(source_mesh))
+    new_roi = None
+    if dscalar['mask_medialwall']:
+        new_roi = medial_wall_roi_file(subject_id, hemisphere, dest_mesh)
+    ciftify.resample.resample_gii_file(metric_in, metric_out, weights,
+            new_roi = new_roi, n_cpus = N_CPUS)
 
 def resample_label(subject_id, label_name, hemisphere, source_mesh, dest_mesh,
         current_sphere='sphere', dest_sphere='sphere'):
@@ -1534,6 +1561,7 @@ def main():
 
     global N_CPUS
     global FS_LICENSE
+    global PYTHON_RESAMPLING
 
     ch = logging.StreamHandler()
     ch.setLevel(logging.WARNING)
@@ -1558,6 +1586,7 @@ def main():
 
     N_CPUS = settings.n_cpus
     FS_LICENSE = settings.fs_license
+    PYTHON_RESAMPLING = settings.python_resampling
 
     logger.info(ciftify.utils.ciftify_logo())
     logger.info(section_header("Starting cifti_recon_all"))
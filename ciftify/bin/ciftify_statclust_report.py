@@ -12,12 +12,24 @@ Options:
     --min-threshold MIN    the largest value [default: -2.85] to consider for being a minimum
     --max-threshold MAX    the smallest value [default: 2.85] to consider for being a maximum
     --area-threshold MIN   threshold [default: 20] for surface cluster area, in mm^2
+    --thresholds LIST      Comma separated list of thresholds to report on
+                           (each used as both the max and the negated min threshold)
     --surface-distance MM  minimum distance in mm [default: 20] between extrema of the same type.
     --volume-distance MM   minimum distance in mm [default: 20] between extrema of the same type.
 
     --outputbase prefix    Output prefix (with path) to output documents
     --no-cluster-dlabel    Do not output a dlabel map of the clusters
     --output-peaks         Also output an additional output of peak locations
+    --maps LIST            Comma separated list of the maps (by number, starting at 1,
+                           or by name) to report on. Defaults to all maps
+    --n_cpus INT           Number of maps to report on at once. Defaults to the value
+                           of the OMP_NUM_THREADS environment variable
+
+    --tfce                 Also output a threshold-free cluster enhanced (TFCE) map
+    --tfce-H H             TFCE height exponent [default: 2]
+    --tfce-E-surface E     TFCE extent exponent for surface clusters [default: 1]
+    --tfce-E-volume E      TFCE extent exponent for volume clusters [default: 0.5]
+    --tfce-dh DH           TFCE step between thresholds [default: 0.1]
 
     --left-surface GII     Left surface file (default is HCP S1200 Group Average)
     --right-surface GII    Right surface file (default is HCP S1200 Group Average)
@@ -29,9 +41,7 @@ Options:
     -h, --help             Prints this message
 
 DETAILS
-Note: at the moment generates separate outputs for surface.
-Uses -cifti-separate in combination with FSL's clusterize to get information from
-the subcortical space.
+Note: at the moment generates separate outputs for surface and subcortical peaks.
 
 Outputs a cluster report csv with the following headings:
   + clusterID: Integer for the cluster this peak is from (corresponds to dlabel.nii)
@@ -60,6 +70,23 @@ with several headings:
   + Yeo7_overlap: The proportion of the cluster (clusterID) that overlaps with this Yeo7 network label
   + MMP: The label from the Glasser et al (2016) Multi-Modal Parcellation
   + MMP_overlap: The proportion of the cluster (clusterID) that overlaps with the MMP atlas label
+  + <atlas>_nearest: The nearest labelled vertex of each atlas to the peak (the label
+     at the peak, unless the peak is not inside any label i.e. in the medial wall)
+  + <atlas>_nearest_mm: The distance (in mm) from the peak to that labelled vertex
+The x,y,z coordinates are those of the surface given (for the default HCP S1200
+midthickness surfaces these are MNI coordinates).
+
+Subcortical peaks are written to a second csv (ending in '_subcortical_peaks.csv')
+with one row per peak:
+  + clusterID: Integer for the cluster this peak is from (corresponds to dlabel.nii)
+  + structure: The subcortical structure the peak is in (i.e. THALAMUS_LEFT)
+  + i,j,k: The voxel indices of the peak
+  + x,y,z: The coordinates of the peak
+  + peak_value: The intensity (value) at that voxel in the func.dscalar.nii
+  + cluster_volume: The volume of the cluster (in mm^3)
+Subcortical clusters are face connected voxels (across structures) and
+their peaks are the largest (or smallest) value of their cluster within the
+--volume-distance. Every cluster has at least one peak.
 
 If no surfaces of surface area files are given. The midthickness surfaces from
 the HCP S1200 Group Mean will be used, as well as it's vertex-wise
@@ -73,6 +100,25 @@ be written to the same folder as the outputcsv to aid in visualication of the re
 This dlable map with have a name ending in '_clust.dlabel.nii'.
 (i.e. func_peaks.csv & func_clust.dlabel.nii)
 
+Every map of the input is reported on (or the '--maps' given). With more than one
+map '_map<number>' is added to the output prefix of each map's outputs
+(i.e. func_map2_statclust_report.csv) and the cluster reports of all maps are
+also written to one long table ending in '_statclust_report_long.csv', with
+map_number, map_name, min_threshold and max_threshold columns. The maps are
+reported on in parallel by up to '--n_cpus' processes.
+
+If a list of '--thresholds' is given (i.e. --thresholds 2.3,3.1) the report
+(and the cluster dlabel and peak tables) is written for each threshold, with
+'_thr<threshold>' added to the output prefix (i.e. func_thr2.3_statclust_report.csv).
+The clusters at every threshold are found in one pass over the map, so this is
+faster than running the report for each threshold.
+
+If the '--tfce' flag is given, the threshold-free cluster enhancement
+(Smith & Nichols, 2009) of the input map is written to a file ending in
+'_tfce.dscalar.nii'. Clusters are found at every threshold (in steps of
+--tfce-dh) along the surface mesh (using the vertex areas) and across face
+adjacent voxels. Negative values are enhanced separately and given negative scores.
+
 Atlas References:
 Yeo, BT. et al. 2011. 'The Organization of the Human Cerebral Cortex
 Estimated by Intrinsic Functional Connectivity.' Journal of Neurophysiology
@@ -95,6 +141,7 @@ import logging
 import logging.config
 import ciftify.niio
 import ciftify.report
+import ciftify.clusters
 import ciftify.utils
 from ciftify.meants import NibInput
 
@@ -102,24 +149,13 @@ config_path = os.path.join(os.path.dirname(ciftify.config.find_ciftify_global())
 logging.config.fileConfig(config_path, disable_existing_loggers=False)
 logger = logging.getLogger(os.path.basename(__file__))
 
-def load_LR_vertex_areas(surf_settings):
-    ''' loads the vertex areas and stacks the dataframes'''
-    surf_va_L = ciftify.niio.load_gii_data(surf_settings.L.vertex_areas)
-    surf_va_R = ciftify.niio.load_gii_data(surf_settings.R.vertex_areas)
-    surf_va_LR = np.vstack((surf_va_L, surf_va_R))
-    return(surf_va_LR)
-
-
-def report_atlas_overlap(df, label_data, atlas, surf_va_LR, min_percent_overlap = 5):
-    # read the atlas
-    atlas_data, atlas_dict = ciftify.niio.load_LR_label(atlas['path'],
-                                                    int(atlas['map_number']))
+def report_atlas_overlap(df, label_data, atlas_name, atlas_labels, surf_va_LR,
+                         min_percent_overlap = 5):
+    atlas_data, atlas_dict = atlas_labels
     # write an overlap report to the outputfile
-    o_col = '{}_overlap'.format(atlas['name'])
-    df[o_col] = ""
-    for pd_idx in df.index.get_values():
-        df.loc[pd_idx, o_col] = ciftify.report.get_label_overlap_summary(
-                        pd_idx, label_data, atlas_data, atlas_dict, surf_va_LR,
+    o_col = '{}_overlap'.format(atlas_name)
+    df[o_col] = ciftify.report.get_label_overlap_summaries(
+                        df.index, label_data, atlas_data, atlas_dict, surf_va_LR,
                         min_percent_overlap = min_percent_overlap)
     return(df)
 
@@ -130,8 +166,6 @@ def run_ciftify_dlabel_report(arguments, tmpdir):
     surf_distance = arguments['--surface-distance']
 
     outputbase = arguments['--outputbase']
-    dont_output_clusters = arguments['--no-cluster-dlabel']
-    output_peaktable = arguments['--output-peaks']
 
     surf_settings = ciftify.report.CombinedSurfaceSettings(arguments, tmpdir)
     atlas_settings = ciftify.report.define_atlas_settings()
@@ -141,30 +175,126 @@ def run_ciftify_dlabel_report(arguments, tmpdir):
         outputbase = os.path.join(os.path.dirname(dscalar_in.path), dscalar_in.base)
         ciftify.utils.check_output_writable(outputbase, exit_on_error = True)
 
-    clusters_dscalar = clusterise_dscalar_input(dscalar_in.path,
-            arguments,
-            surf_settings,
-            tmpdir)
-
-    if dont_output_clusters:
-        cluster_dlabel = os.path.join(tmpdir, 'clust.dlabel.nii')
-    else:
+    ## load the input maps and pick the ones to report on
+    input_data, input_header = ciftify.niio.load_cifti2(dscalar_in.path)
+    map_names = list(input_header.get_axis(0).name)
+    maps = ciftify.report.define_maps(arguments['--maps'], map_names)
+
+    ## the surfaces, vertex areas and atlases are read once for all maps
+    cifti_graph = build_cifti_graph(input_header.get_axis(1), surf_settings)
+    if arguments['--output-peaks']:
+        for hemi in ['L', 'R']:
+            cifti_graph.surface_graph(hemi)
+    settings = MapReportSettings(arguments, dscalar_in.path, cifti_graph,
+        surf_settings, ciftify.report.load_LR_vertex_areas(surf_settings),
+        atlas_settings,
+        {atlas['name']: ciftify.report.load_LR_atlas_labels(atlas)
+         for atlas in atlas_settings.values()})
+
+    ## with more than one map, each map gets its own outputs
+    map_jobs = []
+    for map_idx in maps:
+        map_outputbase = outputbase if len(maps) == 1 else '{}_map{}'.format(outputbase, map_idx + 1)
+        map_jobs.append((input_data[:, map_idx], map_outputbase))
+
+    n_cpus = int(ciftify.utils.get_number_cpus(arguments['--n_cpus']))
+    all_reports = ciftify.report.run_map_jobs(report_map, map_jobs, settings, n_cpus)
+
+    if len(maps) > 1:
+        long_report = '{}_statclust_report_long.csv'.format(outputbase)
+        logger.info('Output table (all maps): {}'.format(long_report))
+        ciftify.report.write_long_table(long_report, maps, map_names, all_reports)
+
+class MapReportSettings:
+    '''the inputs shared by the reports of every map'''
+    def __init__(self, arguments, data_file, cifti_graph, surf_settings,
+                 surf_va_LR, atlas_settings, atlas_labels):
+        self.arguments = arguments
+        self.data_file = data_file
+        self.cifti_graph = cifti_graph
+        self.surf_settings = surf_settings
+        self.surf_va_LR = surf_va_LR
+        self.atlas_settings = atlas_settings
+        self.atlas_labels = atlas_labels
+
+def report_map(map_data, outputbase, settings):
+    '''
+    writes the reports (at every threshold) of one map
+    returns a list of ({min and max threshold}, cluster report) for each threshold
+    '''
+    arguments = settings.arguments
+    cifti_graph = settings.cifti_graph
+
+    ## the output prefix and (min, max) thresholds of every report
+    threshold_reports = define_threshold_reports(arguments, outputbase)
+
+    ## find the clusters in the input map, at every threshold
+    all_cluster_labels = clusterise_dscalar_input(map_data, arguments,
+                    [thresholds for _, thresholds in threshold_reports], cifti_graph)
+
+    if arguments['--tfce']:
+        write_tfce_dscalar('{}_tfce.dscalar.nii'.format(outputbase),
+                           map_data, arguments, cifti_graph)
+
+    ## the peaks at the lowest thresholds, the others are a subset of these
+    if arguments['--output-peaks']:
+        extrema = cifti_graph.find_extrema(map_data,
+                    arguments['--surface-distance'], arguments['--volume-distance'],
+                    max(min_t for _, (min_t, max_t) in threshold_reports),
+                    min(max_t for _, (min_t, max_t) in threshold_reports))
+
+    reports = []
+    for (report_base, (min_t, max_t)), cluster_labels in zip(threshold_reports,
+                                                             all_cluster_labels):
+        df = write_cluster_report(cluster_labels, report_base, cifti_graph,
+                                  settings.surf_va_LR, settings.atlas_labels,
+                                  arguments['--no-cluster-dlabel'])
+        reports.append(({'min_threshold': min_t, 'max_threshold': max_t}, df))
+        if arguments['--output-peaks']:
+            write_statclust_peaktable(settings.data_file, map_data, cluster_labels,
+                    ciftify.clusters.threshold_extrema(extrema, map_data, min_t, max_t),
+                    cifti_graph, report_base, arguments, min_t, max_t,
+                    settings.surf_settings, settings.atlas_settings, settings.atlas_labels)
+    return reports
+
+def define_threshold_reports(arguments, outputbase):
+    '''
+    the output prefix and the (min, max) thresholds for each report, from
+    --min-threshold and --max-threshold or from each value in --thresholds
+    '''
+    if not arguments['--thresholds']:
+        return [(outputbase, (float(arguments['--min-threshold']),
+                              float(arguments['--max-threshold'])))]
+    threshold_reports = []
+    for threshold in arguments['--thresholds'].split(','):
+        try:
+            value = abs(float(threshold))
+        except ValueError:
+            logger.error('Could not read threshold "{}" in --thresholds {}'.format(
+                threshold, arguments['--thresholds']))
+            sys.exit(1)
+        threshold_reports.append(('{}_thr{}'.format(outputbase, threshold.strip().lstrip('-')),
+                                  (-value, value)))
+    return threshold_reports
+
+def write_cluster_report(cluster_labels, outputbase, cifti_graph, surf_va_LR,
+                         atlas_labels, dont_output_clusters):
+    '''writes the cluster report csv (and the clusters dlabel) for one threshold'''
+    if not dont_output_clusters:
         cluster_dlabel = '{}_clust.dlabel.nii'.format(outputbase)
-    empty_labels = os.path.join(tmpdir, 'empty_labels.txt')
-    ciftify.utils.run('touch {}'.format(empty_labels))
-    ciftify.utils.run(['wb_command', '-cifti-label-import',
-        clusters_dscalar, empty_labels, cluster_dlabel])
+        ciftify.niio.write_cifti2_dlabel(cluster_dlabel, cluster_labels,
+                                         cifti_graph.brain_models)
 
-    ## load the data
-    label_data, label_dict = ciftify.niio.load_LR_label(cluster_dlabel, map_number = 1)
+    ## the surface labels, for every vertex of both hemispheres
+    label_data = np.hstack((
+        cifti_graph.surface_data(cluster_labels, 'L', cifti_graph.n_vertices['L']),
+        cifti_graph.surface_data(cluster_labels, 'R', cifti_graph.n_vertices['R'])))
+    label_dict = cluster_label_dict(cluster_labels)
 
     ## define the outputcsv
     outputcsv = '{}_statclust_report.csv'.format(outputbase)
     logger.info('Output table: {}'.format(outputcsv))
 
-    ## load the vertex areas
-    surf_va_LR = load_LR_vertex_areas(surf_settings)
-
     ## assert that the dimensions match
     if not (label_data.shape[0] == surf_va_LR.shape[0]):
         logger.error('label file vertices {} not equal to vertex areas {}'
@@ -178,20 +308,15 @@ def run_ciftify_dlabel_report(arguments, tmpdir):
 
 
     # calculate a column of the surface area for row ROIs
-    df['area'] = -999
-    for pd_idx in df.index.get_values():
-        df.loc[pd_idx, 'area']  = ciftify.report.calc_cluster_area(pd_idx,
-                                                        label_data, surf_va_LR)
+    label_areas = ciftify.report.calc_label_areas(label_data, surf_va_LR)
+    df['area'] = [label_areas.get(int(pd_idx), 0) for pd_idx in df.index]
 
-    for atlas in atlas_settings.values():
-        df = report_atlas_overlap(df, label_data, atlas,
+    for atlas_name, labels in atlas_labels.items():
+        df = report_atlas_overlap(df, label_data, atlas_name, labels,
                                   surf_va_LR, min_percent_overlap = 5)
 
     df.to_csv(outputcsv)
-
-    if output_peaktable:
-        write_statclust_peaktable(dscalar_in.path, clusters_dscalar, outputbase,
-                arguments, surf_settings, atlas_settings)
+    return(df)
 
 class ThresholdArgs:
     '''little class that holds the user aguments about thresholds'''
@@ -203,132 +328,114 @@ class ThresholdArgs:
         max_threshold = arguments['--max-threshold']
         area_threshold = arguments['--area-thratlas_settingseshold']
 
-def clusterise_dscalar_input(data_file, arguments, surf_settings, tmpdir):
-    '''runs wb_command -cifti-find-clusters twice
-    returns the path to the output
+def build_cifti_graph(brain_models, surf_settings):
+    '''the neighbours of every grayordinate of the input, for finding clusters'''
+    return ciftify.clusters.CiftiGraph(brain_models,
+        surfaces = {'L': surf_settings.L.surface, 'R': surf_settings.R.surface},
+        vertex_areas = {'L': ciftify.report.load_vertex_areas(surf_settings.L.vertex_areas),
+                        'R': ciftify.report.load_vertex_areas(surf_settings.R.vertex_areas)})
+
+def clusterise_dscalar_input(data, arguments, thresholds, cifti_graph):
+    '''
+    finds the positive and then negative clusters of the input map
+    (like wb_command -cifti-find-clusters with -merged-volume)
+    for every (min, max) threshold pair, from one component tree
+    returns a list of arrays of cluster labels for every grayordinate
     '''
-    ## also run clusterize with the same settings to get clusters
-    pcluster_dscalar = os.path.join(tmpdir,'pclusters.dscalar.nii')
-
-    wb_cifti_clusters(data_file, pcluster_dscalar, surf_settings,
-                      arguments['--max-threshold'],
-                      arguments['--area-threshold'],
-                      less_than = False, starting_label=1)
-
-    ## load both cluster files to determine the max value
-    pos_clust_data = ciftify.niio.load_concat_cifti_surfaces(pcluster_dscalar)
-    max_pos = int(np.max(pos_clust_data))
-
-    ## now get the negative clusters
-    ncluster_dscalar = os.path.join(tmpdir,'nclusters.dscalar.nii')
-    wb_cifti_clusters(data_file, ncluster_dscalar, surf_settings,
-                      arguments['--min-threshold'],
-                      arguments['--area-threshold'],
-                      less_than = True, starting_label=max_pos + 1)
-
-    ## add the positive and negative together to make one cluster map
-    clusters_out = os.path.join(tmpdir,'clusters.dscalar.nii')
-    ciftify.utils.run(['wb_command', '-cifti-math "(x+y)"',
-        clusters_out,
-        '-var','x',pcluster_dscalar, '-var','y',ncluster_dscalar])
-    return clusters_out
-
-def wb_cifti_clusters(input_cifti, output_cifti, surf_settings,
-                      value_threshold, minimun_size,less_than, starting_label=1):
-    '''runs wb_command -cifti-find-clusters'''
-    wb_arglist = ['wb_command', '-cifti-find-clusters',
-            input_cifti,
-            str(value_threshold), str(minimun_size),
-            str(value_threshold), str(minimun_size),
-            'COLUMN',
-            output_cifti,
-            '-left-surface', surf_settings.L.surface,
-            '-corrected-areas', surf_settings.L.vertex_areas,
-            '-right-surface', surf_settings.R.surface,
-            '-corrected-areas', surf_settings.R.vertex_areas,
-            '-start', str(starting_label)]
-    if less_than : wb_arglist.append('-less-than')
-    cinfo = ciftify.niio.cifti_info(input_cifti)
-    if cinfo['maps_to_volume']: wb_arglist.append('-merged-volume')
-    ciftify.utils.run(wb_arglist)
-
-def write_statclust_peaktable(data_file, clusters_dscalar, outputbase,
-        arguments, surf_settings, atlas_settings):
+    return cifti_graph.find_signed_clusters_at_thresholds(data, thresholds,
+                      min_area = float(arguments['--area-threshold']),
+                      min_volume = float(arguments['--area-threshold']))
+
+def write_tfce_dscalar(tfce_dscalar, data, arguments, cifti_graph):
+    '''writes the threshold-free cluster enhancement of the input map'''
+    logger.info('Writing TFCE map: {}'.format(tfce_dscalar))
+    tfce_scores = cifti_graph.tfce(data,
+                                   E_surface = float(arguments['--tfce-E-surface']),
+                                   E_volume = float(arguments['--tfce-E-volume']),
+                                   H = float(arguments['--tfce-H']),
+                                   dh = float(arguments['--tfce-dh']))
+    ciftify.niio.write_cifti2_dscalar(tfce_dscalar, tfce_scores,
+                                      cifti_graph.brain_models, ['tfce'])
+
+def cluster_label_dict(cluster_labels):
+    '''the label names of the clusters, as wb_command -cifti-label-import would name them'''
+    label_dict = {0: '???'}
+    for label in np.unique(cluster_labels[cluster_labels > 0]):
+        label_dict[int(label)] = 'LABEL_{}'.format(label)
+    return label_dict
+
+def write_statclust_peaktable(data_file, input_data, cluster_labels, extrema,
+        cifti_graph, outputbase, arguments, min_threshold, max_threshold,
+        surf_settings, atlas_settings, atlas_labels):
     '''runs the old peak table functionality
 
     Parameters
     ----------
     data_file : filepath
       path to the dscalar map input
-    clusters_dscalar : filepath
-      path to the cluster file created with same settings
+    input_data : array
+      the grayordinate values of the input map
+    cluster_labels : array
+      the cluster labels of every grayordinate, found with the same settings
+    extrema : array
+      the peaks (1) and troughs (-1) of the input map at these thresholds
+    cifti_graph : ciftify.clusters.CiftiGraph
+      the neighbours of every grayordinate of the input
     outputbase :
        the prefix for the outputfile
     arguments : dict
-      the user args dictionary to pull the thresholds from
+      the user args dictionary to pull the peak distances from
+    min_threshold, max_threshold : float
+      the thresholds of this report
     surf_settings : dict
       the dictionary of paths to the surface files,
       created by ciftify.report.CombinedSurfaceSettings
     altas_settings : dict
       dictionary of paths and settings related to the atlases to use for overlaps
       comparison. Created by ciftify.report.define_atlas_settings()
+    atlas_labels : dict
+      the (label data, label dict) of both hemispheres of each atlas, by atlas name
 
     Outputs
     -------
     writes a csv to <outputbase>_cortex_peaks.csv
+    and (if the input has voxels) <outputbase>_subcortical_peaks.csv
     '''
-    with ciftify.utils.TempDir() as ex_tmpdir:
-        ## run FSL's cluster on the subcortical bits
-        ## now to run FSL's cluster on the subcortical bits
-        cinfo = ciftify.niio.cifti_info(data_file)
-        if cinfo['maps_to_volume']:
-            subcortical_vol = os.path.join(ex_tmpdir, 'subcortical.nii.gz')
-            ciftify.utils.run(['wb_command', '-cifti-separate', data_file, 'COLUMN', '-volume-all', subcortical_vol])
-            fslcluster_cmd = ['cluster',
-                '--in={}'.format(subcortical_vol),
-                '--thresh={}'.format(arguments['--max-threshold']),
-                '--peakdist={}'.format(arguments['--volume-distance'])]
-            peak_table = ciftify.utils.get_stdout(fslcluster_cmd)
-            with open("{}_subcortical_peaks.csv".format(outputbase), "w") as text_file:
-                text_file.write(peak_table.replace('/t',','))
-        else:
-            logger.info('No subcortical volume data in {}'.format(data_file))
-
-        ## run wb_command -cifti-extrema to find the peak locations
-        extrema_dscalar = os.path.join(ex_tmpdir,'extrema.dscalar.nii')
-        ciftify.utils.run(['wb_command','-cifti-extrema',
-               data_file,
-               str(arguments['--surface-distance']),
-               str(arguments['--volume-distance']),
-               'COLUMN',
-               extrema_dscalar,
-               '-left-surface', surf_settings.L.surface,
-               '-right-surface', surf_settings.R.surface,
-               '-threshold',
-               str(arguments['--min-threshold']),
-               str(arguments['--max-threshold'])])
-
-        ## multiply the cluster labels by the extrema to get the labeled exteama
-        lab_extrema_dscalar = os.path.join(ex_tmpdir,'lab_extrema.dscalar.nii')
-        ciftify.utils.run(['wb_command', '-cifti-math "(abs(x*y))"',
-            lab_extrema_dscalar,
-            '-var','x',clusters_dscalar, '-var','y',extrema_dscalar])
-
-        ## run left and right dfs... then concatenate them
-        dfL = build_hemi_results_df(surf_settings.L, atlas_settings,
-                                  data_file, lab_extrema_dscalar, clusters_dscalar)
-        dfR = build_hemi_results_df(surf_settings.R, atlas_settings,
-                                  data_file, lab_extrema_dscalar, clusters_dscalar)
-    df = dfL.append(dfR, ignore_index = True)
+    ## the subcortical clusters and peaks
+    if cifti_graph.brain_models.volume_mask.any():
+        write_subcortical_peaktable("{}_subcortical_peaks.csv".format(outputbase),
+                input_data, cluster_labels, cifti_graph.brain_models,
+                min_threshold, max_threshold, arguments)
+    else:
+        logger.info('No subcortical volume data in {}'.format(data_file))
+
+    ## label the extrema with the cluster they are in
+    lab_extrema = np.abs(cluster_labels * extrema)
+
+    ## run left and right dfs... then concatenate them
+    dfs = []
+    for hemi_settings in [surf_settings.L, surf_settings.R]:
+        hemi, n_vertices = hemi_settings.hemi, cifti_graph.n_vertices[hemi_settings.hemi]
+        hemi_vertices = slice(0, n_vertices) if hemi == 'L' else slice(cifti_graph.n_vertices['L'], None)
+        hemi_atlas_labels = {name: (labels[0][hemi_vertices], labels[1])
+                             for name, labels in atlas_labels.items()}
+        dfs.append(build_hemi_results_df(hemi_settings, hemi_atlas_labels,
+                    cifti_graph.surface_data(input_data, hemi, n_vertices),
+                    cifti_graph.surface_data(lab_extrema, hemi, n_vertices),
+                    cifti_graph.surface_data(cluster_labels, hemi, n_vertices)))
+    df = dfs[0].append(dfs[1], ignore_index = True)
 
     ## write the table out to the outputcsv
-    output_columns = ['clusterID','hemisphere','vertex', 'peak_value', 'area']
-    decimals_out = {"clusterID":0, 'peak_value':3, 'area':0}
+    output_columns = ['clusterID','hemisphere','vertex', 'x', 'y', 'z', 'peak_value', 'area']
+    decimals_out = {"clusterID":0, 'x':1, 'y':1, 'z':1, 'peak_value':3, 'area':0}
     for atlas in atlas_settings.keys():
         atlas_name = atlas_settings[atlas]['name']
         output_columns.append(atlas_name)
         output_columns.append('{}_overlap'.format(atlas_name))
+        output_columns.append('{}_nearest'.format(atlas_name))
+        output_columns.append('{}_nearest_mm'.format(atlas_name))
         decimals_out['{}_overlap'.format(atlas_name)] = 3
+        decimals_out['{}_nearest_mm'.format(atlas_name)] = 1
 
     df = df.round(decimals_out)
     df.to_csv("{}_cortex_peaks.csv".format(outputbase),
@@ -336,22 +443,26 @@ def write_statclust_peaktable(data_file, clusters_dscalar, outputbase,
 
 
 
-def build_hemi_results_df(surf_settings, atlas_settings,
-                          input_dscalar, extreama_dscalar, clusters_dscalar):
-
-    ## read in the extrema file from above
-    extrema_array = ciftify.niio.load_hemisphere_data(extreama_dscalar, surf_settings.wb_structure)
-    vertices = np.nonzero(extrema_array)[0]  # indices - vertex id for peaks in hemisphere
+def write_subcortical_peaktable(outputcsv, input_data, cluster_labels, brain_models,
+                                min_threshold, max_threshold, arguments):
+    '''writes the peaks of the subcortical clusters (labelled as in the dlabel)'''
+    df = ciftify.clusters.volume_peak_table(input_data, brain_models,
+                                            min_threshold, max_threshold,
+                                            arguments['--volume-distance'],
+                                            float(arguments['--area-threshold']),
+                                            cluster_labels = cluster_labels)
+    df = df.round({'x': 1, 'y': 1, 'z': 1, 'peak_value': 3, 'cluster_volume': 0})
+    df.to_csv(outputcsv, index = False)
 
-    ## read in the original data for the value column
-    input_data_array = ciftify.niio.load_hemisphere_data(input_dscalar, surf_settings.wb_structure)
+def build_hemi_results_df(surf_settings, atlas_labels,
+                          input_data_array, extrema_array, clust_array):
 
-    ## load both cluster indices
-    clust_array = ciftify.niio.load_hemisphere_data(clusters_dscalar, surf_settings.wb_structure)
+    ## the labelled extrema - vertex id for peaks in hemisphere
+    vertices = np.nonzero(extrema_array)[0]
 
     ## load the coordinates
     coords = ciftify.niio.load_surf_coords(surf_settings.surface)
-    surf_va = ciftify.niio.load_gii_data(surf_settings.vertex_areas)
+    surf_va = ciftify.report.load_vertex_areas(surf_settings.vertex_areas)
 
     ## put all this info together into one pandas dataframe
     df = pd.DataFrame({"clusterID": np.reshape(extrema_array[vertices],(len(vertices),)),
@@ -359,49 +470,37 @@ def build_hemi_results_df(surf_settings, atlas_settings,
                     "vertex": vertices,
                     'peak_value': [round(x,3) for x in np.reshape(input_data_array[vertices],(len(vertices),))]})
 
+    ## the coordinates of the peaks
+    df['x'], df['y'], df['z'] = coords[vertices, 0], coords[vertices, 1], coords[vertices, 2]
+
+    ## the area of the cluster each peak is in
+    clust_areas = ciftify.report.calc_label_areas(clust_array, surf_va)
+    df['area'] = clust_areas.reindex(df.clusterID.values, fill_value = 0).values
+
     ## look at atlas overlap
-    for atlas in atlas_settings.keys():
-        df = calc_atlas_overlap(df, surf_settings.wb_structure, clust_array, surf_va, atlas_settings[atlas])
+    for atlas_name, (atlas_label_array, atlas_dict) in atlas_labels.items():
+        df = calc_atlas_overlap(df, clust_array, surf_va,
+                                atlas_name, atlas_label_array, atlas_dict)
+        df = ciftify.report.calc_nearest_labels(df, surf_settings.surface,
+                surf_settings.wb_structure, atlas_name, atlas_label_array, atlas_dict)
 
     return(df)
 
-def calc_atlas_overlap(df, wb_structure, clust_label_array, surf_va, atlas_settings):
+def calc_atlas_overlap(df, clust_label_array, surf_va,
+                       atlas_prefix, atlas_label_array, atlas_dict):
     '''
-    calculates the surface area column of the peaks table
-    needs hemisphere specific inputs
+    calculates the atlas label at each peak and the proportion of its cluster
+    that overlaps with that label, needs hemisphere specific inputs
     '''
+    ## atlas interger label is the integer at the vertex
+    peak_labels = atlas_label_array[df['vertex'].values]
 
-    ## load atlas
-    atlas_label_array, atlas_dict = ciftify.niio.load_hemisphere_labels(atlas_settings['path'],
-                                                       wb_structure,
-                                                       map_number = atlas_settings['map_number'])
-
-    atlas_prefix = atlas_settings['name']
-
-    ## create new cols to hold the data
-    df[atlas_prefix] = pd.Series('not_calculated', index = df.index)
-    overlap_col = '{}_overlap'.format(atlas_prefix)
-    df[overlap_col] = pd.Series(-99.0, index = df.index)
-
-    for pd_idx in df.index.tolist():
-        ## atlas interger label is the integer at the vertex
-        atlas_label = atlas_label_array[df.loc[pd_idx, 'vertex']]
-
-        ## the atlas column holds the labelname for this label
-        df.loc[pd_idx, atlas_prefix] = atlas_dict[atlas_label]
-
-        overlap_area = ciftify.report.calc_overlapping_area(
-            df.loc[pd_idx, 'clusterID'], clust_label_array,
-            atlas_label, atlas_label_array,
-            surf_va)
-
-        ## overlap area is the area of the overlaping region over the total cluster area
-        clust_area = ciftify.report.calc_cluster_area(
-            df.loc[pd_idx, 'clusterID'],
-            clust_label_array,
-            surf_va)
+    ## the atlas column holds the labelname for this label
+    df[atlas_prefix] = [atlas_dict[label] for label in peak_labels]
 
-        df.loc[pd_idx, overlap_col] = overlap_area/clust_area
+    ## overlap area is the area of the overlaping region over the total cluster area
+    df['{}_overlap'.format(atlas_prefix)] = ciftify.report.calc_peak_overlaps(
+        df['clusterID'].values, peak_labels, clust_label_array, atlas_label_array, surf_va)
 
     return(df)
 
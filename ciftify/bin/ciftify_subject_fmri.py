@@ -4,11 +4,13 @@ Projects a fMRI timeseries to and HCP dtseries file and does smoothing
 
 Usage:
   ciftify_subject_fmri [options] <func.nii.gz> <subject> <task_label>
+  ciftify_subject_fmri [options] --batch <runs.csv> <subject>
 
 Arguments:
     <func.nii.gz>           Nifty 4D volume to project to cifti space
     <subject>               The Subject ID in the HCP data folder
     <task_label>            The outputname for the cifti result folder
+    <runs.csv>              csv of the func.nii.gz and task_label of many runs (see DETAILS)
 
 Options:
   --SmoothingFWHM MM          The Full-Width-at-Half-Max for smoothing steps
@@ -32,6 +34,14 @@ Options:
   --hcp-data-dir PATH         DEPRECATED, use --ciftify-work-dir instead
   --n_cpus INT                Number of cpu's available. Defaults to the value
                               of the OMP_NUM_THREADS environment variable
+  --batch                     Process every run (row) of the <runs.csv> for the subject
+  --python-surface-mapping    Map the fMRI to the surface with ciftify's (cached)
+                              ribbon weights instead of wb_command (see DETAILS)
+  --python-resampling         Resample the surface data to the low-res meshes with
+                              ciftify's (cached) resampling weights instead of
+                              wb_command (see DETAILS)
+  --python-smoothing          Smooth the surface data with ciftify's (cached)
+                              smoothing kernels instead of wb_command (see DETAILS)
   -v,--verbose                Verbose logging
   --debug                     Debug logging in Erin's very verbose style
   -n,--dry-run                Dry run
@@ -57,6 +67,36 @@ to use the median. The default is to use the first volume.
 To skip the transform to MNI space, and resampling to 2x2x2mm (if this has been
 done already), use the '--already-in-MNI' option.
 
+With '--batch' all of the runs of a subject are processed in one call. The <runs.csv>
+(with a header) has one row per run, with the "func" (the 4D nifti) and "task_label"
+columns, all other options are used for every run. The files that are the same for
+every run (the cortical ribbon, the subcortical rois and template and, with
+'--python-surface-mapping' or '--python-resampling', the surface mapping or resampling
+weights) are only made once for every fMRI voxel geometry, and up to '--n_cpus' runs
+are processed at a time. Each run gets the same outputs (and log) in its results
+folder as it would from its own call. When a run fails, the other runs finish the
+current step and then the batch stops, listing the task_label of every failed run.
+
+The ribbon constrained volume to surface mapping is done with wb_command
+-volume-to-surface-mapping by default. With '--python-surface-mapping' it is done in
+python instead, with ribbon weights that are built once for the subject's surfaces and
+the fMRI voxel geometry and saved in the subject's MNINonLinear/Native/ribbon_weights
+folder, so that the next run (or map) with the same geometry only reads them.
+
+Likewise, the resampling to the low-res meshes is done with wb_command -metric-resample
+ADAP_BARY_AREA by default. With '--python-resampling' it is done in python, with
+resampling weights that are saved in the subject's MNINonLinear/Native/resample_weights
+folder.
+
+The surface smoothing is done with wb_command -metric-smoothing by default. With
+'--python-smoothing' it is done in python, with smoothing kernels that are saved in
+the smoothing_weights folder next to the subject's low-res midthickness surfaces.
+
+Example:
+  func, task_label
+  sub-01_task-rest_run-1_bold.nii.gz, rest_run-1
+  sub-01_task-rest_run-2_bold.nii.gz, rest_run-2
+
 Adapted from the fMRISurface module of the Human Connectome
 Project's minimal proprocessing pipeline. Please cite:
 
@@ -71,6 +111,7 @@ Written by Erin W Dickie, Jan 12, 2017
 import os
 import sys
 import datetime
+import hashlib
 import tempfile
 import shutil
 import subprocess
@@ -78,6 +119,8 @@ import logging
 import nibabel
 import nilearn.image
 import numpy as np
+import pandas as pd
+from concurrent import futures
 from docopt import docopt
 
 import ciftify
@@ -90,8 +133,21 @@ logger.setLevel(logging.DEBUG)
 DRYRUN = False
 N_CPUS = 1
 
-def run_ciftify_subject_fmri(settings, tmpdir):
+def run_ciftify_subject_fmri(settings, tmpdir, subject_files = None):
+    '''
+    runs all steps for one fMRI run, the subject level files (see SubjectFiles)
+    are made in the tmpdir unless they are given
+    '''
+    if subject_files is None:
+        subject_files = SubjectFiles(tmpdir)
+    atlas_fMRI_4D, atlas_fMRI_3D = transform_fmri(settings, tmpdir)
+    project_fmri(settings, tmpdir, atlas_fMRI_4D, atlas_fMRI_3D, subject_files)
 
+def transform_fmri(settings, tmpdir):
+    '''
+    the first steps of a run, getting the fMRI into MNI space
+    returns the MNI space fMRI (4D) and reference (3D) volumes
+    '''
     ## write a bunch of info about the environment to the logs
     log_build_environment()
 
@@ -108,9 +164,8 @@ def run_ciftify_subject_fmri(settings, tmpdir):
         meshes['AtlasSpaceNative']['Folder'],
         settings.surf_reg))
 
-    if not settings.diagnostics.path:
-        settings.diagnostics.path = tmpdir
-    else:
+    set_diagnostics_path(settings, tmpdir)
+    if settings.diagnostics.requested:
         logger.info('cifti files for surface mapping QA will'
             ' be written to {}:'.format(settings.diagnostics.path))
 
@@ -129,16 +184,24 @@ def run_ciftify_subject_fmri(settings, tmpdir):
           else:
               func2T1w_mat = calc_sform_differences(native_func_3D, settings, tmpdir)
       atlas_fMRI_4D, atlas_fMRI_3D = transform_to_MNI(func2T1w_mat, native_func_3D, settings)
+    return atlas_fMRI_4D, atlas_fMRI_3D
+
+def project_fmri(settings, tmpdir, atlas_fMRI_4D, atlas_fMRI_3D, subject_files):
+    '''
+    the rest of the steps of a run, from the MNI space fMRI to the dtseries files
+    '''
+    set_diagnostics_path(settings, tmpdir)
+    meshes = define_meshes(settings.subject.path, tmpdir,
+        low_res_meshes = settings.low_res)
 
     #Make fMRI Ribbon
     #Noisy Voxel Outlier Exclusion
     #Ribbon-based Volume to Surface mapping and resampling to standard surface
     logger.info(section_header('Making fMRI Ribbon'))
     ribbon_vol=os.path.join(settings.diagnostics.path,'ribbon_only.nii.gz')
-    make_cortical_ribbon(ref_vol = atlas_fMRI_3D,
-                        ribbon_vol = ribbon_vol,
-                        settings = settings,
-                        mesh_settings = meshes['AtlasSpaceNative'])
+    run(['cp', subject_files.cortical_ribbon(atlas_fMRI_3D, settings,
+                                             meshes['AtlasSpaceNative']),
+         ribbon_vol])
 
     logger.info(section_header('Determining Noisy fMRI voxels'))
     goodvoxels_vol = os.path.join(settings.diagnostics.path, 'goodvoxels.nii.gz')
@@ -161,7 +224,8 @@ def run_ciftify_subject_fmri(settings, tmpdir):
                               mesh_settings = meshes['AtlasSpaceNative'],
                               dilate_factor = settings.dilate_factor,
                               volume_roi = goodvoxels_vol,
-                              n_cpus = settings.n_cpus)
+                              n_cpus = settings.n_cpus,
+                              python_mapping = settings.python_surface_mapping)
 
 
         ## Erin's new addition - find what is below a certain percentile and dilate..
@@ -175,7 +239,8 @@ def run_ciftify_subject_fmri(settings, tmpdir):
                             hemisphere = Hemisphere,
                             src_mesh = meshes['AtlasSpaceNative'],
                             dest_mesh = meshes['{}k_fs_LR'.format(low_res_mesh)],
-                            surf_reg_name = settings.surf_reg)
+                            surf_reg_name = settings.surf_reg,
+                            python_resampling = settings.python_resampling)
 
     if settings.diagnostics.requested:
         build_diagnositic_cifti_files(tmean_vol, cov_vol, goodvoxels_vol,
@@ -190,17 +255,14 @@ def run_ciftify_subject_fmri(settings, tmpdir):
 
     atlas_roi_vol_greyord_res = os.path.join(settings.subject.atlas_space_dir, "ROIs",'Atlas_ROIs.{}.nii.gz'.format(settings.grayord_res))
 
-    atlas_roi_vol_fmri_res = subcortical_atlas(atlas_fMRI_4D,
-                            settings.subject.atlas_space_dir,
-                            settings.results_dir,
-                            settings.grayord_res,
-                            tmpdir)
+    atlas_roi_vol_fmri_res = subject_files.subcortical_rois(atlas_fMRI_4D, settings)
 
     tmp_dilate_cifti, tmp_roi_dlabel = resample_subcortical_part1(
                             input_fMRI = atlas_fMRI_4D,
                             atlas_roi_vol_fmri_res = atlas_roi_vol_fmri_res,
                             atlas_roi_vol_greyord_res = atlas_roi_vol_greyord_res,
-                            tmpdir = tmpdir)
+                            tmpdir = tmpdir,
+                            subject_files = subject_files)
     subcortical_data_s0 = resample_subcortical_part2(
                                 tmp_dilate_cifti,
                                 tmp_roi_dlabel,
@@ -258,6 +320,9 @@ class Settings(WorkFlowSettings):
         self.dilate_percent_below = arguments["--DilateBelowPct"]
         self.dilate_factor = 10 #settings dilate factor to match HCPPipeline default
         self.diagnostics = self.__set_surf_diagnostics(arguments['--OutputSurfDiagnostics'])
+        self.python_surface_mapping = arguments['--python-surface-mapping']
+        self.python_resampling = arguments['--python-resampling']
+        self.python_smoothing = arguments['--python-smoothing']
         self.already_atlas_transformed = arguments['--already-in-MNI']
         self.run_flirt = arguments["--FLIRT-to-T1w"]
         self.vol_reg = self.__define_volume_registration(arguments)
@@ -465,6 +530,87 @@ class Smoothing:
                   'recommended by the HCP, {} specified'.format(self.fwhm))
             self.sigma = FWHM2Sigma(float(self.fwhm))
 
+class SubjectFiles:
+    '''
+    the files that are the same for every fMRI run of a subject (with the same
+    voxel geometry), they are made once in the path (a tmpdir) and then reused
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def geometry_dir(self, volume):
+        '''the folder for the files of one voxel geometry (shape and affine)'''
+        img = nibabel.load(volume)
+        sha = hashlib.sha1('{}'.format(img.shape[:3]).encode())
+        sha.update(np.round(img.affine, 4).tobytes())
+        geometry_dir = os.path.join(self.path, 'geometry_{}'.format(sha.hexdigest()[:12]))
+        ciftify.utils.make_dir(geometry_dir, suppress_exists_error = True)
+        return geometry_dir
+
+    def cortical_ribbon(self, ref_vol, settings, mesh_settings):
+        '''the cortical ribbon (see make_cortical_ribbon) in the space of ref_vol'''
+        ribbon_vol = os.path.join(self.geometry_dir(ref_vol), 'ribbon_only.nii.gz')
+        if os.path.exists(ribbon_vol):
+            logger.info('Using the cortical ribbon in {}'.format(ribbon_vol))
+        else:
+            make_cortical_ribbon(ref_vol = ref_vol,
+                                 ribbon_vol = ribbon_vol,
+                                 settings = settings,
+                                 mesh_settings = mesh_settings)
+        return ribbon_vol
+
+    def subcortical_rois(self, input_fMRI, settings):
+        '''the subcortical rois (see subcortical_atlas) in the space of input_fMRI'''
+        geometry_dir = self.geometry_dir(input_fMRI)
+        tmp_ROIs = os.path.join(geometry_dir, 'ROIs.nii.gz')
+        if os.path.exists(tmp_ROIs):
+            logger.info('Using the subcortical rois in {}'.format(tmp_ROIs))
+            return tmp_ROIs
+        return subcortical_atlas(input_fMRI,
+                                 settings.subject.atlas_space_dir,
+                                 settings.results_dir,
+                                 settings.grayord_res,
+                                 geometry_dir)
+
+    def atlas_template(self, atlas_roi_vol_greyord_res):
+        '''the atlas subcortical template cifti (as a dlabel)'''
+        tmp_roi_dlabel = os.path.join(self.path, 'temp_template.dlabel.nii')
+        if os.path.exists(tmp_roi_dlabel):
+            logger.info('Using the atlas subcortical template cifti {}'.format(tmp_roi_dlabel))
+            return tmp_roi_dlabel
+        logger.info('Generate atlas subcortical template cifti')
+        run(['wb_command', '-cifti-create-label', tmp_roi_dlabel,
+            '-volume', atlas_roi_vol_greyord_res, atlas_roi_vol_greyord_res])
+        return tmp_roi_dlabel
+
+    def make_all(self, settings, tmpdir, atlas_fMRI_4D, atlas_fMRI_3D):
+        '''
+        makes all of the subject files for a run, with the (cached) ribbon and
+        resampling weights when they are used, so that runs processed at the same
+        time only read them
+        '''
+        meshes = define_meshes(settings.subject.path, tmpdir,
+            low_res_meshes = settings.low_res)
+        native_mesh = meshes['AtlasSpaceNative']
+        self.cortical_ribbon(atlas_fMRI_3D, settings, native_mesh)
+        self.subcortical_rois(atlas_fMRI_4D, settings)
+        self.atlas_template(os.path.join(settings.subject.atlas_space_dir, "ROIs",
+                                         'Atlas_ROIs.{}.nii.gz'.format(settings.grayord_res)))
+        if DRYRUN:
+            return
+        fmri_img = nibabel.load(atlas_fMRI_4D)
+        for hemisphere in ['L', 'R']:
+            if settings.python_surface_mapping:
+                ciftify.ribbon.ribbon_weights(
+                    surf_file(settings.subject.id, 'white', hemisphere, native_mesh),
+                    surf_file(settings.subject.id, 'pial', hemisphere, native_mesh),
+                    fmri_img.shape, fmri_img.affine,
+                    cache_dir = ribbon_weights_dir(native_mesh), n_cpus = N_CPUS)
+            if settings.python_resampling:
+                for low_res_mesh in settings.low_res:
+                    native_resampling_weights(settings.subject.id, hemisphere, native_mesh,
+                        meshes['{}k_fs_LR'.format(low_res_mesh)], settings.surf_reg)
+
 def run(cmd, suppress_stdout = False):
     ''' calls the run function with specific settings'''
     returncode = ciftify.utils.run(cmd,
@@ -474,6 +620,11 @@ def run(cmd, suppress_stdout = False):
         sys.exit(1)
     return(returncode)
 
+def set_diagnostics_path(settings, tmpdir):
+    '''the files for QCing the surface mapping go to the tmpdir unless requested'''
+    if not settings.diagnostics.path:
+        settings.diagnostics.path = tmpdir
+
 def log_build_environment():
     '''print the running environment info to the logs (info)'''
     logger.info("{}---### Environment Settings ###---".format(os.linesep))
@@ -890,26 +1041,39 @@ def define_good_voxels(input_fMRI_4D, ribbon_vol, goodvoxels_vol, tmpdir,
     return(tmean_vol, cov_vol)
 
 def map_volume_to_surface(vol_input, map_name, subject, hemisphere,
-        mesh_settings, n_cpus, dilate_factor = None, volume_roi = None):
+        mesh_settings, n_cpus, dilate_factor = None, volume_roi = None,
+        python_mapping = False):
     """
     Does wb_command -volume-to-surface mapping ribbon constrained
+    (or the same mapping with the cached ribbon weights if python_mapping)
     than does optional dilate step
     """
     output_func = func_gii_file(subject, map_name,
         hemisphere, mesh_settings)
-    cmd = ['wb_command', '-volume-to-surface-mapping', vol_input,
-     surf_file(subject, 'midthickness', hemisphere, mesh_settings),
-     output_func,'-ribbon-constrained',
-     surf_file(subject, 'white', hemisphere, mesh_settings),
-     surf_file(subject, 'pial', hemisphere, mesh_settings)]
-    if volume_roi:
-        cmd.extend(['-volume-roi', volume_roi])
-    run(cmd)
+    midthickness = surf_file(subject, 'midthickness', hemisphere, mesh_settings)
+    if python_mapping:
+        logger.info('Mapping {} to {}'.format(vol_input, output_func))
+        if not DRYRUN:
+            surf_data = ciftify.ribbon.map_volume_to_surface(vol_input,
+                surf_file(subject, 'white', hemisphere, mesh_settings),
+                surf_file(subject, 'pial', hemisphere, mesh_settings),
+                volume_roi = volume_roi,
+                cache_dir = ribbon_weights_dir(mesh_settings), n_cpus = int(n_cpus))
+            ciftify.niio.write_gii_data(output_func, surf_data,
+                ciftify.niio.surf_structure(midthickness))
+    else:
+        cmd = ['wb_command', '-volume-to-surface-mapping', vol_input,
+         midthickness, output_func, '-ribbon-constrained',
+         surf_file(subject, 'white', hemisphere, mesh_settings),
+         surf_file(subject, 'pial', hemisphere, mesh_settings)]
+        if volume_roi:
+            cmd.extend(['-volume-roi', volume_roi])
+        run(cmd)
 
     if dilate_factor:
     ## dilate to get rid of wholes caused by the goodvoxels_vol mask
         run(['wb_command', '-metric-dilate', output_func,
-          surf_file(subject, 'midthickness', hemisphere, mesh_settings),
+          midthickness,
           "{}".format(dilate_factor), output_func, '-nearest'])
 
 def dilate_out_low_intensity_voxels(settings, hemisphere, mesh_settings):
@@ -935,11 +1099,13 @@ def dilate_out_low_intensity_voxels(settings, hemisphere, mesh_settings):
       str(settings.dilate_factor), input_func_gii,
       '-bad-vertex-roi', lowvoxels_gii, '-nearest'])
 
-def mask_and_resample(map_name, subject, hemisphere, src_mesh, dest_mesh, surf_reg_name):
+def mask_and_resample(map_name, subject, hemisphere, src_mesh, dest_mesh, surf_reg_name,
+        python_resampling = False):
     '''
     Does three steps that happen often after surface projection to native space.
     1. mask in natve space (to remove the middle/subcortical bit)
-    2. resample to the low-res-mesh (32k mesh)
+    2. resample to the low-res-mesh (32k mesh) with ADAP_BARY_AREA
+       (with the cached resampling weights if python_resampling)
     3. mask again in the low (32k space)
     '''
 
@@ -947,16 +1113,39 @@ def mask_and_resample(map_name, subject, hemisphere, src_mesh, dest_mesh, surf_r
     output_gii = func_gii_file(subject, map_name, hemisphere, dest_mesh)
     roi_src = medial_wall_roi_file(subject, hemisphere, src_mesh)
     roi_dest = medial_wall_roi_file(subject, hemisphere, dest_mesh)
-    run(['wb_command', '-metric-mask', input_gii, roi_src, input_gii])
-    run(['wb_command', '-metric-resample', input_gii,
-      surf_file(subject, "sphere.{}".format(surf_reg_name), hemisphere, src_mesh),
-      surf_file(subject, 'sphere', hemisphere, dest_mesh),
-      'ADAP_BARY_AREA', output_gii,
-      '-area-surfs',
-      surf_file(subject, 'midthickness', hemisphere, src_mesh),
-      surf_file(subject, 'midthickness', hemisphere, dest_mesh),
-      '-current-roi', roi_src])
-    run(['wb_command', '-metric-mask', output_gii, roi_dest, output_gii])
+    if not python_resampling:
+        run(['wb_command', '-metric-mask', input_gii, roi_src, input_gii])
+        run(['wb_command', '-metric-resample', input_gii,
+          surf_file(subject, "sphere.{}".format(surf_reg_name), hemisphere, src_mesh),
+          surf_file(subject, 'sphere', hemisphere, dest_mesh),
+          'ADAP_BARY_AREA', output_gii,
+          '-area-surfs',
+          surf_file(subject, 'midthickness', hemisphere, src_mesh),
+          surf_file(subject, 'midthickness', hemisphere, dest_mesh),
+          '-current-roi', roi_src])
+        run(['wb_command', '-metric-mask', output_gii, roi_dest, output_gii])
+        return
+    logger.info('Resampling {} to {}'.format(input_gii, output_gii))
+    if DRYRUN:
+        return
+    ciftify.resample.mask_gii_file(input_gii, roi_src)
+    weights = native_resampling_weights(subject, hemisphere, src_mesh, dest_mesh,
+        surf_reg_name)
+    ciftify.resample.resample_gii_file(input_gii, output_gii, weights,
+        new_roi = roi_dest, n_cpus = N_CPUS)
+
+def native_resampling_weights(subject, hemisphere, src_mesh, dest_mesh, surf_reg_name):
+    '''
+    the ADAP_BARY_AREA weights for resampling from the native mesh, these are
+    saved in the subject's folder for the next map or run
+    '''
+    return ciftify.resample.resampling_weights(
+        surf_file(subject, "sphere.{}".format(surf_reg_name), hemisphere, src_mesh),
+        surf_file(subject, 'sphere', hemisphere, dest_mesh),
+        surf_file(subject, 'midthickness', hemisphere, src_mesh),
+        surf_file(subject, 'midthickness', hemisphere, dest_mesh),
+        current_roi = medial_wall_roi_file(subject, hemisphere, src_mesh),
+        cache_dir = resample_weights_dir(src_mesh))
 
 def volume_to_surface_plus_resampling(vol_input, map_name, hemisphere,
         settings, meshes, volume_roi = None, dilate_factor = None):
@@ -970,14 +1159,16 @@ def volume_to_surface_plus_resampling(vol_input, map_name, hemisphere,
                           mesh_settings = meshes['AtlasSpaceNative'],
                           dilate_factor = dilate_factor,
                           volume_roi = volume_roi,
-                          n_cpus = settings.n_cpus)
+                          n_cpus = settings.n_cpus,
+                          python_mapping = settings.python_surface_mapping)
     for low_res_mesh in settings.low_res:
         mask_and_resample(map_name = map_name,
                         subject = settings.subject.id,
                         hemisphere = hemisphere,
                         src_mesh = meshes['AtlasSpaceNative'],
                         dest_mesh = meshes['{}k_fs_LR'.format(low_res_mesh)],
-                        surf_reg_name = settings.surf_reg)
+                        surf_reg_name = settings.surf_reg,
+                        python_resampling = settings.python_resampling)
 
 
 def build_diagnositic_cifti_files(tmean_vol, cov_vol, goodvoxels_vol, settings, meshes):
@@ -1027,7 +1218,8 @@ def build_diagnositic_cifti_files(tmean_vol, cov_vol, goodvoxels_vol, settings,
                                 hemisphere = Hemisphere,
                                 src_mesh = meshes['AtlasSpaceNative'],
                                 dest_mesh = meshes['{}k_fs_LR'.format(low_res_mesh)],
-                                surf_reg_name = settings.surf_reg)
+                                surf_reg_name = settings.surf_reg,
+                                python_resampling = settings.python_resampling)
 
 
     map_names = ['goodvoxels', 'mean', 'mean_all', 'cov', 'cov_all']
@@ -1067,7 +1259,8 @@ def subcortical_atlas(input_fMRI, AtlasSpaceFolder, ResultsFolder,
         vol_rois = tmp_ROIs
     return(vol_rois)
 
-def resample_subcortical_part1(input_fMRI, atlas_roi_vol_fmri_res, atlas_roi_vol_greyord_res, tmpdir):
+def resample_subcortical_part1(input_fMRI, atlas_roi_vol_fmri_res, atlas_roi_vol_greyord_res,
+        tmpdir, subject_files = None):
     '''
     does the first step of the resampling, returns the two filepaths needed for next steps
 
@@ -1085,6 +1278,9 @@ def resample_subcortical_part1(input_fMRI, atlas_roi_vol_fmri_res, atlas_roi_vol
         define the volume parcels (usually Atlas_ROIs.2.nii.gz)
     tmpdir :
         The path to the folder where temporary files can be written
+    subject_files :
+        The SubjectFiles the atlas template cifti is made in (once per subject),
+        by default it is made in the tmpdir
 
     Returns
     --------
@@ -1104,10 +1300,9 @@ def resample_subcortical_part1(input_fMRI, atlas_roi_vol_fmri_res, atlas_roi_vol
     run(['wb_command', '-cifti-dilate', tmp_fmri_cifti,
         'COLUMN', '0', '10', tmp_dilate_cifti])
 
-    logger.info('Generate atlas subcortical template cifti')
-    tmp_roi_dlabel = os.path.join(tmpdir, 'temp_template.dlabel.nii')
-    run(['wb_command', '-cifti-create-label', tmp_roi_dlabel,
-        '-volume', atlas_roi_vol_greyord_res, atlas_roi_vol_greyord_res])
+    if subject_files is None:
+        subject_files = SubjectFiles(tmpdir)
+    tmp_roi_dlabel = subject_files.atlas_template(atlas_roi_vol_greyord_res)
     return tmp_dilate_cifti, tmp_roi_dlabel
 
 def resample_subcortical_part2(tmp_dilate_cifti, tmp_roi_dlabel,
@@ -1176,17 +1371,170 @@ def create_dense_timeseries(map_name, smoothing_fwhm, settings,
         '-timestep', settings.TR_in_ms])
 
 def metric_smoothing(hemisphere, settings, mesh_settings):
-    '''runs wb_commands metric smoothing assuming pipepline naming conventions'''
-
-    run(['wb_command', '-metric-smoothing',
-             surf_file(settings.subject.id, 'midthickness', hemisphere, mesh_settings),
-             func_gii_file(settings.subject.id, settings.fmri_label, hemisphere, mesh_settings),
-             '{}'.format(settings.smoothing.sigma),
-             func_gii_file(settings.subject.id,
+    '''
+    smooths the surface timeseries within the medial wall roi with wb_command
+    -metric-smoothing (or in python if settings.python_smoothing) assuming
+    pipepline naming conventions
+    '''
+    input_gii = func_gii_file(settings.subject.id, settings.fmri_label,
+                              hemisphere, mesh_settings)
+    output_gii = func_gii_file(settings.subject.id,
                     '{}_s{}'.format(settings.fmri_label, settings.smoothing.fwhm),
-                    hemisphere, mesh_settings),
-             '-roi', medial_wall_roi_file(settings.subject.id, hemisphere, mesh_settings)])
+                    hemisphere, mesh_settings)
+    if not settings.python_smoothing:
+        run(['wb_command', '-metric-smoothing',
+            surf_file(settings.subject.id, 'midthickness', hemisphere, mesh_settings),
+            input_gii, '{}'.format(settings.smoothing.sigma), output_gii,
+            '-roi', medial_wall_roi_file(settings.subject.id, hemisphere, mesh_settings)])
+        return
+    logger.info('Smoothing {} to {}'.format(input_gii, output_gii))
+    if DRYRUN:
+        return
+
+    func_gii = nibabel.load(input_gii)
+    roi_data = ciftify.niio.load_gii_data(
+        medial_wall_roi_file(settings.subject.id, hemisphere, mesh_settings))
+    func_data = np.column_stack([darray.data for darray in func_gii.darrays])
+    smoothed = ciftify.smoothing.smooth_metric(func_data,
+            surf_file(settings.subject.id, 'midthickness', hemisphere, mesh_settings),
+            settings.smoothing.sigma, roi = roi_data, n_cpus = N_CPUS)
+
+    ## write the smoothed data back into the input gifti to keep its metadata
+    for i, darray in enumerate(func_gii.darrays):
+        darray.data = smoothed[:, i].astype(darray.data.dtype)
+    nibabel.save(func_gii, output_gii)
+
+
+def read_batch_csv(batch_csv, arguments):
+    '''
+    reads the func.nii.gz and task_label of every run from the batch csv,
+    returns the arguments for each run (the other options are shared)
+    '''
+    try:
+        batch_df = pd.read_csv(batch_csv, skipinitialspace = True, dtype = str)
+    except:
+        logger.critical("Could not load csv {}".format(batch_csv))
+        sys.exit(1)
+
+    for column in ['func', 'task_label']:
+        if column not in batch_df.columns:
+            logger.error("Column '{}' not in batch csv {}".format(column, batch_csv))
+            sys.exit(1)
+    duplicated = batch_df.loc[batch_df['task_label'].duplicated(), 'task_label']
+    if len(duplicated):
+        logger.error("The task_label of every run in {} must be unique, "
+            "{} is repeated".format(batch_csv, ', '.join(duplicated.unique())))
+        sys.exit(1)
+
+    run_arguments = []
+    for idx in batch_df.index:
+        arguments_copy = dict(arguments)
+        arguments_copy['<func.nii.gz>'] = batch_df.loc[idx, 'func']
+        arguments_copy['<task_label>'] = batch_df.loc[idx, 'task_label']
+        run_arguments.append(arguments_copy)
+    return run_arguments
+
+def run_batch(run_settings, subject_tmpdir, formatter):
+    '''
+    runs all of the fMRI runs of a subject, in three steps:
+    1. every run is transformed to MNI space
+    2. the subject files (and weights) are made once for every voxel geometry
+    3. every run is mapped to the surfaces and written out
+    runs are processed up to n_cpus at a time, each with its own log
+    returns 0 once every run is done (exits if any run fails)
+    '''
+    n_cpus = int(run_settings[0].n_cpus)
+    n_workers = min(n_cpus, len(run_settings))
+    run_cpus = max(1, n_cpus // n_workers)
+    subject_files = SubjectFiles(subject_tmpdir)
+    run_tmpdirs = []
+    for settings in run_settings:
+        settings.n_cpus = run_cpus
+        run_tmpdirs.append(os.path.join(subject_tmpdir, settings.fmri_label))
+        ciftify.utils.make_dir(run_tmpdirs[-1])
+        ## each run's log starts like the log of its own call
+        write_run_log(settings, formatter, '{}{}'.format(ciftify.utils.ciftify_logo(),
+                      section_header("Starting ciftify_subject_fmri")))
+
+    logger.info(section_header('Transforming {} runs'.format(len(run_settings))))
+    atlas_images = run_batch_jobs(
+        [(transform_fmri, settings, (tmpdir,), formatter)
+         for settings, tmpdir in zip(run_settings, run_tmpdirs)],
+        n_workers, run_cpus)
+
+    logger.info(section_header('Making subject files'))
+    for settings, tmpdir, (atlas_fMRI_4D, atlas_fMRI_3D) in zip(
+            run_settings, run_tmpdirs, atlas_images):
+        subject_files.make_all(settings, tmpdir, atlas_fMRI_4D, atlas_fMRI_3D)
+
+    logger.info(section_header('Projecting {} runs'.format(len(run_settings))))
+    run_batch_jobs(
+        [(project_fmri, settings, (tmpdir, atlas_fMRI_4D, atlas_fMRI_3D, subject_files),
+          formatter)
+         for settings, tmpdir, (atlas_fMRI_4D, atlas_fMRI_3D) in zip(
+             run_settings, run_tmpdirs, atlas_images)],
+        n_workers, run_cpus, last_step = True)
+    return 0
+
+def write_run_log(settings, formatter, message):
+    '''writes a message to the log of one run only (not to the subject's log)'''
+    fh = settings.get_log_handler(formatter)
+    fh.handle(logger.makeRecord(logger.name, logging.INFO, __file__, 0, message,
+                                None, None))
+    fh.close()
+
+def init_batch_worker(dryrun, n_cpus):
+    '''gives each worker process the dry-run and number of cpus of a run'''
+    global DRYRUN
+    global N_CPUS
+    DRYRUN = dryrun
+    N_CPUS = n_cpus
 
+def run_batch_job(batch_job):
+    '''
+    runs one step of a run, logging to the run's log
+    returns if the run failed and the result of the step
+    '''
+    step, settings, step_args, formatter = batch_job
+    fh = settings.get_log_handler(formatter)
+    logger.addHandler(fh)
+    try:
+        return False, step(settings, *step_args)
+    except (Exception, SystemExit) as e:
+        ## the steps log their own errors before they exit, other errors need their traceback
+        logger.critical('Run {} failed'.format(settings.fmri_label),
+                        exc_info = not isinstance(e, SystemExit))
+        return True, None
+    finally:
+        logger.removeHandler(fh)
+        fh.close()
+
+def run_batch_jobs(batch_jobs, n_workers, run_cpus, last_step = False):
+    '''
+    runs the batch_jobs in a pool of n_workers processes, returns their results in order
+    after the last_step, the logs of the runs that did not fail are marked as Done
+    exits after all of the jobs are done if any of the runs failed
+    '''
+    global N_CPUS
+    if n_workers == 1:
+        N_CPUS = run_cpus
+        job_results = [run_batch_job(batch_job) for batch_job in batch_jobs]
+    else:
+        with futures.ProcessPoolExecutor(max_workers = n_workers,
+                                         initializer = init_batch_worker,
+                                         initargs = (DRYRUN, run_cpus)) as executor:
+            job_results = list(executor.map(run_batch_job, batch_jobs))
+    failed = []
+    for (_, settings, _, formatter), (run_failed, _) in zip(batch_jobs, job_results):
+        if run_failed:
+            failed.append(settings.fmri_label)
+        elif last_step:
+            write_run_log(settings, formatter, section_header("Done"))
+    if failed:
+        logger.critical('Stopping the batch, runs {} failed (see their logs)'.format(
+            ', '.join(failed)))
+        sys.exit(1)
+    return [result for _, result in job_results]
 
 def main():
     global DRYRUN
@@ -1208,6 +1556,20 @@ def main():
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 
+    if arguments['--batch']:
+        ## every run gets its own settings (and log), the run logs are added by run_batch
+        run_settings = [Settings(run_arguments) for run_arguments in
+                        read_batch_csv(arguments['<runs.csv>'], arguments)]
+        N_CPUS = int(run_settings[0].n_cpus)
+        logger.info('{}{}'.format(ciftify.utils.ciftify_logo(),
+                    section_header("Starting ciftify_subject_fmri")))
+        with ciftify.utils.TempDir() as tmpdir:
+            logger.info('Creating tempdir:{} on host:{}'.format(tmpdir,
+                        os.uname()[1]))
+            ret = run_batch(run_settings, tmpdir, formatter)
+        logger.info(section_header("Done"))
+        sys.exit(ret)
+
     # Get settings, and add an extra handler for the current log
     settings = Settings(arguments)
     fh = settings.get_log_handler(formatter)
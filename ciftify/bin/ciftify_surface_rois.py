@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 """
-Runs wb_command -surface-geodesic-rois to make rois on left and right surfaces then combines
-them into one dscalar file.
+Makes geodesic rois (like wb_command -surface-geodesic-rois) on left and right surfaces
+then combines them into one dscalar file.
 
 Usage:
     ciftify_surface_rois [options] <inputcsv> <radius> <L.surf.gii> <R.surf.gii> <output.dscalar.nii>
+    ciftify_surface_rois [options] --batch <batch.csv> <radius> <L.surf.gii> <R.surf.gii>
 
 Arguments:
     <inputcsv>            csv to read vertex list and hemisphere (and optional labels) from
@@ -12,14 +13,16 @@ Arguments:
     <L.surf.gii>          Corresponding Left surface
     <R.surf.gii>          Corresponding Right surface file
     <output.dscalar.nii>  output dscalar file
+    <batch.csv>           csv of the inputcsv and output of many roi maps (see DETAILS)
 
 Options:
     --vertex-col COLNAME   Column name [default: vertex] for column with vertices
     --hemi-col COLNAME     Column name [default: hemi] where hemisphere is given as L or R
     --labels-col COLNAME   Values in this column will be multiplied by the roi
-    --overlap-logic LOGIC  Overlap logic [default: ALLOW] for wb_command
+    --overlap-logic LOGIC  Overlap logic [default: ALLOW] for the rois
     --gaussian             Build a gaussian instead of a circular ROI.
     --probmap              Divide the map by the number to inputs so that the sum is meaningful.
+    --batch                Make one roi map for every row of the <batch.csv>
     --debug                Debug logging
     -v,--verbose           Verbose logging
     -h, --help             Prints this message
@@ -43,13 +46,22 @@ The  argument to -overlap-logic must be one of ALLOW, CLOSEST, or EXCLUDE.
  CLOSEST means that ROIs may not overlap, and that no ROI contains vertices that are closer to a different seed vertex.
  EXCLUDE means that ROIs may not overlap, and that any vertex within range of more than one ROI does not belong to any ROI.
 
+With '--batch' many roi maps are made on the same surfaces (and radius) in one run,
+reusing the geodesic neighbourhood of every vertex. The <batch.csv> (with a header)
+has one row per roi map, with two required columns ("inputcsv" and "output") and
+optional "vertex_col", "hemi_col" and "labels_col" columns. Empty cells (or missing
+columns) take the '--vertex-col', '--hemi-col' and '--labels-col' values.
+
+Example:
+  inputcsv, output, vertex_col
+  network1.csv, network1_tvertex.dscalar.nii, tvertex
+  network1.csv, network1_pvertex.dscalar.nii, pvertex
+  ...
+
 Written by Erin W Dickie, June 3, 2016
 """
 import os
 import sys
-import subprocess
-import tempfile
-import shutil
 import logging
 import logging.config
 
@@ -61,25 +73,73 @@ import pandas as pd
 from docopt import docopt
 
 import ciftify
-from ciftify.utils import run
 
 config_path = os.path.join(os.path.dirname(ciftify.config.find_ciftify_global()), 'bin', "logging.conf")
 logging.config.fileConfig(config_path, disable_existing_loggers=False)
 logger = logging.getLogger(os.path.basename(__file__))
 
-def run_ciftify_surface_rois(arguments, tmpdir):
-    inputcsv = arguments['<inputcsv>']
+def run_ciftify_surface_rois(arguments):
     surfL = arguments['<L.surf.gii>']
     surfR = arguments['<R.surf.gii>']
-    radius = arguments['<radius>']
-    output_dscalar = arguments['<output.dscalar.nii>']
-    vertex_col = arguments['--vertex-col']
-    hemi_col = arguments['--hemi-col']
-    labels_col = arguments['--labels-col']
+    radius = float(arguments['<radius>'])
     gaussian = arguments['--gaussian']
     overlap_logic = arguments['--overlap-logic']
     probmap = arguments['--probmap']
 
+    if overlap_logic not in ciftify.surface.ROI_OVERLAP_LOGIC:
+        logger.error("--overlap-logic must be one of {}, not {}".format(
+            ', '.join(ciftify.surface.ROI_OVERLAP_LOGIC), overlap_logic))
+        sys.exit(1)
+
+    if arguments['--batch']:
+        roi_maps = read_batch_csv(arguments['<batch.csv>'], arguments)
+    else:
+        roi_maps = [{'inputcsv': arguments['<inputcsv>'],
+                     'output': arguments['<output.dscalar.nii>'],
+                     'vertex_col': arguments['--vertex-col'],
+                     'hemi_col': arguments['--hemi-col'],
+                     'labels_col': arguments['--labels-col']}]
+
+    ## the surfaces are only read once for all roi maps
+    surface_rois = ciftify.surface.SurfaceRois(surfL, surfR)
+    for roi_map in roi_maps:
+        make_roi_map(surface_rois, roi_map['inputcsv'], roi_map['output'], radius,
+                     roi_map['vertex_col'], roi_map['hemi_col'], roi_map['labels_col'],
+                     gaussian, overlap_logic, probmap)
+
+def read_batch_csv(batch_csv, arguments):
+    '''
+    reads the inputcsv, output and (optional) column names of every roi map,
+    the column names default to the user arguments
+    '''
+    try:
+        batch_df = pd.read_csv(batch_csv, skipinitialspace = True)
+    except:
+        logger.critical("Could not load csv {}".format(batch_csv))
+        sys.exit(1)
+
+    for column in ['inputcsv', 'output']:
+        if column not in batch_df.columns:
+            logger.error("Column '{}' not in batch csv {}".format(column, batch_csv))
+            sys.exit(1)
+
+    roi_maps = []
+    for idx in batch_df.index:
+        roi_map = {'inputcsv': batch_df.loc[idx, 'inputcsv'],
+                   'output': batch_df.loc[idx, 'output']}
+        for column, option in [('vertex_col', '--vertex-col'),
+                               ('hemi_col', '--hemi-col'),
+                               ('labels_col', '--labels-col')]:
+            if column in batch_df.columns and not pd.isnull(batch_df.loc[idx, column]):
+                roi_map[column] = batch_df.loc[idx, column]
+            else:
+                roi_map[column] = arguments[option]
+        roi_maps.append(roi_map)
+    return roi_maps
+
+def make_roi_map(surface_rois, inputcsv, output_dscalar, radius, vertex_col, hemi_col,
+                 labels_col, gaussian, overlap_logic, probmap):
+    '''reads the vertices of one inputcsv and writes its roi map'''
     ## read in the inputcsv
     try:
         df = pd.read_csv(inputcsv)
@@ -96,62 +156,24 @@ def run_ciftify_surface_rois(arguments, tmpdir):
         logger.error("Hemisphere column '{}' not in csv".format(hemi_col))
         sys.exit(1)
 
-    for hemisphere in ['L','R']:
-
-        surf = surfL if hemisphere == 'L' else surfR
-
-        ## from the temp text build - func masks and target masks
-        rois_2D = os.path.join(tmpdir,'rois_{}_2D.func.gii'.format(hemisphere))
-        rois_1D = os.path.join(tmpdir, 'rois_{}_1D.shape.gii'.format(hemisphere))
+    if labels_col and labels_col not in df.columns:
+        logger.error("Labels column '{}' not in csv".format(labels_col))
+        sys.exit(1)
 
-        ## right the L and R hemisphere vertices from the table out to temptxt
-        vertex_list = os.path.join(tmpdir, 'vertex_list.txt')
+    for hemisphere in ['L','R']:
         vertices = df.loc[df[hemi_col] == hemisphere, vertex_col]
         logger.info('{} vertices are: {}'.format(hemisphere, vertices))
-        if len(vertices) > 0:
-            vertices.to_csv(vertex_list,sep='\n',index=False, header = False)
 
-            if gaussian:
-                run(['wb_command', '-surface-geodesic-rois', surf,
-                       str(radius), vertex_list, rois_2D, '-gaussian',
-                       str(radius)])
-            else:
-                run(['wb_command', '-surface-geodesic-rois', surf,
-                    str(radius),  vertex_list, rois_2D,
-                    '-overlap-logic', overlap_logic])
-
-            if labels_col:
-                run(['wb_command -metric-math "x*0"', rois_1D,
-                       '-var', 'x', rois_2D, '-column', '1'], suppress_stdout=True)
-
-                for i, label in enumerate(df.loc[df[hemi_col] == hemisphere, labels_col]):
-                    run(['wb_command -metric-math "((x*{}) + y)"'.format(label), rois_1D,
-                           '-var', 'x', rois_2D, '-column', '{}'.format(i + 1),
-                          '-var', 'y', rois_1D], suppress_stdout=True)
-            else:
-                run(['wb_command', '-metric-reduce',
-                      rois_2D, 'SUM', rois_1D])
-
-        else:
-            pd.Series([1]).to_csv(vertex_list,sep='\n',index=False, header = False)
-            run(['wb_command', '-surface-geodesic-rois', surf,
-                str(radius),  vertex_list, rois_2D])
-            run(['wb_command -metric-math "x*0"', rois_1D,
-                   '-var', 'x', rois_2D, '-column', '1'], suppress_stdout=True)
-
-    if probmap:
-        mergedoutput = os.path.join(tmpdir,"mergedoutput.dscalar.nii")
-    else:
-        mergedoutput = output_dscalar
-    # combine result surfaces into a cifti file
-    run(['wb_command', '-cifti-create-dense-scalar', mergedoutput,
-           '-left-metric', os.path.join(tmpdir,'rois_L_1D.shape.gii'),
-           '-right-metric', os.path.join(tmpdir,'rois_R_1D.shape.gii')])
+    labels = df[labels_col].values if labels_col else None
+    try:
+        rois = surface_rois.bilateral_map(df[vertex_col].values, df[hemi_col].values,
+                                          radius, labels, gaussian, overlap_logic, probmap)
+    except ValueError as e:
+        logger.error(e)
+        sys.exit(1)
 
-    if probmap:
-        run(['wb_command -cifti-math "(x/{})"'.format(len(df)),
-                output_dscalar,
-                '-var', 'x', mergedoutput ], suppress_stdout=True)
+    ## combine result surfaces into a cifti file
+    surface_rois.write_dscalar(output_dscalar, rois)
 
 def main():
     arguments  = docopt(__doc__)
@@ -176,9 +198,7 @@ def main():
     # formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     # logger.setFormatter(formatter)
 
-    with ciftify.utils.TempDir() as tmpdir:
-        logger.info('Creating tempdir:{} on host:{}'.format(tmpdir, os.uname()[1]))
-        ret = run_ciftify_surface_rois(arguments, tmpdir)
+    ret = run_ciftify_surface_rois(arguments)
 
     logger.info(ciftify.utils.section_header('Done ciftify_surface_rois'))
     sys.exit(ret)
@@ -20,6 +20,9 @@ Options:
   --HCP-Pipelines          Indicates that the surfaces were generated by the HCP-Pipelines
   --HCP-MSMAll             Project to the MSMAll surface (instead of '32k_fs_LR', only works for HCP subjects)
   --resample-nifti         Use this argument to resample voxels 2x2x2 before projecting
+  --python-surface-mapping
+                           Do the ribbon constrained surface mapping with ciftify's
+                           (cached) ribbon weights instead of wb_command
   --hcp-data-dir PATH      DEPRECATED, use --ciftify-work-dir instead
   --debug                  Debug logging in Erin's very verbose style
   -n,--dry-run             Dry run
@@ -39,6 +42,12 @@ If they are not given, <vol.nii.gz> will be used as the input volume for their s
 The '--dilate' option will add a can to wb_commands -cifti-dilate function
 (with the specified mm option) to expand clusters and fill holes.
 
+With '--python-surface-mapping' the ribbon constrained mapping (not used with
+'--integer-labels') is done in python instead of with wb_command. The ribbon weights
+are built once for the surfaces and the voxel geometry of the volume and saved in a
+ribbon_weights folder next to the subject's surfaces (or in the ciftify cache for
+'HCP_S1200_GroupAvg'), so that the next volume in the same space only reads them.
+
 If <subject> is set to 'HCP_S1200_GroupAvg' the volume with project to the surfaces
 of the HCP S900 release Average subject.  This 'average fiducial mapping' approach
 is not recommended in most cases, as group average surfaces do not encapsulate
@@ -72,23 +81,34 @@ def run_ciftify_vol_result(settings, tmpdir):
 
     ## project the surface data
     for hemi in ['L','R']:
-        surf_mapping_cmd = ['wb_command', '-volume-to-surface-mapping',
-            settings.surface_nii,
-            os.path.join(settings.surf_dir,
-                '{}.{}.midthickness{}.surf.gii'.format(
-                    settings.subject, hemi, settings.surf_mesh)),
-            os.path.join(tmpdir, '{}.func.gii'.format(hemi))]
+        midthickness = os.path.join(settings.surf_dir,
+            '{}.{}.midthickness{}.surf.gii'.format(
+                settings.subject, hemi, settings.surf_mesh))
+        output_func = os.path.join(tmpdir, '{}.func.gii'.format(hemi))
         if settings.integer_labels:
-            surf_mapping_cmd.append('-enclosing')
+            run(['wb_command', '-volume-to-surface-mapping',
+                settings.surface_nii, midthickness, output_func, '-enclosing'])
+        elif settings.python_surface_mapping:
+            ## ribbon constrained mapping with the (cached) ribbon weights
+            surf_data = ciftify.ribbon.map_volume_to_surface(settings.surface_nii,
+                os.path.join(settings.surf_dir,
+                    '{}.{}.white{}.surf.gii'.format(
+                        settings.subject,hemi,settings.surf_mesh)),
+                os.path.join(settings.surf_dir,
+                    '{}.{}.pial{}.surf.gii'.format(
+                        settings.subject,hemi,settings.surf_mesh)),
+                cache_dir = settings.ribbon_weights_dir)
+            ciftify.niio.write_gii_data(output_func, surf_data,
+                ciftify.niio.surf_structure(midthickness))
         else:
-            surf_mapping_cmd.extend(['-ribbon-constrained',
-                    os.path.join(settings.surf_dir,
-                        '{}.{}.white{}.surf.gii'.format(
-                            settings.subject,hemi,settings.surf_mesh)),
-                    os.path.join(settings.surf_dir,
-                        '{}.{}.pial{}.surf.gii'.format(
-                            settings.subject,hemi,settings.surf_mesh))])
-        run(surf_mapping_cmd)
+            run(['wb_command', '-volume-to-surface-mapping',
+                settings.surface_nii, midthickness, output_func, '-ribbon-constrained',
+                os.path.join(settings.surf_dir,
+                    '{}.{}.white{}.surf.gii'.format(
+                        settings.subject,hemi,settings.surf_mesh)),
+                os.path.join(settings.surf_dir,
+                    '{}.{}.pial{}.surf.gii'.format(
+                        settings.subject,hemi,settings.surf_mesh))])
 
     ## if asked to resample the volume...do this step
     if settings.resample:
@@ -155,6 +175,8 @@ class UserSettings(WorkDirSettings):
         self.subject = self.get_subject(arguments['<subject>'])
         self.surf_dir = self.get_surf_dir()
         self.surf_mesh = self.get_surface_mesh(arguments['--HCP-MSMAll'])
+        self.python_surface_mapping = arguments['--python-surface-mapping']
+        self.ribbon_weights_dir = self.get_ribbon_weights_dir()
         self.atlas_vol = self.get_atlas_vol()
         self.surf_roi_L = self.get_surf_roi('L')
         self.surf_roi_R = self.get_surf_roi('R')
@@ -202,6 +224,12 @@ class UserSettings(WorkDirSettings):
                 'MNINonLinear','fsaverage_LR32k')
         return surface_dir
 
+    def get_ribbon_weights_dir(self):
+        ''' returns the directory the ribbon weights for the surfaces are saved to '''
+        if self.use_ciftify_global:
+            return os.path.join(ciftify.config.find_ciftify_cache(), 'ribbon_weights')
+        return os.path.join(self.surf_dir, 'ribbon_weights')
+
     def get_surface_mesh(self, use_MSMall):
         ''' returns a string needed to create the surface filesnames '''
         if self.use_ciftify_global:
@@ -0,0 +1,588 @@
+#!/usr/bin/env python3
+"""
+In-process cluster finding on cifti maps (like wb_command -cifti-find-clusters)
+using the neighbours of every grayordinate (surface mesh edges and face
+adjacent voxels) as one sparse graph.
+"""
+
+import sys
+import logging
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy import sparse
+from scipy import ndimage
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+
+import ciftify.niio
+import ciftify.surface
+
+SURFACE_STRUCTURES = {'CIFTI_STRUCTURE_CORTEX_LEFT': 'L',
+                      'CIFTI_STRUCTURE_CORTEX_RIGHT': 'R'}
+# number of candidate peaks per geodesic distance calculation
+DISTANCE_CHUNK = 256
+VOLUME_PEAK_COLUMNS = ['clusterID', 'structure', 'i', 'j', 'k', 'x', 'y', 'z',
+                       'peak_value', 'cluster_volume']
+
+logger = logging.getLogger(__name__)
+
+class CiftiGraph:
+    '''
+    The grayordinates of a cifti file as a graph, for finding clusters.
+
+    Surface grayordinates are connected by the edges of their mesh and have the
+    size of their (corrected) vertex area, voxels are connected to the voxels that
+    share a face with them (across all subcortical structures, like the
+    -merged-volume option of wb_command) and have the size of one voxel in mm^3.
+
+    Arguments:
+      brain_models   the nibabel BrainModelAxis of the cifti file
+      surfaces       dict of surface files, with 'L' and 'R' keys
+      vertex_areas   dict of vertex area arrays (for every vertex), with 'L' and 'R' keys
+    '''
+    def __init__(self, brain_models, surfaces, vertex_areas):
+        self.brain_models = brain_models
+        self.surfaces = surfaces
+        self.__surface_graphs = {}
+        self.n_grayordinates = len(brain_models)
+        self.is_surface = brain_models.surface_mask
+        self.sizes = np.zeros(self.n_grayordinates, dtype = np.float64)
+        self.order = np.zeros(self.n_grayordinates, dtype = np.int64)
+        self.n_vertices = {hemi: len(np.asarray(vertex_areas[hemi]).ravel())
+                           for hemi in vertex_areas}
+        rows, cols = [], []
+        offset = 0
+        ## nibabel builds a new axis for every structure, so only do it once
+        self.structures = list(brain_models.iter_structures())
+        for name, slc, structure in self.structures:
+            idx = np.arange(self.n_grayordinates)[slc]
+            if name in SURFACE_STRUCTURES:
+                hemi = SURFACE_STRUCTURES[name]
+                edges = self.__surface_edges(structure, idx, surfaces[hemi])
+                self.sizes[idx] = np.asarray(vertex_areas[hemi]).ravel()[structure.vertex]
+                ## workbench numbers clusters in vertex order, one structure after another
+                self.order[idx] = offset + structure.vertex
+                offset += structure.nvertices[name]
+                rows.append(edges[:, 0])
+                cols.append(edges[:, 1])
+        volume_idx = np.flatnonzero(brain_models.volume_mask)
+        if len(volume_idx) > 0:
+            edges, linear_index = volume_edges(brain_models.voxel[volume_idx],
+                                               brain_models.volume_shape)
+            rows.append(volume_idx[edges[:, 0]])
+            cols.append(volume_idx[edges[:, 1]])
+            self.sizes[volume_idx] = np.prod(nib.affines.voxel_sizes(brain_models.affine))
+            self.order[volume_idx] = offset + linear_index
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype = np.int64)
+        cols = np.concatenate(cols) if cols else np.zeros(0, dtype = np.int64)
+        self.graph = sparse.coo_matrix((np.ones(len(rows), dtype = np.int8), (rows, cols)),
+                                       shape = (self.n_grayordinates, self.n_grayordinates)).tocsr()
+
+    def __surface_edges(self, structure, idx, surf):
+        '''the mesh edges between the vertices of a surface structure (as grayordinate indices)'''
+        if surf is None:
+            logger.error('A surface is needed to find clusters in {}'.format(structure.name[0]))
+            sys.exit(1)
+        triangles = np.asarray(ciftify.niio.load_surf_triangles(surf), dtype = np.int64)
+        n_vertices = list(structure.nvertices.values())[0]
+        if triangles.max() >= n_vertices:
+            logger.error('Surface {} does not match the cifti file ({} vertices)'.format(
+                surf, n_vertices))
+            sys.exit(1)
+        grayordinate = np.full(n_vertices, -1, dtype = np.int64)
+        grayordinate[structure.vertex] = idx
+        edges = grayordinate[ciftify.surface.mesh_edges(triangles)]
+        return edges[(edges >= 0).all(axis = 1)]
+
+    def components(self, mask):
+        '''
+        the connected components of the grayordinates in the mask
+        returns the component of each masked grayordinate (-1 outside the mask)
+        and the number of components
+        '''
+        idx = np.flatnonzero(mask)
+        component = np.full(self.n_grayordinates, -1, dtype = np.int64)
+        if len(idx) == 0:
+            return component, 0
+        n_components, labels = csgraph.connected_components(
+            self.graph[idx, :][:, idx], directed = False)
+        component[idx] = labels
+        return component, n_components
+
+    def find_clusters(self, data, threshold, min_area, min_volume,
+                      less_than = False, start = 1):
+        '''
+        labels the clusters of grayordinates above (or below if less_than) the threshold
+
+        Surface clusters smaller than min_area (mm^2) and volume clusters smaller
+        than min_volume (mm^3) are dropped. Like wb_command -cifti-find-clusters the
+        clusters are numbered from start, in the order of their first vertex (or voxel).
+        Returns an array of labels (0 outside of clusters).
+        '''
+        data = np.asarray(data, dtype = np.float64).ravel()
+        with np.errstate(invalid = 'ignore'):
+            mask = data < threshold if less_than else data > threshold
+        component, n_components = self.components(mask)
+        return self.label_components(component, n_components, min_area, min_volume, start)
+
+    def label_components(self, component, n_components, min_area, min_volume, start = 1):
+        '''
+        numbers the components (from components()) that are large enough, from start
+        in the order of their first vertex (or voxel), returns an array of labels
+        '''
+        labels = np.zeros(self.n_grayordinates, dtype = np.int32)
+        if n_components == 0:
+            return labels
+        idx = np.flatnonzero(component >= 0)
+        comp = component[idx]
+        size = np.bincount(comp, weights = self.sizes[idx], minlength = n_components)
+        on_surface = np.zeros(n_components, dtype = bool)
+        on_surface[comp[self.is_surface[idx]]] = True
+        keep = np.where(on_surface, size >= float(min_area), size >= float(min_volume))
+        first = np.full(n_components, np.iinfo(np.int64).max, dtype = np.int64)
+        np.minimum.at(first, comp, self.order[idx])
+        kept = np.flatnonzero(keep)
+        kept = kept[np.argsort(first[kept], kind = 'stable')]
+        new_label = np.zeros(n_components, dtype = np.int32)
+        new_label[kept] = np.arange(start, start + len(kept))
+        labels[idx] = new_label[comp]
+        return labels
+
+    def find_signed_clusters(self, data, min_threshold, max_threshold,
+                             min_area, min_volume):
+        '''
+        the positive clusters (above max_threshold, numbered from 1) and the
+        negative clusters (below min_threshold, numbered after the positive ones)
+        as one array of labels
+        '''
+        pos_labels = self.find_clusters(data, max_threshold, min_area, min_volume,
+                                        less_than = False, start = 1)
+        neg_labels = self.find_clusters(data, min_threshold, min_area, min_volume,
+                                        less_than = True, start = pos_labels.max() + 1)
+        return pos_labels + neg_labels
+
+    def find_signed_clusters_at_thresholds(self, data, thresholds, min_area, min_volume):
+        '''
+        find_signed_clusters for every (min_threshold, max_threshold) pair in thresholds,
+        from one component tree for the positive and one for the negative values
+        returns a list of label arrays, one per pair
+        '''
+        data = np.asarray(data, dtype = np.float64).ravel()
+        positive = self.components_at_thresholds(data,
+                                    [float(max_t) for min_t, max_t in thresholds])
+        negative = self.components_at_thresholds(-data,
+                                    [-float(min_t) for min_t, max_t in thresholds])
+        all_labels = []
+        for pos_components, neg_components in zip(positive, negative):
+            pos_labels = self.label_components(*pos_components, min_area, min_volume, start = 1)
+            neg_labels = self.label_components(*neg_components, min_area, min_volume,
+                                               start = pos_labels.max() + 1)
+            all_labels.append(pos_labels + neg_labels)
+        return all_labels
+
+    def components_at_thresholds(self, values, thresholds):
+        '''
+        the connected components of the grayordinates above each of the thresholds
+
+        The grayordinates are sorted once and added from the largest value down,
+        joining their clusters (union-find) as they go, so the components at every
+        threshold come from one pass (the component tree of the map).
+        Returns a list of (component, n_components) like components().
+        '''
+        values = np.asarray(values, dtype = np.float64).ravel().copy()
+        values[np.isnan(values)] = -np.inf
+        order = np.argsort(-values, kind = 'stable')
+        sorted_values = values[order]
+        graph = (self.graph + self.graph.T).tocsr()
+        indptr, indices = graph.indptr.tolist(), graph.indices.tolist()
+        sets = ComponentForest(self.n_grayordinates)
+        active = [False] * self.n_grayordinates
+        n_added = 0
+        tree_components = {}
+        for threshold in sorted(set(thresholds), reverse = True):
+            n_above = int(np.searchsorted(-sorted_values, -threshold, side = 'left'))
+            for v in order[n_added:n_above].tolist():
+                active[v] = True
+                for u in indices[indptr[v]:indptr[v + 1]]:
+                    if not active[u]:
+                        continue
+                    root_u, root_v = sets.find(u), sets.find(v)
+                    if root_u != root_v:
+                        sets.union(root_u, root_v)
+            n_added = n_above
+            tree_components[threshold] = sets.components(order[:n_above],
+                                                         self.n_grayordinates)
+        return [tree_components[threshold] for threshold in thresholds]
+
+    def find_extrema(self, data, surface_distance, volume_distance,
+                     min_threshold, max_threshold):
+        '''
+        finds the peaks of the map (like wb_command -cifti-extrema with -threshold)
+
+        Maxima are at least max_threshold and larger than their mesh neighbours and
+        than every other grayordinate of the same structure within surface_distance
+        (geodesic, in mm) or volume_distance (in mm), minima the same for values at
+        most min_threshold. Returns an array of 1 at the maxima, -1 at the minima.
+        '''
+        data = np.asarray(data, dtype = np.float64).ravel()
+        extrema = np.zeros(self.n_grayordinates, dtype = np.int8)
+        for sign, threshold in [(1, float(max_threshold)), (-1, float(min_threshold))]:
+            values = sign * data
+            values[np.isnan(values)] = -np.inf
+            candidates = (values >= sign * threshold) & (values > self.neighbour_max(values))
+            for name, slc, structure in self.structures:
+                idx = np.arange(self.n_grayordinates)[slc]
+                if name in SURFACE_STRUCTURES:
+                    is_peak = self.__surface_peaks(values, idx, structure,
+                                                   SURFACE_STRUCTURES[name],
+                                                   candidates[idx], float(surface_distance))
+                else:
+                    ## voxels are compared to all the voxels around them, not only their faces
+                    is_peak = volume_peaks(values[idx], structure.voxel,
+                                           self.brain_models.affine,
+                                           values[idx] >= sign * threshold,
+                                           float(volume_distance))
+                extrema[idx[is_peak]] = sign
+        return extrema
+
+    def neighbour_max(self, values):
+        '''the largest value among the neighbours of every grayordinate (-inf without neighbours)'''
+        graph = (self.graph + self.graph.T).tocsr()
+        neighbour_max = np.full(self.n_grayordinates, -np.inf)
+        has_neighbours = np.diff(graph.indptr) > 0
+        if has_neighbours.any():
+            neighbour_max[has_neighbours] = np.maximum.reduceat(
+                values[graph.indices], graph.indptr[:-1][has_neighbours])
+        return neighbour_max
+
+    def surface_graph(self, hemi):
+        '''the geodesic distance graph of a surface, built once'''
+        if hemi not in self.__surface_graphs:
+            self.__surface_graphs[hemi] = ciftify.surface.SurfaceGraph(self.surfaces[hemi])
+        return self.__surface_graphs[hemi]
+
+    def __surface_peaks(self, values, idx, structure, hemi, candidates, distance):
+        '''which of the candidate vertices are larger than all others within the distance'''
+        is_peak = np.zeros(len(idx), dtype = bool)
+        if not candidates.any():
+            return is_peak
+        surf_graph = self.surface_graph(hemi)
+        surf_values = np.full(surf_graph.n_vertices, -np.inf)
+        surf_values[structure.vertex] = values[idx]
+        candidate_idx = np.flatnonzero(candidates)
+        n_chunks = max(1, int(np.ceil(len(candidate_idx) / DISTANCE_CHUNK)))
+        for chunk in np.array_split(candidate_idx, n_chunks):
+            vertices = structure.vertex[chunk]
+            distances = surf_graph.distances(vertices, limit = distance)
+            distances[np.arange(len(vertices)), vertices] = np.inf
+            nearby = np.where(np.isfinite(distances), surf_values[np.newaxis, :], -np.inf)
+            is_peak[chunk] = nearby.max(axis = 1) < surf_values[vertices]
+        return is_peak
+
+    def tfce(self, data, E_surface = 1.0, E_volume = 0.5, H = 2.0, dh = 0.1):
+        '''
+        the threshold-free cluster enhancement of the map (Smith & Nichols 2009)
+
+        The score of each grayordinate is the sum, over the thresholds h (in steps
+        of dh) up to its value, of extent(h)^E * h^H * dh, where the extent is the
+        (corrected) area or volume of the cluster it is in at that threshold.
+        Negative values are enhanced separately and returned as negative scores.
+        '''
+        data = np.asarray(data, dtype = np.float64).ravel()
+        exponents = np.where(self.is_surface, float(E_surface), float(E_volume))
+        scores = np.zeros(self.n_grayordinates, dtype = np.float64)
+        for sign in [1, -1]:
+            values = sign * data
+            values[np.isnan(values)] = 0
+            scores += sign * self.__tfce_scores(values, exponents, float(H), float(dh))
+        return scores
+
+    def __tfce_scores(self, values, exponents, H, dh):
+        '''
+        the TFCE scores of the positive values, from one pass over the grayordinates
+        in descending order. Clusters are joined as the threshold drops (union-find)
+        and each cluster only adds to the score of its members when its extent changes.
+        '''
+        scores = np.zeros(self.n_grayordinates, dtype = np.float64)
+        levels = np.floor(values / dh).astype(np.int64)
+        active_idx = np.flatnonzero(levels >= 1)
+        if len(active_idx) == 0:
+            return scores
+        heights = np.arange(levels.max() + 1) * dh
+        ## the sum of h^H * dh over the thresholds up to each level
+        height_sums = np.concatenate(([0], np.cumsum(heights[1:]**H * dh))).tolist()
+
+        graph = (self.graph + self.graph.T).tocsr()
+        indptr, indices = graph.indptr.tolist(), graph.indices.tolist()
+        sets = ComponentForest(self.n_grayordinates)
+        extent = self.sizes.tolist()
+        level_of = levels.tolist()
+        exponent = exponents.tolist()
+        ## the level from which each cluster has had its current extent
+        opened = list(level_of)
+        active = [False] * self.n_grayordinates
+
+        def add_scores(root, level):
+            sets.offset[root] += extent[root]**exponent[root] * (
+                height_sums[opened[root]] - height_sums[level])
+            opened[root] = level
+
+        for v in active_idx[np.argsort(-values[active_idx], kind = 'stable')].tolist():
+            level = level_of[v]
+            active[v] = True
+            for u in indices[indptr[v]:indptr[v + 1]]:
+                if not active[u]:
+                    continue
+                root_u, root_v = sets.find(u), sets.find(v)
+                if root_u == root_v:
+                    continue
+                add_scores(root_u, level)
+                add_scores(root_v, level)
+                root = sets.union(root_u, root_v)
+                extent[root] = extent[root_u] + extent[root_v]
+                opened[root] = level
+        for v in active_idx.tolist():
+            if sets.find(v) == v:
+                add_scores(v, 0)
+        scores[active_idx] = [sets.value(v) for v in active_idx.tolist()]
+        return scores
+
+    def surface_data(self, data, hemi, n_vertices):
+        '''
+        the values of one hemisphere ('L' or 'R') for all n_vertices of its surface
+        (vertices not in the cifti file are zero)
+        '''
+        data = np.asarray(data)
+        surf_data = np.zeros(n_vertices, dtype = data.dtype)
+        for name, slc, structure in self.structures:
+            if SURFACE_STRUCTURES.get(name) == hemi:
+                surf_data[structure.vertex] = data[slc]
+        return surf_data
+
+class ComponentForest:
+    '''
+    Disjoint sets (union-find) of grayordinates, for joining clusters as a
+    threshold drops. Each set can also carry a value for all of its members:
+    a member's value is the sum of the offsets on its path to the root.
+    '''
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
+        self.offset = [0.0] * n
+
+    def find(self, v):
+        '''the root of the set of v (with path compression)'''
+        path = []
+        while self.parent[v] != v:
+            path.append(v)
+            v = self.parent[v]
+        ## going down from the root, so that every node keeps its value
+        total = 0.0
+        for node in reversed(path):
+            total += self.offset[node]
+            self.offset[node] = total
+            self.parent[node] = v
+        return v
+
+    def union(self, root_a, root_b):
+        '''joins two sets (given by their roots), returns the new root'''
+        if self.size[root_a] < self.size[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        self.offset[root_b] -= self.offset[root_a]
+        self.size[root_a] += self.size[root_b]
+        return root_a
+
+    def components(self, members, n):
+        '''
+        the sets of the given members as an array of component numbers for all
+        n elements (-1 for the others) and the number of components
+        '''
+        component = np.full(n, -1, dtype = np.int64)
+        if len(members) == 0:
+            return component, 0
+        parent = np.asarray(self.parent, dtype = np.int64)
+        roots = parent[members]
+        while True:
+            grand_parents = parent[roots]
+            if np.array_equal(grand_parents, roots):
+                break
+            roots = grand_parents
+        unique_roots, component[members] = np.unique(roots, return_inverse = True)
+        return component, len(unique_roots)
+
+    def value(self, v):
+        '''the value of one member'''
+        root = self.find(v)
+        if root == v:
+            return self.offset[v]
+        return self.offset[v] + self.offset[root]
+
+def volume_edges(voxels, volume_shape):
+    '''
+    the pairs of voxels (as indices into voxels) that share a face
+    also returns the linear (x fastest) index of each voxel in the volume
+    '''
+    voxels = np.asarray(voxels, dtype = np.int64)
+    nx, ny, nz = volume_shape
+    linear_index = voxels[:, 0] + nx * (voxels[:, 1] + ny * voxels[:, 2])
+    order = np.argsort(linear_index)
+    sorted_index = linear_index[order]
+    edges = []
+    for axis, step in enumerate([1, nx, nx * ny]):
+        has_neighbour = voxels[:, axis] + 1 < volume_shape[axis]
+        neighbour_index = linear_index + step
+        pos = np.searchsorted(sorted_index, neighbour_index)
+        pos[pos >= len(sorted_index)] = 0
+        found = has_neighbour & (sorted_index[pos] == neighbour_index)
+        edges.append(np.column_stack((np.flatnonzero(found), order[pos[found]])))
+    return np.vstack(edges), linear_index
+
+def volume_peaks(values, voxels, affine, candidates, distance):
+    '''
+    which of the candidate voxels are larger than every other voxel (of the same
+    list of voxels) within the distance (in mm)
+    '''
+    is_peak = np.zeros(len(values), dtype = bool)
+    candidate_idx = np.flatnonzero(candidates)
+    if len(candidate_idx) == 0:
+        return is_peak
+    coords = nib.affines.apply_affine(affine, voxels)
+    tree = cKDTree(coords)
+    for i, neighbours in zip(candidate_idx,
+                             tree.query_ball_point(coords[candidate_idx], distance)):
+        neighbours = [n for n in neighbours if n != i]
+        is_peak[i] = not neighbours or values[neighbours].max() < values[i]
+    return is_peak
+
+def threshold_extrema(extrema, data, min_threshold, max_threshold):
+    '''
+    keeps the extrema (from CiftiGraph.find_extrema with lower thresholds) that pass
+    higher thresholds, because the distance rule does not depend on the threshold
+    '''
+    data = np.asarray(data).ravel()
+    keep = ((extrema > 0) & (data >= float(max_threshold))) | \
+           ((extrema < 0) & (data <= float(min_threshold)))
+    return np.where(keep, extrema, 0).astype(extrema.dtype)
+
+def volume_peak_table(data, brain_models, min_threshold, max_threshold,
+                      volume_distance, min_volume, cluster_labels = None):
+    '''
+    the clusters and peaks of the voxels of a cifti map, found with scipy.ndimage
+    on the voxel grid of the cifti file
+
+    Clusters are face connected voxels above max_threshold (or below min_threshold)
+    of at least min_volume mm^3, numbered from 1 (positive first) in the order of their
+    first voxel. If the cluster_labels of all grayordinates are given, their labels are
+    used instead. Peaks are the voxels with the largest (or smallest) value of their
+    cluster within volume_distance mm, every cluster has at least one.
+    Returns a DataFrame with one row per peak.
+    '''
+    data = np.asarray(data, dtype = np.float64).ravel()
+    volume_idx = np.flatnonzero(brain_models.volume_mask)
+    if len(volume_idx) == 0:
+        return pd.DataFrame(columns = VOLUME_PEAK_COLUMNS)
+    grid_idx = tuple(brain_models.voxel[volume_idx].T)
+    grayordinate = np.full(brain_models.volume_shape, -1, dtype = np.int64)
+    grayordinate[grid_idx] = volume_idx
+    voxel_sizes = nib.affines.voxel_sizes(brain_models.affine)
+    footprint = sphere_footprint(float(volume_distance), voxel_sizes)
+    ## the linear index with x fastest, to number the clusters like workbench
+    first_order = np.arange(grayordinate.size).reshape(grayordinate.shape, order = 'F')
+
+    tables = []
+    start = 1
+    for sign, threshold in [(1, float(max_threshold)), (-1, float(min_threshold))]:
+        values = np.full(brain_models.volume_shape, -np.inf)
+        values[grid_idx] = sign * data[volume_idx]
+        values[np.isnan(values)] = -np.inf
+        clusters, n_clusters = ndimage.label(values > sign * threshold)
+        if n_clusters == 0:
+            continue
+        cluster_ids = np.arange(1, n_clusters + 1)
+        volumes = np.bincount(clusters.ravel())[1:] * np.prod(voxel_sizes)
+        first = ndimage.minimum(first_order, clusters, cluster_ids)
+        kept = cluster_ids[volumes >= float(min_volume)]
+        kept = kept[np.argsort(first[kept - 1], kind = 'stable')]
+        new_id = np.zeros(n_clusters + 1, dtype = np.int64)
+        new_id[kept] = np.arange(start, start + len(kept))
+        start += len(kept)
+
+        ## peaks are only compared with the voxels of their own cluster
+        objects = ndimage.find_objects(clusters)
+        peaks = [np.empty((0, 3), dtype = np.int64)]
+        for cluster_id in kept:
+            box = objects[cluster_id - 1]
+            offset = np.array([s.start for s in box])
+            peaks.append(offset + cluster_peaks(values[box], clusters[box] == cluster_id,
+                                                footprint, float(volume_distance),
+                                                voxel_sizes))
+        peaks = np.vstack(peaks)
+        peak_idx = tuple(peaks.T)
+        idx = grayordinate[peak_idx]
+        coords = nib.affines.apply_affine(brain_models.affine, peaks.astype(np.float64))
+        tables.append(pd.DataFrame({
+            'clusterID': new_id[clusters[peak_idx]] if cluster_labels is None
+                         else np.asarray(cluster_labels)[idx],
+            'structure': [name.replace('CIFTI_STRUCTURE_', '') for name in brain_models.name[idx]],
+            'i': peaks[:, 0], 'j': peaks[:, 1], 'k': peaks[:, 2],
+            'x': coords[:, 0], 'y': coords[:, 1], 'z': coords[:, 2],
+            'peak_value': data[idx],
+            'cluster_volume': volumes[clusters[peak_idx] - 1]}))
+    if not tables:
+        return pd.DataFrame(columns = VOLUME_PEAK_COLUMNS)
+    df = pd.concat(tables, ignore_index = True)
+    df['abs_value'] = df.peak_value.abs()
+    df = df.sort_values(['clusterID', 'abs_value'], ascending = [True, False])
+    return df.loc[:, VOLUME_PEAK_COLUMNS].reset_index(drop = True)
+
+def cluster_peaks(values, in_cluster, footprint, distance, voxel_sizes):
+    '''
+    the peaks (n x 3 voxel indices) of one cluster (the in_cluster voxels of values),
+    starting with the maximum of the cluster; tied peaks within the distance (in mm)
+    of each other are one peak
+    '''
+    values = np.where(in_cluster, values, -np.inf)
+    maximum = np.array(ndimage.maximum_position(values))
+    peaks = sphere_maxima(values, footprint, in_cluster)
+    peaks = np.vstack((maximum, peaks[np.any(peaks != maximum, axis = 1)]))
+    ## peaks within the distance of each other have the same value
+    pairs = cKDTree(peaks * voxel_sizes).query_pairs(distance, output_type = 'ndarray')
+    tied = sparse.coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                             shape = (len(peaks), len(peaks)))
+    _, groups = csgraph.connected_components(tied, directed = False)
+    _, first = np.unique(groups, return_index = True)
+    return peaks[np.sort(first)]
+
+def sphere_maxima(values, footprint, mask):
+    '''
+    the voxels (n x 3 indices) of the mask that are the largest value within the
+    (sphere) footprint around them, like comparing values with a maximum_filter
+    of the footprint, but only checking the whole sphere around local maxima
+    '''
+    ## the local maxima within the part of the sphere inside the 3x3x3 neighbours
+    center = np.array(footprint.shape) // 2
+    near = footprint[tuple(slice(max(c - 1, 0), c + 2) for c in center)]
+    candidates = np.argwhere((values == ndimage.maximum_filter(values, footprint = near,
+                                    mode = 'constant', cval = -np.inf)) & mask)
+    if near.shape == footprint.shape:
+        return candidates
+    return candidates[[is_sphere_max(values, voxel, footprint) for voxel in candidates]]
+
+def is_sphere_max(values, voxel, footprint):
+    '''is the voxel the largest value within the (sphere) footprint around it'''
+    radius = np.array(footprint.shape) // 2
+    lower = np.maximum(voxel - radius, 0)
+    upper = np.minimum(voxel + radius + 1, values.shape)
+    window = values[tuple(slice(l, u) for l, u in zip(lower, upper))]
+    window_footprint = footprint[tuple(slice(l, u) for l, u in
+                                       zip(lower - voxel + radius, upper - voxel + radius))]
+    return window[window_footprint].max() <= values[tuple(voxel)]
+
+def sphere_footprint(distance, voxel_sizes):
+    '''the voxels within distance (in mm) of the center voxel, as a boolean array'''
+    radius = np.floor(distance / np.asarray(voxel_sizes)).astype(int)
+    grid = np.meshgrid(*[np.arange(-r, r + 1) * size
+                         for r, size in zip(radius, voxel_sizes)], indexing = 'ij')
+    return sum(axis**2 for axis in grid) <= distance**2
@@ -160,6 +160,17 @@ def find_work_dir():
             work_dir = None
     return work_dir
 
+def find_ciftify_cache():
+    """
+    Returns the path of the directory used to cache precomputed data (i.e.
+    smoothing operators). Defined by the CIFTIFY_CACHE environment variable,
+    or ~/.cache/ciftify if it is not set.
+    """
+    cache_dir = os.getenv('CIFTIFY_CACHE')
+    if not cache_dir:
+        cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'ciftify')
+    return cache_dir
+
 def wb_command_version():
     '''
     Returns version info about wb_command.
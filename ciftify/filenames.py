@@ -46,6 +46,14 @@ def surf_file(subject_id, surface, hemisphere, mesh_settings):
             mesh_settings['meshname']))
     return surface_gii
 
+def resample_weights_dir(mesh_settings):
+    '''return the folder that the resampling weights from this mesh are saved to'''
+    return os.path.join(mesh_settings['Folder'], 'resample_weights')
+
+def ribbon_weights_dir(mesh_settings):
+    '''return the folder that the ribbon weights for the surfaces of this mesh are saved to'''
+    return os.path.join(mesh_settings['Folder'], 'ribbon_weights')
+
 def label_file(subject_id, label_name, hemisphere, mesh_settings):
     '''return the formated file path to a label (surface data) file for this mesh'''
     label_gii = os.path.join(mesh_settings['tmpdir'],
@@ -159,6 +159,114 @@ def load_cifti(filename):
 
     return cifti_data
 
+def load_cifti2(filename):
+    """
+    Usage:
+        data, header = load_cifti2(filename)
+
+    Loads a Cifti-2 file with nibabel (without calling wb_command).
+
+    Returns:
+        a 2D matrix of grayordinates x maps (or timepoints),
+        and the cifti header (for the axes)
+    """
+    logger = logging.getLogger(__name__)
+
+    try:
+        cifti = nib.load(filename)
+        data = np.asanyarray(cifti.dataobj)
+    except:
+        logger.error("Cannot read {}".format(filename))
+        sys.exit(1)
+
+    if not isinstance(cifti, nib.Cifti2Image):
+        logger.error("{} is not a Cifti-2 file".format(filename))
+        sys.exit(1)
+
+    ## transpose so that grayordinates are the rows (without a copy)
+    return data.T, cifti.header
+
+def load_cifti2_proxy(filename):
+    """
+    Usage:
+        dataobj, header = load_cifti2_proxy(filename)
+
+    Loads a Cifti-2 file with nibabel without reading its data.
+
+    Returns:
+        the data proxy (maps (or timepoints) x grayordinates, only the part
+        that is sliced is read from disk), and the cifti header
+    """
+    logger = logging.getLogger(__name__)
+
+    try:
+        cifti = nib.load(filename)
+    except:
+        logger.error("Cannot read {}".format(filename))
+        sys.exit(1)
+
+    if not isinstance(cifti, nib.Cifti2Image):
+        logger.error("{} is not a Cifti-2 file".format(filename))
+        sys.exit(1)
+
+    return cifti.dataobj, cifti.header
+
+def cifti_series_step(header):
+    '''
+    returns the step (i.e. the TR) in seconds between timepoints of a
+    dtseries header, or None if the series is not in time
+    '''
+    series_axis = header.get_axis(0)
+    if not isinstance(series_axis, nib.cifti2.SeriesAxis):
+        return None
+    if series_axis.unit != 'SECOND':
+        return None
+    return float(series_axis.step)
+
+def write_cifti2_dscalar(filename, data, brain_models, map_names):
+    '''
+    writes a grayordinates x maps matrix as a Cifti-2 dscalar.nii file
+    brain_models is the BrainModelAxis of the grayordinates (i.e. from the input file)
+    '''
+    data = np.asarray(data, dtype = np.float32)
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+    scalar_axis = nib.cifti2.ScalarAxis(map_names)
+    cifti = nib.Cifti2Image(data.T, header = (scalar_axis, brain_models))
+    cifti.nifti_header.set_intent('ConnDenseScalar')
+    cifti.to_filename(filename)
+
+def write_cifti2_dtseries(filename, data, brain_models, step, start = 0):
+    '''
+    writes a grayordinates x timepoints matrix as a Cifti-2 dtseries.nii file
+    step (i.e. the TR) and start are in seconds
+    brain_models is the BrainModelAxis of the grayordinates (i.e. from the input file)
+    '''
+    series_axis = nib.cifti2.SeriesAxis(start, step, data.shape[1], 'SECOND')
+    cifti = nib.Cifti2Image(data.T, header = (series_axis, brain_models))
+    cifti.nifti_header.set_intent('ConnDenseSeries')
+    cifti.to_filename(filename)
+
+def write_cifti2_dlabel(filename, labels, brain_models, label_names = None,
+                        map_name = ''):
+    '''
+    writes a grayordinates array of integer labels as a Cifti-2 dlabel.nii file
+    labels missing from the label_names dict are named LABEL_<label> (as by
+    wb_command -cifti-label-import) and all labels are given random colors
+    '''
+    labels = np.asarray(labels).ravel()
+    label_names = label_names if label_names else {}
+    label_table = {0: ('???', (1.0, 1.0, 1.0, 0.0))}
+    for key in np.unique(labels[labels != 0]).astype(int):
+        color = np.random.RandomState(key).uniform(size = 3)
+        label_table[key] = (label_names.get(key, 'LABEL_{}'.format(key)),
+                            tuple(color) + (1.0,))
+    label_axis = nib.cifti2.LabelAxis([map_name], [label_table])
+    cifti = nib.Cifti2Image(labels[np.newaxis, :].astype(np.float32),
+                            header = (label_axis, brain_models))
+    cifti.nifti_header.set_intent('ConnDenseLabel')
+    cifti.to_filename(filename)
+
 def load_gii_data(filename, intent='NIFTI_INTENT_NORMAL'):
     """
     Usage:
@@ -203,6 +311,32 @@ def load_gii_data(filename, intent='NIFTI_INTENT_NORMAL'):
 
     return data
 
+def surf_structure(surf):
+    '''the AnatomicalStructurePrimary (i.e. CortexLeft) of a surface file, or None'''
+    surf_img = nibabel.load(surf)
+    for meta in [surf_img.get_arrays_from_intent('NIFTI_INTENT_POINTSET')[0].meta,
+                 surf_img.meta]:
+        structure = meta.metadata.get('AnatomicalStructurePrimary')
+        if structure:
+            return structure
+    return None
+
+def write_gii_data(filename, data, structure = None):
+    '''
+    writes a vertices x timepoints matrix as a gifti metric (".func.gii") file,
+    structure is the AnatomicalStructurePrimary (i.e. CortexLeft) of the surface
+    '''
+    data = np.asarray(data, dtype = np.float32)
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+    meta = {'AnatomicalStructurePrimary': structure} if structure else {}
+    gii = nib.gifti.GiftiImage(meta = nib.gifti.GiftiMetaData.from_dict(meta))
+    for column in range(data.shape[1]):
+        gii.add_gifti_data_array(nib.gifti.GiftiDataArray(
+            np.ascontiguousarray(data[:, column]), intent = 'NIFTI_INTENT_NORMAL',
+            datatype = 'NIFTI_TYPE_FLOAT32'))
+    nib.save(gii, filename)
+
 def load_surfaces(filename, suppress_echo = False):
     '''
     separate a cifti file into surfaces,
@@ -270,6 +404,11 @@ def load_surf_coords(surf):
     coords = nibabel.gifti.giftiio.read(surf).getArraysFromIntent('NIFTI_INTENT_POINTSET')[0].data
     return coords
 
+def load_surf_triangles(surf):
+    '''load the triangles (faces) from a surface file'''
+    triangles = nibabel.gifti.giftiio.read(surf).getArraysFromIntent('NIFTI_INTENT_TRIANGLE')[0].data
+    return triangles
+
 
 def load_hemisphere_labels(filename, wb_structure, map_number = 1):
     '''separates dlabel file into left and right and loads label data'''
@@ -5,10 +5,15 @@ i.e. ciftify_peaktable and ciftify_dlabel_report
 """
 
 import os
+import sys
+import hashlib
+from concurrent import futures
 from ciftify.utils import run
 import ciftify.config
+import ciftify.niio
 import numpy as np
 import pandas as pd
+from scipy.spatial import cKDTree
 import logging
 import logging.config
 
@@ -39,6 +44,118 @@ def define_atlas_settings():
     }
     return(atlas_settings)
 
+# bump this when the layout of the atlas cache changes
+ATLAS_CACHE_VERSION = '2'
+
+def atlas_cache_file(source_file, entry_name):
+    '''
+    the .npz file holding the arrays decoded from one source file (i.e. the
+    label arrays and table of a report atlas or the S1200 vertex areas), so they
+    are only separated with wb_command once
+    each entry has its own file, so reading one never reads the others
+    '''
+    prefix = '{}_{}'.format(entry_name,
+        hashlib.sha1(os.path.abspath(source_file).encode()).hexdigest()[:12])
+    return os.path.join(ciftify.config.find_ciftify_cache(), 'atlases',
+                        '{}.v{}.npz'.format(prefix, ATLAS_CACHE_VERSION))
+
+def read_atlas_cache(cache_file):
+    '''reads all the arrays in an atlas cache file, an unreadable cache is treated as empty'''
+    if not os.path.exists(cache_file):
+        return {}
+    try:
+        with np.load(cache_file) as cached:
+            return {key: cached[key] for key in cached.files}
+    except Exception as e:
+        logging.getLogger(__name__).warning('Could not read atlas cache {}: {}'
+                                            ''.format(cache_file, e))
+        return {}
+
+def write_atlas_cache(cache_file, arrays):
+    '''writes an atlas cache file (atomically), failing to write it is only a warning'''
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok = True)
+        tmp_file = '{}.{}.tmp.npz'.format(cache_file[:-len('.npz')], os.getpid())
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logging.getLogger(__name__).warning('Could not write atlas cache {}: {}'
+                                            ''.format(cache_file, e))
+
+def cached_arrays(source_file, entry_name, decode):
+    '''
+    returns the dict of arrays decoded from source_file by decode(), from its
+    atlas cache file if they were decoded after the source file was last changed
+    '''
+    cache_file = atlas_cache_file(source_file, entry_name)
+    mtime = os.path.getmtime(source_file)
+    cached = read_atlas_cache(cache_file)
+    if 'mtime' in cached and cached['mtime'] == mtime:
+        return cached
+    arrays = decode()
+    arrays['mtime'] = np.array(mtime)
+    write_atlas_cache(cache_file, arrays)
+    return arrays
+
+def compact_labels(label_data):
+    '''stores labels as int16 when they fit'''
+    label_data = np.asarray(label_data)
+    if label_data.size and np.abs(label_data).max() < np.iinfo(np.int16).max:
+        return label_data.astype(np.int16)
+    return label_data.astype(np.int32)
+
+def load_atlas_labels(atlas, wb_structure):
+    '''
+    loads the label data (for one hemisphere structure, i.e. 'CORTEX_LEFT') and
+    label dictionary of an atlas from define_atlas_settings, from the atlas cache
+    '''
+    map_number = int(atlas['map_number'])
+
+    def decode():
+        ## the atlases are separated with wb_command because not all are cifti-2
+        arrays = {}
+        for structure in ['CORTEX_LEFT', 'CORTEX_RIGHT']:
+            label_data, label_dict = ciftify.niio.load_hemisphere_labels(atlas['path'],
+                                                    structure, map_number)
+            arrays[structure] = compact_labels(label_data)
+        arrays['label_keys'] = np.array(list(label_dict.keys()), dtype = np.int32)
+        arrays['label_names'] = np.array(list(label_dict.values()), dtype = str)
+        return arrays
+
+    arrays = cached_arrays(atlas['path'], 'atlas_map{}'.format(map_number), decode)
+    label_dict = dict(zip(arrays['label_keys'].tolist(), arrays['label_names'].tolist()))
+    return arrays[wb_structure], label_dict
+
+def load_LR_atlas_labels(atlas):
+    '''
+    loads the left and right label data (stacked) and the label dictionary
+    of an atlas from define_atlas_settings, like ciftify.niio.load_LR_label
+    '''
+    label_L, label_dict = load_atlas_labels(atlas, 'CORTEX_LEFT')
+    label_R, _ = load_atlas_labels(atlas, 'CORTEX_RIGHT')
+    return np.hstack((label_L, label_R)), label_dict
+
+def load_vertex_areas(vertex_areas_file):
+    '''
+    loads a vertex areas (.shape.gii) file,
+    the S1200 group average files are read from the atlas cache
+    '''
+    s1200_dir = os.path.abspath(ciftify.config.find_HCP_S1200_GroupAvg())
+    if not os.path.abspath(vertex_areas_file).startswith(s1200_dir + os.sep):
+        return ciftify.niio.load_gii_data(vertex_areas_file)
+
+    def decode():
+        return {'areas': ciftify.niio.load_gii_data(vertex_areas_file).astype(np.float32)}
+
+    return cached_arrays(vertex_areas_file, 'vertex_areas', decode)['areas']
+
+def load_LR_vertex_areas(surf_settings):
+    ''' loads the vertex areas and stacks the dataframes'''
+    surf_va_L = load_vertex_areas(surf_settings.L.vertex_areas)
+    surf_va_R = load_vertex_areas(surf_settings.R.vertex_areas)
+    surf_va_LR = np.vstack((surf_va_L, surf_va_R))
+    return(surf_va_LR)
+
 class HemiSurfaceSettings:
     '''class that holds the setting for one hemisphere'''
     def __init__(self, hemi, arguments):
@@ -123,60 +240,171 @@ class CombinedSurfaceSettings:
                 for hemi in ['L','R']:
                     self.__dict__[hemi].calc_vertex_areas_from_surface(tmpdir)
 
-def sum_idx_area(clust_idx, surf_va):
+def define_maps(maps_arg, map_names):
     '''
-    calculates the surface area for a given set of indices
+    the (0 based) columns of the maps to report on, from a comma separated list of
+    map numbers (starting at 1) or map names, all maps if no list is given
     '''
-    area = sum(surf_va[clust_idx])
-    return(area)
+    if not maps_arg:
+        return list(range(len(map_names)))
+    maps = []
+    for map_id in maps_arg.split(','):
+        map_id = map_id.strip()
+        if map_id in map_names:
+            maps.append(map_names.index(map_id))
+        elif map_id.isdigit() and 1 <= int(map_id) <= len(map_names):
+            maps.append(int(map_id) - 1)
+        else:
+            logger = logging.getLogger(__name__)
+            logger.error('Map "{}" of --maps not found in the input, which has {} maps: {}'.format(
+                map_id, len(map_names), ', '.join(map_names)))
+            sys.exit(1)
+    return maps
+
+## the settings shared by the map jobs of a worker process, see run_map_jobs
+MAP_SETTINGS = None
 
-def get_cluster_indices(cluster_id, clust_altas):
+def init_map_worker(settings):
+    '''gives each worker process the shared settings once (not with every map)'''
+    global MAP_SETTINGS
+    MAP_SETTINGS = settings
+
+def run_map_job(map_job):
+    map_function, map_data, outputbase = map_job
+    return map_function(map_data, outputbase, MAP_SETTINGS)
+
+def run_map_jobs(map_function, map_jobs, settings, n_cpus):
     '''
-    gets the indices for a cluster given the label
+    calls map_function(map_data, outputbase, settings) for every (map_data, outputbase)
+    of map_jobs, in a pool of up to n_cpus processes
+    returns the results in the order of map_jobs
     '''
-    clust_idx = np.where(clust_altas == cluster_id)[0]
-    return(clust_idx)
-
-def get_overlaping_idx(clust_id1, clust_atlas1, clust_id2, clust_atlas2):
+    n_workers = min(max(1, int(n_cpus)), len(map_jobs))
+    if n_workers == 1:
+        return [map_function(map_data, outputbase, settings)
+                for map_data, outputbase in map_jobs]
+    logger = logging.getLogger(__name__)
+    logger.info('Running {} maps with {} processes'.format(len(map_jobs), n_workers))
+    with futures.ProcessPoolExecutor(max_workers = n_workers,
+                                     initializer = init_map_worker,
+                                     initargs = (settings,)) as executor:
+        return list(executor.map(run_map_job,
+            [(map_function, map_data, outputbase) for map_data, outputbase in map_jobs]))
+
+def write_long_table(outputcsv, maps, map_names, all_tables):
     '''
-    find the indices that overlap for two labels across two maps
+    writes the tables of every map as one long table, with map_number and map_name
+    columns, all_tables holds a list of (extra columns dict, table) for each map
     '''
-    label1_idx = get_cluster_indices(int(clust_id1), clust_atlas1)
-    label2_idx = get_cluster_indices(int(clust_id2), clust_atlas2)
-    overlap_idx = np.intersect1d(label1_idx,label2_idx)
-    return(overlap_idx)
-
-def calc_cluster_area(cluster_id, atlas_array, surf_va_array):
+    dfs = []
+    for map_idx, tables in zip(maps, all_tables):
+        for extra_columns, df in tables:
+            df = df.copy()
+            for column, value in reversed(list(extra_columns.items())):
+                df.insert(0, column, value)
+            df.insert(0, 'map_name', map_names[map_idx])
+            df.insert(0, 'map_number', map_idx + 1)
+            dfs.append(df)
+    pd.concat(dfs).to_csv(outputcsv, index = False)
+
+def calc_label_areas(label_data, surf_va_array):
     '''
-    calculate the area of a cluster
+    calculate the area of every label in a label array in one pass
+    returns a pd.Series of areas indexed by the label ids
     '''
-    clust_idx = get_cluster_indices(int(cluster_id), atlas_array)
-    area = sum_idx_area(clust_idx, surf_va_array)
-    return(area)
+    label_ids, label_idx = np.unique(np.asarray(label_data).ravel().astype(np.int64),
+                                     return_inverse = True)
+    areas = np.bincount(label_idx, weights = np.asarray(surf_va_array).ravel(),
+                        minlength = len(label_ids))
+    return(pd.Series(areas, index = label_ids))
 
-def calc_overlapping_area(clust_id1, clust_atlas1, clust_id2, clust_atlas2, surf_va_array):
+def calc_overlap_matrix(clust_atlas1_data, clust_atlas2_data, surf_va_array):
     '''
-    calculates the area of overlap between two clusters
+    calculates the area of overlap between every label of one map and every label of
+    another (a contingency table weighted by vertex area) with one np.bincount
+    over the combined label codes
+    returns a pd.DataFrame with the map 1 labels as rows and map 2 labels as columns
     '''
-    overlap_idx = get_overlaping_idx(clust_id1, clust_atlas1, clust_id2, clust_atlas2)
-
-    if len(overlap_idx) > 0:
-        overlap_area = sum_idx_area(overlap_idx, surf_va_array)
-    else:
-        overlap_area = 0
-
-    return(overlap_area)
-
-def calc_label_to_atlas_overlap(clust_id1, clust_atlas1_data,
-                                clust_atlas2_dict, clust_atlas2, surf_va_array):
-    '''create a df of overlap of and atlas with one label'''
+    labels1, idx1 = np.unique(np.asarray(clust_atlas1_data).ravel().astype(np.int64),
+                              return_inverse = True)
+    labels2, idx2 = np.unique(np.asarray(clust_atlas2_data).ravel().astype(np.int64),
+                              return_inverse = True)
+    overlap = np.bincount(idx1 * len(labels2) + idx2,
+                          weights = np.asarray(surf_va_array).ravel(),
+                          minlength = len(labels1) * len(labels2))
+    return(pd.DataFrame(overlap.reshape(len(labels1), len(labels2)),
+                        index = labels1, columns = labels2))
+
+def calc_peak_overlaps(clust_ids, atlas_ids, clust_atlas1_data, clust_atlas2_data,
+                       surf_va_array):
+    '''
+    the fraction of the area of each cluster (clust_ids) that overlaps with one label
+    of another map (atlas_ids, i.e. the atlas label at the cluster's peak),
+    all looked up in one overlap matrix
+    '''
+    overlap_matrix = calc_overlap_matrix(clust_atlas1_data, clust_atlas2_data, surf_va_array)
+    rows = overlap_matrix.index.get_indexer(np.asarray(clust_ids, dtype = np.int64))
+    cols = overlap_matrix.columns.get_indexer(np.asarray(atlas_ids, dtype = np.int64))
+    found = (rows >= 0) & (cols >= 0)
+    overlap_area = np.where(found, overlap_matrix.values[rows, cols], 0.0)
+    clust_area = np.where(rows >= 0, overlap_matrix.values.sum(axis = 1)[rows], 0.0)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return(overlap_area / clust_area)
+
+class NearestLabelTree:
+    '''a KD-tree of the labelled (label > 0) vertices of an atlas on a surface'''
+    def __init__(self, coords, label_data):
+        label_data = np.asarray(label_data).ravel()
+        labelled = np.flatnonzero(label_data > 0)
+        self.labels = label_data[labelled]
+        self.tree = cKDTree(np.asarray(coords)[labelled]) if len(labelled) else None
+
+    def query(self, points):
+        '''the label of, and distance (in mm) to, the nearest labelled vertex of each point'''
+        points = np.asarray(points, dtype = np.float64).reshape(-1, 3)
+        if self.tree is None:
+            return np.zeros(len(points), dtype = np.int64), np.full(len(points), np.inf)
+        distances, idx = self.tree.query(points)
+        return self.labels[idx], distances
+
+## the KD-trees built by find_nearest_labels, by (surface, structure, atlas name)
+NEAREST_LABEL_TREES = {}
+
+def find_nearest_labels(points, surface, wb_structure, atlas_name, atlas_label_array):
+    '''
+    finds the nearest labelled vertex of an atlas to every point in one query,
+    the KD-tree of each surface and atlas is only built once
+    returns the labels and distances (in mm)
+    '''
+    key = (surface, wb_structure, atlas_name)
+    if key not in NEAREST_LABEL_TREES:
+        NEAREST_LABEL_TREES[key] = NearestLabelTree(ciftify.niio.load_surf_coords(surface),
+                                                    atlas_label_array)
+    return NEAREST_LABEL_TREES[key].query(points)
+
+def calc_nearest_labels(df, surface, wb_structure,
+                        atlas_prefix, atlas_label_array, atlas_dict):
+    '''
+    the nearest labelled vertex of the atlas to each peak (the label at the peak
+    unless it is unlabelled) and its distance in mm, needs hemisphere specific inputs
+    '''
+    nearest_labels, distances = find_nearest_labels(
+        df[['x', 'y', 'z']].values, surface, wb_structure, atlas_prefix, atlas_label_array)
+    df['{}_nearest'.format(atlas_prefix)] = [atlas_dict.get(label, '') for label in nearest_labels]
+    df['{}_nearest_mm'.format(atlas_prefix)] = distances
+    return(df)
+
+def calc_label_to_atlas_overlap(clust_id1, overlap_matrix, clust_atlas2_dict):
+    '''create a df of overlap of and atlas with one label, from the overlap matrix'''
     ## create a data frame to hold the overlap
     o_df = pd.DataFrame.from_dict(clust_atlas2_dict, orient = "index")
     o_df = o_df.rename(index=str, columns={0: "clusterID"})
-
-    for idx_label2 in o_df.index.get_values():
-        o_df.loc[idx_label2, 'overlap_area'] = calc_overlapping_area(clust_id1, clust_atlas1_data,
-                                                        idx_label2, clust_atlas2, surf_va_array)
+    if int(clust_id1) in overlap_matrix.index:
+        label_overlap = overlap_matrix.loc[int(clust_id1)]
+    else:
+        label_overlap = pd.Series(dtype = np.float64)
+    o_df['overlap_area'] = [label_overlap.get(int(idx_label2), 0.0)
+                            for idx_label2 in o_df.index]
     return(o_df)
 
 def overlap_summary_string(overlap_df, min_percent_overlap):
@@ -184,23 +412,19 @@ def overlap_summary_string(overlap_df, min_percent_overlap):
     rdf = overlap_df[overlap_df.overlap_percent > min_percent_overlap]
     rdf = rdf.sort_values(by='overlap_percent', ascending=False)
     result_string = ""
-    for o_label in rdf.index.get_values():
+    for o_label in rdf.index:
         result_string += '{} ({:2.1f}%); '.format(rdf.loc[o_label, 'clusterID'],
                                                   rdf.loc[o_label, 'overlap_percent'])
     return(result_string)
 
-
-def get_label_overlap_summary(clust_id1, clust_atlas1_data, clust_atlas2_data, clust_atlas2_dict,
-                              surf_va_array, min_percent_overlap = 5):
-    '''returns of sting listing all clusters in label2 that overlap with label1_idx in label1'''
-
-    label1_area = calc_cluster_area(clust_id1, clust_atlas1_data, surf_va_array)
+def label_overlap_summary(clust_id1, overlap_matrix, label1_area, clust_atlas2_dict,
+                          min_percent_overlap = 5):
+    '''the overlap string for one label, from the overlap matrix and the label's area'''
     if label1_area == 0:
         return("")
 
     ## get a pd dataframe of labels names and overlap
-    overlap_df = calc_label_to_atlas_overlap(clust_id1, clust_atlas1_data,
-                                             clust_atlas2_dict, clust_atlas2_data, surf_va_array)
+    overlap_df = calc_label_to_atlas_overlap(clust_id1, overlap_matrix, clust_atlas2_dict)
 
     if overlap_df.overlap_area.sum() == 0:
         return("")
@@ -209,6 +433,24 @@ def get_label_overlap_summary(clust_id1, clust_atlas1_data, clust_atlas2_data, c
     overlap_df.loc[:, 'overlap_percent'] = overlap_df.loc[:, 'overlap_area']/label1_area*100
 
     ## convert the df to a string report
-    result_string = overlap_summary_string(overlap_df, min_percent_overlap)
+    return(overlap_summary_string(overlap_df, min_percent_overlap))
 
-    return(result_string)
+def get_label_overlap_summaries(clust_ids, clust_atlas1_data, clust_atlas2_data,
+                                clust_atlas2_dict, surf_va_array, min_percent_overlap = 5):
+    '''
+    returns a list of strings (one per label in clust_ids) listing all clusters in
+    atlas 2 that overlap with that label of atlas 1, all from one overlap matrix
+    '''
+    overlap_matrix = calc_overlap_matrix(clust_atlas1_data, clust_atlas2_data, surf_va_array)
+    label1_areas = overlap_matrix.sum(axis = 1)
+    return([label_overlap_summary(clust_id1, overlap_matrix,
+                                  label1_areas.get(int(clust_id1), 0),
+                                  clust_atlas2_dict, min_percent_overlap)
+            for clust_id1 in clust_ids])
+
+def get_label_overlap_summary(clust_id1, clust_atlas1_data, clust_atlas2_data, clust_atlas2_dict,
+                              surf_va_array, min_percent_overlap = 5):
+    '''returns of sting listing all clusters in label2 that overlap with label1_idx in label1'''
+    return(get_label_overlap_summaries([clust_id1], clust_atlas1_data, clust_atlas2_data,
+                                       clust_atlas2_dict, surf_va_array,
+                                       min_percent_overlap)[0])
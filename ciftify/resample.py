@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Resampling of surface (metric) data between spheres (like wb_command
+-metric-resample ADAP_BARY_AREA) as a sparse matrix product.
+
+The resampling weights only depend on the two spheres, the two area surfaces
+and the roi, so they are built once (as a sparse new vertices x current vertices
+matrix), saved (i.e. in the subject's folder) and reused for every map and every
+fMRI run that is resampled with the same inputs.
+"""
+
+import os
+import logging
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+import nibabel as nib
+
+import ciftify.config
+import ciftify.niio
+import ciftify.smoothing
+import ciftify.surface
+import ciftify.utils
+
+# bump this when the way weights are built changes, so old cache files are not used
+WEIGHTS_VERSION = '1'
+# the number of nearest vertices whose triangles are searched for points that
+# are not in a triangle next to their nearest vertex
+NEAREST_VERTICES = 8
+# the number of points looked up at once
+POINTS_PER_CHUNK = 20000
+
+logger = logging.getLogger(__name__)
+
+def resampling_weights(current_sphere, new_sphere, current_area_surf, new_area_surf,
+                       current_roi = None, cache_dir = None, use_cache = True):
+    '''
+    returns the sparse (new vertices x current vertices) ADAP_BARY_AREA resampling
+    weights, from the cache_dir (by default the ciftify cache) if they have been
+    built before for the same spheres, area surfaces and roi
+    '''
+    roi_mask = None
+    if current_roi is not None:
+        roi_mask = ciftify.niio.load_gii_data(current_roi)[:, 0] > 0
+    if cache_dir is None:
+        cache_dir = os.path.join(ciftify.config.find_ciftify_cache(), 'resample')
+    cache_file = None
+    if use_cache:
+        cache_file = weights_cache_file(cache_dir, [current_sphere, new_sphere,
+                current_area_surf, new_area_surf], roi_mask)
+    return ciftify.utils.cached_sparse_matrix(cache_file,
+        lambda: build_resampling_weights(current_sphere, new_sphere,
+                current_area_surf, new_area_surf, roi_mask))
+
+def build_resampling_weights(current_sphere, new_sphere, current_area_surf,
+                             new_area_surf, roi_mask = None):
+    '''builds the ADAP_BARY_AREA resampling weights from the surface files'''
+    current_areas = ciftify.surface.vertex_areas(
+        ciftify.niio.load_surf_coords(current_area_surf),
+        ciftify.niio.load_surf_triangles(current_area_surf))
+    new_areas = ciftify.surface.vertex_areas(
+        ciftify.niio.load_surf_coords(new_area_surf),
+        ciftify.niio.load_surf_triangles(new_area_surf))
+    return adap_bary_area_weights(
+        ciftify.niio.load_surf_coords(current_sphere),
+        ciftify.niio.load_surf_triangles(current_sphere),
+        ciftify.niio.load_surf_coords(new_sphere),
+        ciftify.niio.load_surf_triangles(new_sphere),
+        current_areas, new_areas, roi_mask)
+
+def weights_cache_file(cache_dir, input_files, roi_mask):
+    '''the cache file for resampling weights, named by a hash of their inputs'''
+    extras = ['version{}'.format(WEIGHTS_VERSION)]
+    if roi_mask is not None:
+        extras.append(np.packbits(roi_mask).tobytes())
+    return ciftify.utils.hashed_cache_file(cache_dir, 'adap_bary_area', input_files,
+                                           *extras)
+
+def triangle_weights(points, triangles, coords):
+    '''
+    the barycentric weights (points x candidate triangles x 3) of each point in
+    each of its candidate triangles (points x candidate triangles), after projecting
+    the point onto the triangle from the centre of the sphere
+    '''
+    corners = coords[triangles]
+    ## solve point = w0 * a + w1 * b + w2 * c, the scale is removed after
+    solved = np.linalg.solve(np.swapaxes(corners, -1, -2),
+                             np.broadcast_to(points[:, np.newaxis, :, np.newaxis],
+                                             corners.shape[:2] + (3, 1)))[..., 0]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        weights = solved / solved.sum(axis = -1, keepdims = True)
+    ## points behind the centre of the sphere are never in the triangle
+    weights[~(solved.sum(axis = -1) > 0)] = -np.inf
+    return weights
+
+def best_triangles(points, candidates, coords, triangles):
+    '''
+    from the candidate triangles (points x candidates, -1 for none) of each point,
+    finds the one that contains it (or is closest to containing it)
+    returns the triangle and barycentric weights of each point
+    '''
+    valid = candidates >= 0
+    tris = triangles[np.where(valid, candidates, 0)]
+    weights = triangle_weights(points, tris, coords)
+    smallest = weights.min(axis = -1)
+    smallest[~valid] = -np.inf
+    best = np.argmax(smallest, axis = 1)
+    rows = np.arange(points.shape[0])
+    return (tris[rows, best], weights[rows, best], smallest[rows, best])
+
+def barycentric_weights(coords, triangles, points):
+    '''
+    the sparse (points x vertices) barycentric weights of points on a sphere
+    (coords and triangles), like wb_command BARYCENTRIC resampling
+    '''
+    coords = np.asarray(coords, dtype = np.float64)
+    points = np.asarray(points, dtype = np.float64)
+    triangles = np.asarray(triangles, dtype = np.int64)
+    ## both spheres are centred, the radius does not matter
+    coords = coords / np.linalg.norm(coords, axis = 1, keepdims = True)
+    points = points / np.linalg.norm(points, axis = 1, keepdims = True)
+    around = ciftify.surface.vertex_triangles(triangles, coords.shape[0])
+    tree = cKDTree(coords)
+
+    corners, weights = [], []
+    for chunk in np.array_split(np.arange(points.shape[0]),
+                                max(1, int(np.ceil(points.shape[0] / POINTS_PER_CHUNK)))):
+        chunk_points = points[chunk]
+        _, nearest = tree.query(chunk_points)
+        tris, tri_weights, smallest = best_triangles(chunk_points, around[nearest],
+                                                     coords, triangles)
+        ## look further for points outside of the triangles around their nearest vertex
+        outside = np.flatnonzero(smallest < -1e-6)
+        if len(outside):
+            _, nearest = tree.query(chunk_points[outside],
+                                    k = min(NEAREST_VERTICES, coords.shape[0]))
+            candidates = around[nearest.reshape(len(outside), -1)].reshape(len(outside), -1)
+            tris[outside], tri_weights[outside], _ = best_triangles(
+                chunk_points[outside], candidates, coords, triangles)
+        ## points just outside of their closest triangle are moved onto its edge
+        tri_weights = np.clip(tri_weights, 0, None)
+        tri_weights = tri_weights / tri_weights.sum(axis = 1, keepdims = True)
+        corners.append(tris)
+        weights.append(tri_weights)
+
+    corners, weights = np.concatenate(corners), np.concatenate(weights)
+    rows = np.repeat(np.arange(points.shape[0]), 3)
+    bary = sparse.csr_matrix((weights.ravel(), (rows, corners.ravel())),
+                             shape = (points.shape[0], coords.shape[0]))
+    bary.eliminate_zeros()
+    return bary
+
+def adap_bary_area_weights(current_coords, current_triangles, new_coords,
+                           new_triangles, current_areas, new_areas, roi_mask = None):
+    '''
+    builds the sparse (new vertices x current vertices) adaptive barycentric
+    area weights, like wb_command -metric-resample ADAP_BARY_AREA
+
+    Each new vertex gathers from the current vertices either with its own
+    barycentric weights (forward) or with the weights of the current vertices
+    that fall around it (reverse), whichever uses more current vertices in the roi
+    (i.e. reverse when downsampling). The weights are then corrected by the vertex
+    areas of the area surfaces, so that each current vertex contributes by its area.
+    '''
+    forward = barycentric_weights(current_coords, current_triangles, new_coords)
+    reverse = barycentric_weights(new_coords, new_triangles, current_coords).T.tocsr()
+    ## like workbench, the vertices outside the roi are dropped before choosing
+    if roi_mask is not None:
+        in_roi = sparse.diags(np.asarray(roi_mask, dtype = np.float64))
+        forward, reverse = forward.dot(in_roi).tocsr(), reverse.dot(in_roi).tocsr()
+        forward.eliminate_zeros()
+        reverse.eliminate_zeros()
+    use_reverse = np.diff(forward.indptr) < np.diff(reverse.indptr)
+    adaptive = (sparse.diags((~use_reverse).astype(np.float64)).dot(forward) +
+                sparse.diags(use_reverse.astype(np.float64)).dot(reverse)).tocsr()
+
+    ## scatter the area of every current vertex over the new vertices, by new vertex area
+    adaptive = sparse.diags(np.asarray(new_areas, dtype = np.float64)).dot(adaptive).tocsc()
+    scatter_sums = np.asarray(adaptive.sum(axis = 0)).ravel()
+    scale = np.zeros(scatter_sums.shape)
+    scale[scatter_sums > 0] = (np.asarray(current_areas)[scatter_sums > 0] /
+                               scatter_sums[scatter_sums > 0])
+    adaptive = adaptive.dot(sparse.diags(scale)).tocsr()
+    adaptive.eliminate_zeros()
+    return ciftify.smoothing.normalize_rows(adaptive)
+
+def resample_gii_file(input_gii, output_gii, weights, new_roi = None, n_cpus = 1):
+    '''
+    resamples every map of a gifti metric file with the resampling weights,
+    keeping the metadata and map names of the input
+    vertices outside of the new_roi (a metric file) are set to zero
+    '''
+    input_img = nib.load(input_gii)
+    data = np.column_stack([darray.data for darray in input_img.darrays])
+    resampled = ciftify.smoothing.apply_operator(weights, data, n_cpus)
+    if new_roi is not None:
+        resampled[ciftify.niio.load_gii_data(new_roi)[:, 0] <= 0, :] = 0
+    output_img = nib.gifti.GiftiImage(meta = input_img.meta)
+    for i, darray in enumerate(input_img.darrays):
+        output_img.add_gifti_data_array(nib.gifti.GiftiDataArray(
+            resampled[:, i].astype(darray.data.dtype), intent = darray.intent,
+            datatype = darray.datatype, meta = darray.meta))
+    nib.save(output_img, output_gii)
+
+def mask_gii_file(input_gii, roi, output_gii = None):
+    '''sets the vertices of a gifti metric file outside of the roi to zero (in place by default)'''
+    gii = nib.load(input_gii)
+    outside = ciftify.niio.load_gii_data(roi)[:, 0] <= 0
+    for darray in gii.darrays:
+        data = np.array(darray.data)
+        data[outside] = 0
+        darray.data = data
+    nib.save(gii, output_gii if output_gii else input_gii)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Ribbon constrained volume to surface mapping (like wb_command
+-volume-to-surface-mapping -ribbon-constrained) as a sparse matrix product.
+
+The weight of each voxel for a vertex only depends on the white and pial
+surfaces and on the volume geometry, so the sparse (vertices x voxels) weights
+are built once, saved (i.e. in the subject's folder) and reused for every
+volume (and every TR) that is mapped with the same surfaces and volume space.
+"""
+
+import logging
+import numpy as np
+from scipy import sparse
+from concurrent.futures import ThreadPoolExecutor
+import nibabel as nib
+
+import ciftify.niio
+import ciftify.smoothing
+import ciftify.surface
+import ciftify.utils
+
+# voxels are split into this many parts along each axis to estimate how
+# much of them is inside a vertex's polyhedron (wb_command -voxel-subdiv default)
+VOXEL_SUBDIVISIONS = 3
+# bump this when the way the weights are built changes, so old cache files are not used
+WEIGHTS_VERSION = '1'
+# the (about) number of voxel sample points tested at once
+POINTS_PER_CHUNK = 250000
+# a small shear of the coordinates, so the rays cast to test if a point is inside a
+# polyhedron (along z) are never parallel to the surfaces or the voxel grid
+RAY_SHEAR = (np.sqrt(2) * 1e-3, np.sqrt(3) * 1e-3)
+
+logger = logging.getLogger(__name__)
+
+def ribbon_weights(white_surf, pial_surf, vol_shape, affine, cache_dir = None,
+                   use_cache = True, n_cpus = 1):
+    '''
+    returns the sparse (vertices x voxels) ribbon weights, the fraction of each
+    voxel inside of each vertex's polyhedron between the white and pial surfaces,
+    from the cache_dir if they have been built before for these surfaces and volume
+    space (without a cache_dir they are built every time)
+    voxels are numbered as in the flattened (C order) volume
+    '''
+    vol_shape = tuple(int(dim) for dim in vol_shape[:3])
+    cache_file = None
+    if use_cache and cache_dir is not None:
+        cache_file = weights_cache_file(cache_dir, white_surf, pial_surf, vol_shape, affine)
+    return ciftify.utils.cached_sparse_matrix(cache_file,
+        lambda: build_ribbon_weights(
+            ciftify.niio.load_surf_coords(white_surf),
+            ciftify.niio.load_surf_coords(pial_surf),
+            ciftify.niio.load_surf_triangles(white_surf),
+            vol_shape, affine, n_cpus = n_cpus))
+
+def weights_cache_file(cache_dir, white_surf, pial_surf, vol_shape, affine):
+    '''the cache file for the ribbon weights, named by a hash of their inputs'''
+    return ciftify.utils.hashed_cache_file(cache_dir, 'ribbon', [white_surf, pial_surf],
+        'shape{}'.format(vol_shape), np.asarray(affine, dtype = np.float64).tobytes(),
+        'subdiv{}version{}'.format(VOXEL_SUBDIVISIONS, WEIGHTS_VERSION))
+
+def polyhedron_faces(vertices, inner, outer, triangles, around):
+    '''
+    the faces (number of vertices x faces x 3 corners x xyz) of the polyhedron of
+    each vertex: the triangles around the vertex on the inner and outer surface
+    and the sides between the two, padded with (never hit) points
+
+    Like workbench's ribbon mapping, the polyhedron is the whole ring of triangles
+    around the vertex, so the polyhedra of neighbouring vertices overlap.
+    '''
+    tris = around[vertices]
+    valid = tris >= 0
+    corners = triangles[np.where(valid, tris, 0)]
+    ## rotate the corners so that the vertex is first, keeping the orientation
+    first = np.argmax(corners == vertices[:, np.newaxis, np.newaxis], axis = 2)
+    rotate = (first[:, :, np.newaxis] + np.arange(3)) % 3
+    corners = np.take_along_axis(corners, rotate, axis = 2)
+    v, p, q = corners[:, :, 0], corners[:, :, 1], corners[:, :, 2]
+
+    faces = np.stack((
+        np.stack((inner[v], inner[q], inner[p]), axis = 2),
+        np.stack((outer[v], outer[p], outer[q]), axis = 2),
+        np.stack((inner[p], inner[q], outer[q]), axis = 2),
+        np.stack((inner[p], outer[q], outer[p]), axis = 2)), axis = 2)
+    faces[~valid] = 0
+    return faces.reshape(len(vertices), -1, 3, 3)
+
+def face_coefficients(faces):
+    '''
+    the coefficients for testing if an upwards (+z) ray crosses each face: the
+    three edge functions (A*y - B*x + C) and the z of the three corners
+    '''
+    a = faces
+    b = np.roll(faces, -1, axis = -2)
+    A = b[..., 0] - a[..., 0]
+    B = b[..., 1] - a[..., 1]
+    C = B * a[..., 0] - A * a[..., 1]
+    ## the edge opposite each corner gives that corner's barycentric weight
+    z = np.roll(faces[..., 2], -1, axis = -1)
+    return np.concatenate((A, B, C, z), axis = -1)
+
+def count_crossings(points, coefficients, owner):
+    '''
+    the parity of the number of faces crossed by an upwards ray from each point,
+    a point is inside a closed polyhedron if its ray crosses an odd number of faces
+    coefficients are the face_coefficients of the polyhedra, owner is the
+    polyhedron of each point
+    '''
+    inside = np.zeros(points.shape[0], dtype = bool)
+    x, y, z = points[:, 0], points[:, 1], points[:, 2]
+    for face in range(coefficients.shape[1]):
+        coef = coefficients[:, face, :][owner]
+        w0 = coef[:, 0] * y - coef[:, 3] * x + coef[:, 6]
+        w1 = coef[:, 1] * y - coef[:, 4] * x + coef[:, 7]
+        w2 = coef[:, 2] * y - coef[:, 5] * x + coef[:, 8]
+        area = w0 + w1 + w2
+        ## strictly inside the triangle (seen from above), degenerate faces never are
+        within = (((w0 > 0) & (w1 > 0) & (w2 > 0)) |
+                  ((w0 < 0) & (w1 < 0) & (w2 < 0)))
+        ## and the triangle is above the point
+        above = (w0 * coef[:, 9] + w1 * coef[:, 10] + w2 * coef[:, 11] - z * area) * area > 0
+        inside ^= within & above
+    return inside
+
+def shear(coords):
+    '''applies the RAY_SHEAR to an array of xyz coordinates'''
+    sheared = np.array(coords, dtype = np.float64)
+    sheared[..., 0] -= RAY_SHEAR[0] * sheared[..., 2]
+    sheared[..., 1] -= RAY_SHEAR[1] * sheared[..., 2]
+    return sheared
+
+def vertex_voxel_bounds(inner, outer, triangles, vol_shape, affine):
+    '''
+    the first and last voxel (i,j,k) that can touch the polyhedron of each vertex,
+    from the bounding box of the triangles around the vertex on both surfaces
+    '''
+    inv_affine = np.linalg.inv(affine)
+    n_vertices = inner.shape[0]
+    lo = np.full((n_vertices, 3), np.inf)
+    hi = np.full((n_vertices, 3), -np.inf)
+    for coords in [inner, outer]:
+        ijk = nib.affines.apply_affine(inv_affine, coords)
+        tri_lo = ijk[triangles].min(axis = 1)
+        tri_hi = ijk[triangles].max(axis = 1)
+        for corner in range(3):
+            np.minimum.at(lo, triangles[:, corner], tri_lo)
+            np.maximum.at(hi, triangles[:, corner], tri_hi)
+    ## voxel v covers v - 0.5 to v + 0.5
+    first = np.maximum(np.ceil(lo - 0.5), 0)
+    last = np.minimum(np.floor(hi + 0.5), np.array(vol_shape) - 1)
+    unused = ~np.isfinite(lo).all(axis = 1)
+    first[unused], last[unused] = 0, -1
+    return first.astype(np.int64), last.astype(np.int64)
+
+def voxel_offsets(affine, subdivisions):
+    '''the world space offsets of the sample points of a voxel from its centre'''
+    steps = (np.arange(subdivisions) + 0.5) / subdivisions - 0.5
+    grid = np.stack(np.meshgrid(steps, steps, steps, indexing = 'ij'), axis = -1)
+    return grid.reshape(-1, 3).dot(np.asarray(affine)[:3, :3].T)
+
+def chunk_weights(vertices, first, last, inner, outer, triangles, around,
+                  vol_shape, affine, offsets):
+    '''the (vertex, voxel, weight) of every voxel touching the polyhedra of some vertices'''
+    extent = np.maximum(last[vertices] - first[vertices] + 1, 0)
+    n_voxels = extent.prod(axis = 1)
+    keep = n_voxels > 0
+    vertices, extent, n_voxels = vertices[keep], extent[keep], n_voxels[keep]
+    if not len(vertices):
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64), np.zeros(0)
+
+    ## every candidate voxel of every vertex
+    owner = np.repeat(np.arange(len(vertices)), n_voxels)
+    starts = np.concatenate(([0], np.cumsum(n_voxels)[:-1]))
+    idx = np.arange(n_voxels.sum()) - starts[owner]
+    ext = extent[owner]
+    voxels = first[vertices][owner] + np.column_stack((
+        idx // (ext[:, 1] * ext[:, 2]), (idx // ext[:, 2]) % ext[:, 1], idx % ext[:, 2]))
+
+    ## the sample points in each voxel, tested against the polyhedron of its vertex
+    centres = nib.affines.apply_affine(affine, voxels)
+    n_samples = offsets.shape[0]
+    points = shear((centres[:, np.newaxis, :] + offsets).reshape(-1, 3))
+    coefficients = face_coefficients(shear(polyhedron_faces(vertices, inner, outer,
+                                                            triangles, around)))
+    inside = count_crossings(points, coefficients, np.repeat(owner, n_samples))
+    weights = inside.reshape(-1, n_samples).sum(axis = 1) / float(n_samples)
+
+    touched = weights > 0
+    return (vertices[owner[touched]],
+            np.ravel_multi_index(tuple(voxels[touched].T), vol_shape),
+            weights[touched])
+
+def build_ribbon_weights(inner, outer, triangles, vol_shape, affine,
+                         subdivisions = VOXEL_SUBDIVISIONS, n_cpus = 1):
+    '''
+    builds the sparse (vertices x voxels) ribbon weights, the fraction of each voxel
+    (estimated from subdivisions^3 points) inside of the polyhedron of each vertex
+    '''
+    inner = np.asarray(inner, dtype = np.float64)
+    outer = np.asarray(outer, dtype = np.float64)
+    triangles = np.asarray(triangles, dtype = np.int64)
+    vol_shape = tuple(int(dim) for dim in vol_shape[:3])
+    n_vertices = inner.shape[0]
+    around = ciftify.surface.vertex_triangles(triangles, n_vertices)
+    first, last = vertex_voxel_bounds(inner, outer, triangles, vol_shape, affine)
+    offsets = voxel_offsets(affine, subdivisions)
+
+    ## split the vertices into chunks of about POINTS_PER_CHUNK sample points
+    n_points = np.maximum(last - first + 1, 0).prod(axis = 1) * offsets.shape[0]
+    chunk_ids = np.cumsum(n_points) // POINTS_PER_CHUNK
+    chunks = np.split(np.arange(n_vertices), np.flatnonzero(np.diff(chunk_ids)) + 1)
+
+    def weigh_chunk(chunk):
+        return chunk_weights(chunk, first, last, inner, outer, triangles, around,
+                             vol_shape, affine, offsets)
+
+    if n_cpus > 1:
+        with ThreadPoolExecutor(max_workers = n_cpus) as executor:
+            results = list(executor.map(weigh_chunk, chunks))
+    else:
+        results = [weigh_chunk(chunk) for chunk in chunks]
+
+    rows, cols, weights = (np.concatenate(parts) for parts in zip(*results))
+    return sparse.csr_matrix((weights, (rows, cols)),
+                             shape = (n_vertices, int(np.prod(vol_shape))))
+
+def map_volume(vol_data, weights, roi_data = None):
+    '''
+    maps a volume (i,j,k or i,j,k,t array) to the surface with the ribbon weights,
+    each vertex is the weighted mean of its voxels (only voxels in the roi are used)
+    returns a vertices x maps array
+    '''
+    vol_data = np.asanyarray(vol_data)
+    n_maps = int(np.prod(vol_data.shape[3:]))
+    if roi_data is not None:
+        roi = np.asarray(roi_data).reshape(-1) > 0
+        weights = weights.dot(sparse.diags(roi.astype(np.float64))).tocsr()
+        weights.eliminate_zeros()
+    weights = ciftify.smoothing.normalize_rows(weights)
+    ## only the voxels that are mapped are read out of the volume
+    voxels = np.unique(weights.indices)
+    flat_data = vol_data.reshape(-1, n_maps)[voxels].astype(np.float32)
+    return np.asarray(weights[:, voxels].dot(flat_data), dtype = np.float32)
+
+def map_volume_to_surface(volume, white_surf, pial_surf, volume_roi = None,
+                          cache_dir = None, n_cpus = 1):
+    '''
+    maps a nifti volume (3D or 4D) to the vertices of the white and pial surfaces
+    (like wb_command -volume-to-surface-mapping -ribbon-constrained -volume-roi),
+    the ribbon weights are saved to (and read from) the cache_dir
+    returns a vertices x maps array
+    '''
+    vol_img = nib.load(volume)
+    weights = ribbon_weights(white_surf, pial_surf, vol_img.shape, vol_img.affine,
+                             cache_dir = cache_dir, n_cpus = n_cpus)
+    roi_data = None
+    if volume_roi:
+        roi_img = nib.load(volume_roi)
+        if roi_img.shape[:3] != vol_img.shape[:3]:
+            raise ValueError('Volume roi {} does not match the dimensions of {}'.format(
+                volume_roi, volume))
+        roi_data = np.asanyarray(roi_img.dataobj)
+    return map_volume(np.asanyarray(vol_img.dataobj), weights, roi_data)
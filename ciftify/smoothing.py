@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Gaussian smoothing of surface (metric) and cifti data as a sparse matrix product.
+
+The smoothing kernel of a surface only depends on the surface, the kernel size
+and the roi, so it is built once (as a sparse vertices x vertices operator),
+saved (in a smoothing_weights folder next to the surface, or in the ciftify
+cache for the surfaces that come with ciftify) and reused for every timepoint
+and every later call with the same inputs.
+"""
+
+import os
+import logging
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+from concurrent.futures import ThreadPoolExecutor
+import nibabel as nib
+
+import ciftify.config
+import ciftify.surface
+import ciftify.utils
+
+# kernels are cut off at this many sigmas (geodesic distance on the surface)
+KERNEL_CUTOFF = 3.0
+# bump this when the way kernels are built changes, so old cache files are not used
+KERNEL_VERSION = '1'
+# number of source vertices per geodesic distance calculation
+DISTANCE_CHUNK = 256
+# the size of the blocks of space (in kernel cutoffs) that the source vertices are
+# grouped by, so that each distance calculation only searches a small part of the mesh
+CHUNK_CELL = 4
+
+logger = logging.getLogger(__name__)
+
+def surface_smoothing_operator(surf, sigma, roi = None, cache_dir = None,
+                               use_cache = True):
+    '''
+    returns the sparse (vertices x vertices) smoothing operator for a surface,
+    from the cache_dir (by default see smoothing_cache_dir) if it has been built
+    before with the same surface, sigma and roi
+    '''
+    roi_mask = None if roi is None else np.asarray(roi).ravel() > 0
+    cache_file = None
+    if use_cache:
+        if cache_dir is None:
+            cache_dir = smoothing_cache_dir(surf)
+        cache_file = operator_cache_file(cache_dir, surf, sigma, roi_mask)
+    return ciftify.utils.cached_sparse_matrix(cache_file,
+        lambda: surface_smoothing_kernel(surf, sigma, roi_mask))
+
+def smoothing_cache_dir(surf):
+    '''
+    the folder that the smoothing operators of a surface are saved to, the
+    smoothing_weights folder next to it (i.e. in the subject's folder) or, for the
+    shared surfaces that come with ciftify, the ciftify cache
+    '''
+    surf_dir = os.path.dirname(os.path.realpath(surf))
+    ciftify_data = os.path.realpath(ciftify.config.find_ciftify_global())
+    if os.path.commonpath([surf_dir, ciftify_data]) == ciftify_data:
+        return os.path.join(ciftify.config.find_ciftify_cache(), 'smoothing')
+    return os.path.join(surf_dir, 'smoothing_weights')
+
+def operator_cache_file(cache_dir, surf, sigma, roi_mask):
+    '''the cache file for a surface smoothing operator, named by a hash of its inputs'''
+    extras = ['sigma{:.6f}'.format(float(sigma)),
+              'cutoff{}version{}'.format(KERNEL_CUTOFF, KERNEL_VERSION)]
+    if roi_mask is not None:
+        extras.append(np.packbits(roi_mask).tobytes())
+    return ciftify.utils.hashed_cache_file(cache_dir, 'smoothing', [surf], *extras)
+
+def surface_smoothing_kernel(surf, sigma, roi_mask = None):
+    '''
+    builds the geodesic gaussian smoothing kernel of a surface
+
+    Like wb_command -metric-smoothing (GEO_GAUSS_AREA) the weight of each neighbour
+    is the gaussian of its geodesic distance times its vertex area, and the weights
+    for each vertex sum to one. Only vertices inside the roi are used, vertices
+    outside of it are set to zero.
+    '''
+    surf_graph = ciftify.surface.SurfaceGraph(surf)
+    areas = ciftify.surface.vertex_areas(surf_graph.coords, surf_graph.triangles)
+    n_vertices = surf_graph.n_vertices
+    if roi_mask is None:
+        roi_mask = np.ones(n_vertices, dtype = bool)
+    roi_vertices = np.flatnonzero(roi_mask)
+
+    ## the vertices of each chunk are close together, so that only the part of the
+    ## mesh around them is searched and only the distances under the cutoff are kept
+    cells = np.floor(surf_graph.coords[roi_vertices] /
+                     (CHUNK_CELL * KERNEL_CUTOFF * sigma)).astype(np.int64)
+    roi_vertices = roi_vertices[np.lexsort(cells.T[::-1])]
+
+    rows, cols, weights = [], [], []
+    n_chunks = max(1, int(np.ceil(len(roi_vertices) / DISTANCE_CHUNK)))
+    for chunk in np.array_split(roi_vertices, n_chunks):
+        source, neighbour, dist = surf_graph.distances_within(chunk,
+                                                              KERNEL_CUTOFF * sigma)
+        in_roi = roi_mask[neighbour]
+        source, neighbour, dist = source[in_roi], neighbour[in_roi], dist[in_roi]
+        rows.append(chunk[source])
+        cols.append(neighbour)
+        weights.append(np.exp(-dist**2 / (2 * sigma**2)) * areas[neighbour])
+
+    kernel = sparse.csr_matrix((np.concatenate(weights),
+                                (np.concatenate(rows), np.concatenate(cols))),
+                               shape = (n_vertices, n_vertices))
+    return normalize_rows(kernel)
+
+def volume_smoothing_kernel(voxels, affine, sigma):
+    '''
+    builds the gaussian smoothing kernel for a list of voxels (i,j,k indices),
+    only smoothing within the given voxels (i.e. within one subcortical structure)
+    '''
+    coords = nib.affines.apply_affine(affine, voxels)
+    tree = cKDTree(coords)
+    pairs = tree.query_pairs(KERNEL_CUTOFF * sigma, output_type = 'ndarray')
+    dist = np.linalg.norm(coords[pairs[:, 0]] - coords[pairs[:, 1]], axis = 1)
+    pair_weights = np.exp(-dist**2 / (2 * sigma**2))
+    n_voxels = coords.shape[0]
+    diagonal = np.arange(n_voxels)
+    kernel = sparse.csr_matrix((np.concatenate((pair_weights, pair_weights, np.ones(n_voxels))),
+                                (np.concatenate((pairs[:, 0], pairs[:, 1], diagonal)),
+                                 np.concatenate((pairs[:, 1], pairs[:, 0], diagonal)))),
+                               shape = (n_voxels, n_voxels))
+    return normalize_rows(kernel)
+
+def normalize_rows(kernel):
+    '''scale the rows of a sparse kernel to sum to one (empty rows stay zero)'''
+    row_sums = np.asarray(kernel.sum(axis = 1)).ravel()
+    scale = np.zeros(row_sums.shape)
+    scale[row_sums > 0] = 1.0 / row_sums[row_sums > 0]
+    return sparse.diags(scale).dot(kernel).tocsr()
+
+def cifti_smoothing_operator(brain_models, surface_sigma, volume_sigma,
+                             left_surface, right_surface):
+    '''
+    builds the sparse (grayordinates x grayordinates) operator for smoothing
+    along the columns of a cifti file, like wb_command -cifti-smoothing:
+    each surface is smoothed within the vertices that are in the cifti file,
+    and each subcortical structure is smoothed separately
+    '''
+    surfaces = {'CIFTI_STRUCTURE_CORTEX_LEFT': left_surface,
+                'CIFTI_STRUCTURE_CORTEX_RIGHT': right_surface}
+    blocks = []
+    for name, _, structure in brain_models.iter_structures():
+        if structure.volume_mask.all():
+            if volume_sigma > 0:
+                blocks.append(volume_smoothing_kernel(structure.voxel,
+                                                      brain_models.affine, volume_sigma))
+            else:
+                blocks.append(sparse.identity(len(structure), format = 'csr'))
+            continue
+        vertices = structure.vertex
+        if name not in surfaces or surface_sigma <= 0:
+            if surface_sigma > 0:
+                logger.warning('No surface given for {}, it will not be smoothed'.format(name))
+            blocks.append(sparse.identity(len(structure), format = 'csr'))
+            continue
+        roi = np.zeros(structure.nvertices[name], dtype = bool)
+        roi[vertices] = True
+        operator = surface_smoothing_operator(surfaces[name], surface_sigma, roi)
+        blocks.append(operator[vertices, :][:, vertices])
+    return sparse.block_diag(blocks, format = 'csr')
+
+def apply_operator(operator, data, n_cpus = 1, out = None):
+    '''
+    applies a sparse (new rows x rows) operator to a rows x timepoints array
+    blocks of timepoints are multiplied in parallel threads
+    '''
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+    if out is None:
+        out = np.empty((operator.shape[0], data.shape[1]),
+                       dtype = np.result_type(data.dtype, np.float32))
+    n_cpus = max(1, int(n_cpus))
+    n_blocks = min(data.shape[1], n_cpus * 4)
+
+    def smooth_block(block):
+        out[:, block] = operator.dot(data[:, block])
+
+    blocks = [b for b in np.array_split(np.arange(data.shape[1]), n_blocks) if len(b)]
+    if n_cpus == 1:
+        for block in blocks:
+            smooth_block(block)
+    else:
+        with ThreadPoolExecutor(max_workers = n_cpus) as executor:
+            list(executor.map(smooth_block, blocks))
+    return out
+
+def smooth_metric(data, surf, sigma, roi = None, n_cpus = 1, cache_dir = None):
+    '''
+    smooth a vertices x timepoints array on a surface (like wb_command -metric-smoothing)
+    vertices outside of the roi are set to zero
+    '''
+    operator = surface_smoothing_operator(surf, sigma, roi, cache_dir = cache_dir)
+    return apply_operator(operator, data, n_cpus)
+
+def smooth_cifti_file(input_cifti, output_cifti, surface_sigma, volume_sigma,
+                      left_surface, right_surface, n_cpus = 1):
+    '''
+    smooth a dense cifti file along its columns (like wb_command -cifti-smoothing COLUMN)
+    '''
+    cifti = nib.load(input_cifti)
+    data = np.asanyarray(cifti.dataobj).T
+    operator = cifti_smoothing_operator(cifti.header.get_axis(1), surface_sigma,
+                                        volume_sigma, left_surface, right_surface)
+    smoothed = apply_operator(operator, data, n_cpus)
+    output = nib.Cifti2Image(smoothed.T, header = cifti.header,
+                             nifti_header = cifti.nifti_header)
+    output.to_filename(output_cifti)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+In-process tools for working with surface meshes (i.e. geodesic distances)
+so that many measurements can be made without calling wb_command each time
+"""
+
+import logging
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+
+import ciftify.niio
+
+## the -overlap-logic options of wb_command -surface-geodesic-rois
+ROI_OVERLAP_LOGIC = ['ALLOW', 'CLOSEST', 'EXCLUDE']
+
+class SurfaceGraph:
+    '''
+    The vertex graph of a surface mesh, with edges weighted by their length in mm.
+
+    Geodesic distances are measured along the mesh edges plus, like
+    wb_command -surface-geodesic-distance, the straight paths that cross
+    between two neighbouring triangles when they are unfolded into one plane.
+    '''
+    def __init__(self, surf):
+        self.surface = surf
+        self.coords = np.asarray(ciftify.niio.load_surf_coords(surf), dtype = np.float64)
+        self.triangles = np.asarray(ciftify.niio.load_surf_triangles(surf), dtype = np.int64)
+        self.n_vertices = self.coords.shape[0]
+        self.graph = build_distance_graph(self.coords, self.triangles)
+        self.__tree = None
+
+    def distances(self, vertices, limit = np.inf):
+        '''
+        geodesic distances from each of the given vertices to every vertex
+        returns an array of shape (number of vertices given, number of vertices)
+        vertices beyond the limit (in mm) are returned as np.inf
+        '''
+        vertices = np.atleast_1d(np.asarray(vertices, dtype = np.int64))
+        return csgraph.dijkstra(self.graph, directed = False,
+                                indices = vertices, limit = limit)
+
+    def distances_within(self, vertices, limit):
+        '''
+        geodesic distances from each of the given vertices to the vertices within
+        the limit (in mm), searching only the part of the mesh within a straight line
+        distance of the limit (no path within the limit can leave it)
+        returns the (index in vertices, vertex, distance) of every pair in range
+        '''
+        vertices = np.atleast_1d(np.asarray(vertices, dtype = np.int64))
+        if self.__tree is None:
+            self.__tree = cKDTree(self.coords)
+        nearby = np.unique(np.concatenate(self.__tree.query_ball_point(
+            self.coords[vertices], limit * (1 + 1e-9))).astype(np.int64))
+        nearby_graph = self.graph[nearby, :][:, nearby]
+        distances = csgraph.dijkstra(nearby_graph, directed = False,
+                                     indices = np.searchsorted(nearby, vertices),
+                                     limit = limit)
+        source, neighbour = np.nonzero(np.isfinite(distances))
+        return source, nearby[neighbour], distances[source, neighbour]
+
+    def geodesic_rois(self, vertices, radius, sigma = None, overlap_logic = 'ALLOW'):
+        '''
+        builds one roi (like wb_command -surface-geodesic-rois) of the vertices within
+        the radius (in mm) of each of the given vertices
+        returns an array of shape (number of vertices, number of rois)
+
+        If a sigma is given the rois are gaussian kernels, exp(-d^2 / (2 * sigma^2)),
+        instead of ones. The overlap_logic is one of
+          ALLOW   - the rois are independent and may overlap
+          CLOSEST - a vertex only belongs to the roi with the closest centre
+          EXCLUDE - a vertex within range of more than one roi belongs to no roi
+        '''
+        distances = self.distances(vertices, limit = radius).T
+        return rois_from_distances(distances, sigma, overlap_logic)
+
+def rois_from_distances(distances, sigma = None, overlap_logic = 'ALLOW'):
+    '''
+    builds the rois of SurfaceGraph.geodesic_rois from a (number of vertices,
+    number of rois) array of the distances to each roi centre (np.inf out of range)
+    '''
+    if overlap_logic not in ROI_OVERLAP_LOGIC:
+        raise ValueError('overlap_logic must be one of {}, not {}'.format(
+            ', '.join(ROI_OVERLAP_LOGIC), overlap_logic))
+    in_roi = np.isfinite(distances)
+    if overlap_logic == 'CLOSEST':
+        ## ties go to the first of the rois, like workbench
+        closest = np.zeros(in_roi.shape, dtype = bool)
+        closest[np.arange(distances.shape[0]), np.argmin(distances, axis = 1)] = True
+        in_roi &= closest
+    elif overlap_logic == 'EXCLUDE':
+        in_roi[in_roi.sum(axis = 1) > 1, :] = False
+    if sigma is None:
+        return in_roi.astype(np.float32)
+    rois = np.zeros(distances.shape, dtype = np.float32)
+    rois[in_roi] = np.exp(-distances[in_roi]**2 / (2 * float(sigma)**2))
+    return rois
+
+class SurfaceRois:
+    '''
+    Builds roi maps (like ciftify_surface_rois) on a left and right surface.
+
+    The surface graphs, and the geodesic neighbourhood of every roi centre, are
+    kept between calls so that many roi maps of the same surfaces (i.e. one per
+    network of a PINT output) only measure each neighbourhood once.
+    '''
+    def __init__(self, left_surface, right_surface):
+        self.surfaces = {'L': left_surface, 'R': right_surface}
+        self.__graphs = {}
+        self.__neighbourhoods = {}
+
+    def surface_graph(self, hemi):
+        '''the SurfaceGraph of one hemisphere (L or R), only read once'''
+        if hemi not in self.__graphs:
+            self.__graphs[hemi] = SurfaceGraph(self.surfaces[hemi])
+        return self.__graphs[hemi]
+
+    def n_vertices(self, hemi):
+        return self.surface_graph(hemi).n_vertices
+
+    def roi_distances(self, hemi, vertices, radius):
+        '''
+        the distances (number of vertices, number of rois) to each of the vertices,
+        np.inf beyond the radius, from the neighbourhood cache
+        '''
+        surf_graph = self.surface_graph(hemi)
+        vertices = np.asarray(vertices, dtype = np.int64).ravel()
+        if len(vertices) and (vertices.min() < 0 or vertices.max() >= surf_graph.n_vertices):
+            raise ValueError('Vertices must be between 0 and {} for surface {}'.format(
+                surf_graph.n_vertices - 1, self.surfaces[hemi]))
+        ## measure the neighbourhoods that are not cached (or only to a smaller radius)
+        missing = sorted(set(v for v in vertices.tolist()
+                    if self.__neighbourhoods.get((hemi, v), (-1,))[0] < radius))
+        if missing:
+            missing_distances = surf_graph.distances(missing, limit = radius)
+            for vertex, vertex_distances in zip(missing, missing_distances):
+                neighbours = np.flatnonzero(np.isfinite(vertex_distances))
+                self.__neighbourhoods[(hemi, vertex)] = (radius, neighbours,
+                                                        vertex_distances[neighbours])
+        distances = np.full((surf_graph.n_vertices, len(vertices)), np.inf)
+        for roi_idx, vertex in enumerate(vertices.tolist()):
+            _, neighbours, neighbour_distances = self.__neighbourhoods[(hemi, vertex)]
+            in_radius = neighbour_distances <= radius
+            distances[neighbours[in_radius], roi_idx] = neighbour_distances[in_radius]
+        return distances
+
+    def hemi_map(self, hemi, vertices, radius, labels = None, gaussian = False,
+                 overlap_logic = 'ALLOW'):
+        '''
+        the rois around the vertices of one hemisphere combined into one map, the sum
+        of the rois or, if labels are given, the sum of each roi multiplied by its label
+        gaussian rois (with a sigma of the radius) are built independently of each other
+        '''
+        if len(vertices) == 0:
+            return np.zeros(self.n_vertices(hemi), dtype = np.float32)
+        distances = self.roi_distances(hemi, vertices, radius)
+        if gaussian:
+            rois = rois_from_distances(distances, sigma = radius)
+        else:
+            rois = rois_from_distances(distances, overlap_logic = overlap_logic)
+        if labels is None:
+            return rois.sum(axis = 1)
+        return rois.dot(np.asarray(labels, dtype = np.float32))
+
+    def bilateral_map(self, vertices, hemis, radius, labels = None, gaussian = False,
+                      overlap_logic = 'ALLOW', probmap = False):
+        '''
+        the roi map of both hemispheres (left then right vertices), for lists of roi
+        centre vertices and their hemisphere (L or R), divided by the number of rois
+        if probmap is True
+        '''
+        vertices = np.asarray(vertices)
+        hemis = np.asarray(hemis)
+        hemi_maps = []
+        for hemi in ['L', 'R']:
+            hemi_labels = None if labels is None else np.asarray(labels)[hemis == hemi]
+            hemi_maps.append(self.hemi_map(hemi, vertices[hemis == hemi], radius,
+                                           hemi_labels, gaussian, overlap_logic))
+        rois = np.concatenate(hemi_maps)
+        if probmap:
+            rois = rois / len(vertices)
+        return rois
+
+    def brain_models(self):
+        '''the grayordinates of every vertex of the left and right surfaces'''
+        return (nib.cifti2.BrainModelAxis.from_surface(np.arange(self.n_vertices('L')),
+                                                       self.n_vertices('L'), 'CortexLeft') +
+                nib.cifti2.BrainModelAxis.from_surface(np.arange(self.n_vertices('R')),
+                                                       self.n_vertices('R'), 'CortexRight'))
+
+    def write_dscalar(self, filename, rois):
+        '''writes a map from bilateral_map to a dscalar.nii file'''
+        ciftify.niio.write_cifti2_dscalar(filename, rois, self.brain_models(), [''])
+
+def vertex_areas(coords, triangles):
+    '''the area of each vertex, as a third of the area of every triangle it is part of'''
+    a = coords[triangles[:, 0]]
+    b = coords[triangles[:, 1]]
+    c = coords[triangles[:, 2]]
+    triangle_areas = 0.5 * np.linalg.norm(np.cross(b - a, c - a), axis = 1)
+    return np.bincount(triangles.ravel(), weights = np.repeat(triangle_areas / 3, 3),
+                       minlength = coords.shape[0])
+
+def vertex_triangles(triangles, n_vertices):
+    '''
+    the triangles around every vertex, as an (n_vertices x most triangles) array
+    padded with -1
+    '''
+    vertex = triangles.ravel()
+    triangle = np.repeat(np.arange(triangles.shape[0]), 3)
+    order = np.argsort(vertex, kind = 'stable')
+    vertex, triangle = vertex[order], triangle[order]
+    counts = np.bincount(vertex, minlength = n_vertices)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    slots = np.arange(len(vertex)) - starts[vertex]
+    around = np.full((n_vertices, max(counts.max(), 1)), -1, dtype = np.int64)
+    around[vertex, slots] = triangle
+    return around
+
+def mesh_edges(triangles):
+    '''returns the unique edges (as sorted vertex pairs) of a triangle mesh'''
+    edges = np.vstack((triangles[:, [0, 1]],
+                       triangles[:, [1, 2]],
+                       triangles[:, [2, 0]]))
+    edges = np.sort(edges, axis = 1)
+    return np.unique(edges, axis = 0)
+
+def unfolded_triangle_pairs(coords, triangles):
+    '''
+    finds the shortcut across every pair of triangles that share an edge
+
+    The two triangles are unfolded into one plane, if the straight line between
+    the two vertices not on the shared edge crosses that edge, it is kept as
+    a path between them.
+
+    Returns the vertex pairs (n x 2) and their unfolded distance
+    '''
+    ## every edge of every triangle, with the vertex opposite that edge
+    edges = np.vstack((triangles[:, [0, 1, 2]],
+                       triangles[:, [1, 2, 0]],
+                       triangles[:, [2, 0, 1]]))
+    edges[:, :2] = np.sort(edges[:, :2], axis = 1)
+
+    ## group the half edges so that triangles sharing an edge are next to each other
+    order = np.lexsort((edges[:, 1], edges[:, 0]))
+    edges = edges[order]
+    shared = np.all(edges[1:, :2] == edges[:-1, :2], axis = 1)
+    first = edges[:-1][shared]
+    second = edges[1:][shared]
+
+    a = coords[first[:, 0]]
+    b = coords[first[:, 1]]
+    c = coords[first[:, 2]]
+    d = coords[second[:, 2]]
+
+    ## place a at the origin and b along the x axis, c above and d below
+    ab_len = np.linalg.norm(b - a, axis = 1)
+    u = (b - a) / ab_len[:, np.newaxis]
+    cx = np.einsum('ij,ij->i', c - a, u)
+    cy = np.linalg.norm((c - a) - cx[:, np.newaxis] * u, axis = 1)
+    dx = np.einsum('ij,ij->i', d - a, u)
+    dy = np.linalg.norm((d - a) - dx[:, np.newaxis] * u, axis = 1)
+
+    ## where does the c to d line cross the shared edge
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        cross_x = cx + (dx - cx) * cy / (cy + dy)
+    valid = (cy + dy > 0) & (cross_x > 0) & (cross_x < ab_len)
+
+    pairs = np.column_stack((first[valid, 2], second[valid, 2]))
+    lengths = np.hypot(cx[valid] - dx[valid], cy[valid] + dy[valid])
+    return pairs, lengths
+
+def build_distance_graph(coords, triangles):
+    '''build a sparse (symmetric) graph of the distances between connected vertices'''
+    edges = mesh_edges(triangles)
+    edge_lengths = np.linalg.norm(coords[edges[:, 0]] - coords[edges[:, 1]], axis = 1)
+    pairs, pair_lengths = unfolded_triangle_pairs(coords, triangles)
+
+    rows = np.concatenate((edges[:, 0], pairs[:, 0]))
+    cols = np.concatenate((edges[:, 1], pairs[:, 1]))
+    lengths = np.concatenate((edge_lengths, pair_lengths))
+
+    return symmetric_graph(rows, cols, lengths, coords.shape[0])
+
+def symmetric_graph(rows, cols, lengths, n_vertices):
+    '''
+    build a symmetric sparse matrix from a list of vertex pairs,
+    keeping the shortest length where a pair is given more than once
+    '''
+    lo = np.minimum(rows, cols)
+    hi = np.maximum(rows, cols)
+    order = np.lexsort((lengths, hi, lo))
+    lo, hi, lengths = lo[order], hi[order], lengths[order]
+    keep = np.ones(len(lo), dtype = bool)
+    keep[1:] = (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])
+    lo, hi, lengths = lo[keep], hi[keep], lengths[keep]
+    graph = sparse.coo_matrix((np.concatenate((lengths, lengths)),
+                               (np.concatenate((lo, hi)), np.concatenate((hi, lo)))),
+                              shape = (n_vertices, n_vertices))
+    return graph.tocsr()
@@ -13,7 +13,9 @@ import tempfile
 import shutil
 import logging
 import math
+import hashlib
 import yaml
+from scipy import sparse
 
 import ciftify
 logger = logging.getLogger(__name__)
@@ -485,3 +487,45 @@ def has_ciftify_fmri_run(subject, fmriname, ciftify_work_dir):
                         'ciftify_subject_fmri.log')
     # print('ciftify_subject_fmri done {}'.format(ciftify_log_endswith_done(ciftify_log)))
     return ciftify_log_endswith_done(ciftify_log)
+
+def hashed_cache_file(cache_dir, prefix, input_files, *extras):
+    '''
+    returns the path of a cache file (prefix.<sha1>.npz in cache_dir) named by a
+    hash of the contents of the input_files and any extra strings or bytes (i.e.
+    the settings and the version of the cached data)
+    '''
+    sha = hashlib.sha1()
+    for input_file in input_files:
+        with open(input_file, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+    for extra in extras:
+        sha.update(extra if isinstance(extra, bytes) else str(extra).encode())
+    return os.path.join(cache_dir, '{}.{}.npz'.format(prefix, sha.hexdigest()))
+
+def save_sparse_matrix(matrix, cache_file):
+    '''
+    saves a sparse matrix to a cache file, a cache that can not be written is only
+    a warning
+    '''
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok = True)
+        ## write to a temporary name first so that other processes never read half a file
+        tmp_file = '{}.{}.tmp.npz'.format(cache_file[:-len('.npz')], os.getpid())
+        sparse.save_npz(tmp_file, matrix)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logger.warning('Could not write to cache file {}: {}'.format(cache_file, e))
+
+def cached_sparse_matrix(cache_file, build_matrix):
+    '''
+    returns the sparse matrix saved in the cache_file, or builds it (by calling
+    build_matrix) and saves it there, without a cache_file it is only built
+    '''
+    if cache_file and os.path.exists(cache_file):
+        logger.debug('Reading {}'.format(cache_file))
+        return sparse.load_npz(cache_file)
+    matrix = build_matrix()
+    if cache_file:
+        save_sparse_matrix(matrix, cache_file)
+    return matrix
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+'''small meshes shared by the surface tests'''
+import numpy as np
+
+def grid_triangles(n = 5):
+    '''the triangles of a square mesh of n x n vertices (numbered row by row)'''
+    triangles = []
+    for row in range(n - 1):
+        for col in range(n - 1):
+            v = row * n + col
+            triangles.append([v, v + 1, v + n])
+            triangles.append([v + 1, v + n + 1, v + n])
+    return np.array(triangles)
+
+def grid_coords(n = 5, spacing = 1.0):
+    '''the vertex coordinates of a flat square mesh of n x n vertices, spacing mm apart'''
+    x, y = np.meshgrid(np.arange(n), np.arange(n))
+    return np.column_stack((x.ravel(), y.ravel(), np.zeros(n * n))) * spacing
+
+def flat_grid(n = 5, spacing = 1.0):
+    '''a flat square mesh of n x n vertices, split into triangles'''
+    return grid_coords(n, spacing), grid_triangles(n)
@@ -12,10 +12,13 @@ import json
 import pytest
 from unittest.mock import patch
 
+import nibabel as nib
 from nibabel import Nifti1Image
 import numpy as np
 import nilearn.image
+import nilearn.signal
 
+import ciftify.utils
 import ciftify.bin.ciftify_clean_img as ciftify_clean_img
 
 logging.disable(logging.CRITICAL)
@@ -48,7 +51,8 @@ class TestUserSettings(unittest.TestCase):
       '--tr': '2.0',
       '--smooth-fwhm': None,
       '--left-surface': None,
-      '--right-surface': None }
+      '--right-surface': None,
+      '--python-smoothing': False }
     json_config = '''
     {
       "--detrend": true,
@@ -243,6 +247,36 @@ class TestUserSettings(unittest.TestCase):
         settings = ciftify_clean_img.UserSettings(arguments)
         assert settings.smooth.fwhm == 0
 
+@patch('ciftify.bin.ciftify_clean_img.UserSettings.print_settings')
+@patch('ciftify.bin.ciftify_clean_img.clean_cifti_in_blocks')
+@patch('ciftify.utils.run')
+@patch('ciftify.utils.check_input_readable', side_effect = _check_input_readble_side_effect)
+@patch('ciftify.utils.check_output_writable', return_value = True)
+class TestCiftiSmoothing(unittest.TestCase):
+
+    def cifti_arguments(self, python_smoothing):
+        arguments = copy.deepcopy(TestUserSettings.docopt_args)
+        arguments['<func_input>'] = '/path/to/input/myfunc.dtseries.nii'
+        arguments['--smooth-fwhm'] = '8'
+        arguments['--left-surface'] = 'L.midthickness.surf.gii'
+        arguments['--right-surface'] = 'R.midthickness.surf.gii'
+        arguments['--python-smoothing'] = python_smoothing
+        return arguments
+
+    def test_wb_command_is_the_default(self, mock_writable, mock_readable,
+                                       mock_run, mock_clean, mock_print):
+        ciftify_clean_img.run_ciftify_clean_img(self.cifti_arguments(False), '/tmp/clean')
+        assert mock_clean.call_args[0][1] == '/tmp/clean/cleaned.dtseries.nii'
+        cmd = mock_run.call_args[0][0]
+        assert cmd[:3] == ['wb_command', '-cifti-smoothing', '/tmp/clean/cleaned.dtseries.nii']
+        assert cmd[6] == '/path/to/input/myfunc_clean_s8.dtseries.nii'
+
+    def test_python_smoothing_is_done_while_cleaning(self, mock_writable, mock_readable,
+                                                      mock_run, mock_clean, mock_print):
+        ciftify_clean_img.run_ciftify_clean_img(self.cifti_arguments(True), '/tmp/clean')
+        assert mock_clean.call_args[0][1] == '/path/to/input/myfunc_clean_s8.dtseries.nii'
+        assert mock_run.call_count == 0
+
 class TestMangleConfounds(unittest.TestCase):
 
     input_signals = pd.DataFrame(data = {'x': [1,2,3,4,5],
@@ -348,37 +382,137 @@ class TestMangleConfounds(unittest.TestCase):
         for coln in ['x', 'y', 'y_sq', 'y_lag', 'y_sqlag']:
             assert coln in list(confound_signals.columns.values)
 
-@patch('nilearn.image.clean_img')
 class TestCleanImage(unittest.TestCase):
-    # note this one need to patch nilean.clean_img just to check it is only called when asked for
-    def test_nilearn_not_called_not_indicated(self, nilearn_clean):
 
-        class SettingsStub(object):
-            def __init__(self):
-                self.detrend = False
-                self.standardize = False
-                self.high_pass = None
-                self.low_pass = None
-
-        input_img = 'fake_img.nii.gz'
+    class SettingsStub(object):
+        def __init__(self, detrend = False, standardize = False,
+                     high_pass = None, low_pass = None, start_from_tr = 0):
+            self.detrend = detrend
+            self.standardize = standardize
+            self.high_pass = high_pass
+            self.low_pass = low_pass
+            self.start_from_tr = start_from_tr
+            self.func = type('FuncStub', (object,), {'tr': 2.0})
+            self.smooth = type('SmoothStub', (object,), {'fwhm': 0})
+
+    def test_cleaning_not_required_when_not_indicated(self):
+
+        settings = self.SettingsStub()
         confound_signals = None
-        settings = SettingsStub()
-
-        output_img = ciftify_clean_img.clean_image_with_nilearn(
-            input_img, confound_signals, settings)
-
-        nilearn_clean.assert_not_called()
-
-def test_drop_image():
-    img1 = Nifti1Image(np.ones((2, 2, 2, 1)), affine=np.eye(4))
-    img2 = Nifti1Image(np.ones((2, 2, 2, 1)) + 1, affine=np.eye(4))
-    img3 = Nifti1Image(np.ones((2, 2, 2, 1)) + 2, affine=np.eye(4))
-    img4 = Nifti1Image(np.ones((2, 2, 2, 1)) + 3, affine=np.eye(4))
-    img5 = Nifti1Image(np.ones((2, 2, 2, 1)) + 4, affine=np.eye(4))
-
-    img_1to5 = nilearn.image.concat_imgs([img1, img2, img3, img4, img5])
-
-    img_trim = ciftify_clean_img.image_drop_dummy_trs(img_1to5, 2)
 
-    assert np.allclose(img_trim.get_fdata()[1,1,1,:], np.array([3, 4, 5]))
-    assert img_trim.header.get_data_shape() == (2,2,2,3)
+        assert not ciftify_clean_img.cleaning_required(confound_signals, settings)
+
+    def test_design_matches_nilearn_signal_clean(self):
+
+        signals = np.random.RandomState(0).randn(60, 20) * 10 + 100
+        confounds = np.random.RandomState(1).randn(60, 3)
+        for kwargs in [dict(detrend = True),
+                       dict(detrend = True, standardize = True, low_pass = 0.1, high_pass = 0.01),
+                       dict(low_pass = 0.1)]:
+            settings = self.SettingsStub(**kwargs)
+            expected = nilearn.signal.clean(signals,
+                detrend = settings.detrend, standardize = settings.standardize,
+                confounds = confounds, low_pass = settings.low_pass,
+                high_pass = settings.high_pass, t_r = 2.0)
+            design = ciftify_clean_img.CleaningDesign(60, confounds, settings)
+            result = design.clean(signals.astype(np.float32))
+            assert result.dtype == np.float32
+            assert np.allclose(result, expected, atol = 1e-4)
+
+    def test_confounds_are_not_changed_by_the_design(self):
+
+        confounds = np.random.RandomState(1).randn(60, 3)
+        original = confounds.copy()
+        settings = self.SettingsStub(detrend = True, low_pass = 0.1)
+        ciftify_clean_img.CleaningDesign(60, confounds, settings)
+        assert np.array_equal(confounds, original)
+
+    @patch('ciftify.bin.ciftify_clean_img.CLEAN_BLOCK_BYTES', 8 * 20 * 7)
+    def test_blocks_match_cleaning_the_whole_image(self):
+
+        data = (np.random.RandomState(2).randn(4, 3, 2, 20) * 10 + 100).astype(np.float32)
+        input_img = Nifti1Image(data, affine = np.eye(4))
+        settings = self.SettingsStub(detrend = True, standardize = True,
+                                     start_from_tr = 2)
+        with ciftify.utils.TempDir() as tmpdir:
+            input_nii = os.path.join(tmpdir, 'input.nii.gz')
+            output_nii = os.path.join(tmpdir, 'output.nii')
+            input_img.to_filename(input_nii)
+            ciftify_clean_img.clean_nifti_in_blocks(input_nii, output_nii,
+                None, settings, tmpdir)
+            result = nilearn.image.load_img(output_nii).get_fdata()
+        expected = nilearn.image.clean_img(input_img.slicer[:,:,:,2:],
+            detrend = True, standardize = True).get_fdata()
+        assert result.shape == (4, 3, 2, 18)
+        assert np.allclose(result, expected, atol = 1e-4)
+
+    def test_grayordinate_rows_are_the_transposed_columns(self):
+
+        data = np.arange(40, dtype = np.float32).reshape(8, 5)
+        rows = ciftify_clean_img.GrayordinateRows(data)
+        assert rows.shape == (5, 8)
+        assert np.array_equal(rows[slice(1, 3), slice(2, None)], data[2:, 1:3].T)
+
+    @patch('ciftify.bin.ciftify_clean_img.CLEAN_BLOCK_BYTES', 8 * 40 * 3)
+    @patch('ciftify.niio.load_cifti2')
+    def test_cifti_is_cleaned_as_a_grayordinate_matrix(self, mock_load_cifti2):
+
+        data = (np.random.RandomState(3).randn(40, 10) * 10 + 100).astype(np.float32)
+        brain_models = nib.cifti2.BrainModelAxis.from_surface(np.arange(10), 10, 'CortexLeft')
+        series = nib.cifti2.SeriesAxis(0, 2.0, 40, 'SECOND')
+        settings = self.SettingsStub(detrend = True, low_pass = 0.1,
+                                     start_from_tr = 2)
+        with ciftify.utils.TempDir() as tmpdir:
+            input_dtseries = os.path.join(tmpdir, 'input.dtseries.nii')
+            output_dtseries = os.path.join(tmpdir, 'output.dtseries.nii')
+            nib.Cifti2Image(data, header = (series, brain_models)).to_filename(input_dtseries)
+            ciftify_clean_img.clean_cifti_in_blocks(input_dtseries, output_dtseries,
+                None, settings, tmpdir)
+            output_img = nib.load(output_dtseries)
+            result = output_img.get_fdata()
+            output_series = output_img.header.get_axis(0)
+        expected = nilearn.signal.clean(data[2:, :].astype(np.float64), detrend = True,
+            standardize = False, low_pass = 0.1, t_r = 2.0)
+        assert result.shape == (38, 10)
+        assert output_series.start == 4.0
+        assert output_series.step == 2.0
+        assert np.allclose(result, expected, atol = 1e-4)
+        ## the dtseries is read a block at a time, not loaded whole
+        assert mock_load_cifti2.call_count == 0
+
+def _record_run(run):
+    '''a stand in for cleaning one run, returns its name as the status'''
+    return run, '', 0.0
+
+class TestBatchCleaning(unittest.TestCase):
+
+    def test_manifest_without_optional_columns(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            manifest_tsv = os.path.join(tmpdir, 'manifest.tsv')
+            pd.DataFrame({'func': ['a.nii.gz', 'b.nii.gz']}).to_csv(manifest_tsv,
+                sep = '\t', index = False)
+            manifest = ciftify_clean_img.read_manifest(manifest_tsv)
+        assert list(manifest.columns) == ['func', 'confounds', 'output']
+        assert manifest['output'][1] is None
+
+    def test_run_arguments_keep_batch_confounds_if_none_given(self):
+        batch_args = {'<func_input>': None, '--output-file': None,
+                      '--confounds-tsv': 'shared.tsv', '--detrend': True}
+        run = {'func': 'a.nii.gz', 'confounds': None, 'output': 'a_out.nii.gz'}
+        run_args = ciftify_clean_img.run_arguments(batch_args, run)
+        assert run_args['<func_input>'] == 'a.nii.gz'
+        assert run_args['--output-file'] == 'a_out.nii.gz'
+        assert run_args['--confounds-tsv'] == 'shared.tsv'
+        assert batch_args['<func_input>'] is None
+
+    @patch('ciftify.bin.ciftify_clean_img.run_ciftify_clean_img')
+    def test_failed_run_is_recorded_not_raised(self, mock_clean):
+        mock_clean.side_effect = SystemExit(1)
+        status, message, seconds = ciftify_clean_img.clean_run({'<func_input>': 'a.nii.gz'})
+        assert status == 'failed'
+
+    def test_runs_results_are_in_manifest_order(self):
+        runs = ['a', 'b', 'c', 'd']
+        results = ciftify_clean_img.schedule_runs(_record_run, runs,
+            estimates = [3, 1, 3, 1], n_workers = 2, mem_budget = 2)
+        assert [result[0] for result in results] == runs
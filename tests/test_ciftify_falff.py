@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import unittest
+import logging
+
+import numpy as np
+import pytest
+from unittest.mock import patch
+
+import ciftify.bin.ciftify_falff as ciftify_falff
+
+logging.disable(logging.CRITICAL)
+
+def _falff_one_timeseries(timeseries, min_low_freq, max_low_freq,
+                          min_total_freq, max_total_freq, calc_alff):
+    '''the original one voxel at a time calculation (using the full fft)'''
+    n = len(timeseries)
+    fft_timeseries = np.fft.fft(timeseries)
+    freq_scale = np.fft.fftfreq(n, 1/1)
+    mag = (abs(fft_timeseries))**0.5
+    low_ind = np.where((min_low_freq <= freq_scale) & (freq_scale <= max_low_freq))
+    total_ind = np.where((min_total_freq <= freq_scale) & (freq_scale <= max_total_freq))
+    if calc_alff:
+        return np.sum(mag[low_ind])
+    return np.sum(mag[low_ind]) / np.sum(mag[total_ind])
+
+class TestCalculateFalffMatrix(unittest.TestCase):
+
+    freqs = (0.01, 0.08, 0.0, 0.25)
+
+    def test_matches_full_fft_for_even_and_odd_lengths(self):
+        rng = np.random.RandomState(0)
+        for n_timepoints in [100, 101]:
+            data = rng.randn(10, n_timepoints)
+            for calc_alff in [False, True]:
+                expected = [_falff_one_timeseries(row, *self.freqs, calc_alff) for row in data]
+                result = ciftify_falff.calculate_falff_matrix(data, *self.freqs, calc_alff)
+                assert np.allclose(result, expected)
+
+    def test_only_given_rows_are_calculated(self):
+        data = np.random.RandomState(1).randn(10, 50)
+        rows = np.array([2, 7])
+        result = ciftify_falff.calculate_falff_matrix(data, *self.freqs, False, rows = rows)
+        assert result.shape == (2,)
+        assert np.isclose(result[1], _falff_one_timeseries(data[7], *self.freqs, False))
+
+    def test_chunks_cover_all_rows(self):
+        chunks = list(ciftify_falff.chunk_slices(10, 4, chunk_bytes = 16 * 4 * 3))
+        assert [(c.start, c.stop) for c in chunks] == [(0, 3), (3, 6), (6, 9), (9, 10)]
+
+class TestMultipleBands(unittest.TestCase):
+
+    def test_parse_bands_reads_names_and_ranges(self):
+        bands = ciftify_falff.parse_bands('alff, falff:slow4,alff:0.05-0.1', 0.01, 0.08)
+        assert [b.name for b in bands] == ['alff', 'falff:slow4', 'alff:0.05-0.1']
+        assert [b.calc_alff for b in bands] == [True, False, True]
+        assert (bands[0].min_freq, bands[0].max_freq) == (0.01, 0.08)
+        assert (bands[1].min_freq, bands[1].max_freq) == ciftify_falff.SLOW_BANDS['slow4']
+        assert (bands[2].min_freq, bands[2].max_freq) == (0.05, 0.1)
+
+    def test_parse_bands_exits_on_unknown_metric(self):
+        with pytest.raises(SystemExit):
+            ciftify_falff.parse_bands('reho', 0.01, 0.08)
+
+    def test_each_band_matches_a_single_band_run(self):
+        data = np.random.RandomState(2).randn(8, 120)
+        bands = ciftify_falff.parse_bands('alff,falff,alff:slow5,falff:0.02-0.2', 0.01, 0.08)
+        result = ciftify_falff.calculate_amplitude_maps(data, bands, 0.0, 0.25)
+        assert result.shape == (8, 4)
+        for i, band in enumerate(bands):
+            expected = ciftify_falff.calculate_falff_matrix(data, band.min_freq,
+                band.max_freq, 0.0, 0.25, band.calc_alff)
+            assert np.allclose(result[:, i], expected)
+
+class TestTRAndCensoring(unittest.TestCase):
+
+    def test_band_weights_are_in_hz(self):
+        ## with a TR of 2 seconds the nyquist is 0.25 Hz
+        weights = ciftify_falff.frequency_band_weights(100, 0.1, 0.2, tr = 2.0)
+        freqs = np.fft.rfftfreq(100, 2.0)
+        in_band = (freqs >= 0.1) & (freqs <= 0.2)
+        assert np.all(weights[in_band] == 1)
+        assert np.all(weights[~in_band] == 0)
+
+    def test_lomb_scargle_matches_fft_without_censoring(self):
+        data = np.random.RandomState(3).randn(4, 100) + 5
+        sample_mask = np.ones(100, dtype = bool)
+        estimate = ciftify_falff.LombScargleAmplitudes(100, 2.0, sample_mask)(data)
+        assert np.allclose(estimate, ciftify_falff.fft_amplitudes(data))
+
+    def test_lomb_scargle_finds_sine_with_censored_trs(self):
+        tr = 2.0
+        times = np.arange(200) * tr
+        data = np.sin(2 * np.pi * 0.05 * times)[np.newaxis, :]
+        sample_mask = np.ones(200, dtype = bool)
+        sample_mask[np.random.RandomState(4).choice(200, 40, replace = False)] = False
+        estimate = ciftify_falff.LombScargleAmplitudes(200, tr, sample_mask)(data)
+        freqs = np.fft.rfftfreq(200, tr)
+        assert np.isclose(freqs[estimate[0].argmax()], 0.05)
+
+    def test_censor_file_with_all_trs_kept_returns_none(self):
+        with patch('numpy.loadtxt') as mock_loadtxt:
+            mock_loadtxt.return_value = np.ones(10)
+            assert ciftify_falff.read_censor_file('censor.1D', 10) is None
+
+    def test_censor_file_of_wrong_length_exits(self):
+        with patch('numpy.loadtxt') as mock_loadtxt:
+            mock_loadtxt.return_value = np.ones(9)
+            with pytest.raises(SystemExit):
+                ciftify_falff.read_censor_file('censor.1D', 10)
+
+    def test_exits_without_a_tr(self):
+        with pytest.raises(SystemExit):
+            ciftify_falff.define_tr(None, None, 'func.nii.gz')
+        assert ciftify_falff.define_tr('0.8', 2.0, 'func.nii.gz') == 0.8
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import logging
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import ciftify.utils
+import ciftify.bin.ciftify_groupmask as ciftify_groupmask
+
+logging.disable(logging.CRITICAL)
+
+def write_dtseries(path, data, brain_models):
+    series = nib.cifti2.SeriesAxis(0, 2.0, data.shape[0], 'SECOND')
+    nib.Cifti2Image(data, header = (series, brain_models)).to_filename(path)
+
+class TestCalcGroupMask(unittest.TestCase):
+
+    brain_models = nib.cifti2.BrainModelAxis.from_surface(np.arange(10), 10, 'CortexLeft')
+
+    def test_mask_is_valid_in_every_file_and_coverage_counts_files(self):
+        first = np.tile(np.arange(10, dtype = np.float32), (3, 1))
+        second = first.copy()
+        second[0, 9] = -1
+        with ciftify.utils.TempDir() as tmpdir:
+            files = [os.path.join(tmpdir, 'sub{}.dtseries.nii'.format(i)) for i in range(2)]
+            write_dtseries(files[0], first, self.brain_models)
+            write_dtseries(files[1], second, self.brain_models)
+            mask, coverage, _ = ciftify_groupmask.calc_group_mask(files, 50, 1, n_cpus = 2)
+        # the 50th percentile is 4.5 for the first file and 3.5 for the second
+        assert np.array_equal(mask, (np.arange(10) > 4.5) & (np.arange(10) < 9))
+        assert coverage[9] == 1
+        assert coverage[5] == 2
+        assert coverage[4] == 1
+        assert coverage[0] == 0
+
+    def test_files_with_other_grayordinates_exit(self):
+        other_models = nib.cifti2.BrainModelAxis.from_surface(np.arange(10), 12, 'CortexLeft')
+        data = np.ones((3, 10), dtype = np.float32)
+        with ciftify.utils.TempDir() as tmpdir:
+            files = [os.path.join(tmpdir, 'sub{}.dtseries.nii'.format(i)) for i in range(2)]
+            write_dtseries(files[0], data, self.brain_models)
+            write_dtseries(files[1], data, other_models)
+            with pytest.raises(SystemExit):
+                ciftify_groupmask.calc_group_mask(files, 5, 1)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import logging
+
+import numpy as np
+import pandas as pd
+import pytest
+from unittest.mock import patch
+
+import ciftify.utils
+import ciftify.surface
+import ciftify.bin.ciftify_postPINT1_concat as concat
+
+from tests.mesh_fixtures import flat_grid
+
+logging.disable(logging.CRITICAL)
+
+SUMMARY_COLUMNS = ['hemi', 'NETWORK', 'roiidx', 'tvertex', 'pvertex', 'dist_49', 'vertex_48']
+
+def write_summary(tmpdir, subid, rows, columns = SUMMARY_COLUMNS):
+    summary_csv = os.path.join(tmpdir, '{}_summary.csv'.format(subid))
+    pd.DataFrame(rows, columns = columns).to_csv(summary_csv, index = False)
+    return summary_csv
+
+def fake_surf_coords(surf):
+    '''the left surface has 1mm spacing, the right 2mm'''
+    return flat_grid(spacing = 1.0 if '.L.' in surf else 2.0)[0]
+
+def fake_surf_triangles(surf):
+    return flat_grid()[1]
+
+def per_roi_distances(concatenated_df, surfL, surfR, radius_search = 100):
+    '''
+    the distances as the old per roi loop measured them (one wb_command
+    -surface-geodesic-distance call per roi, -1 beyond the limit)
+    '''
+    distances = np.full(len(concatenated_df), -99.0)
+    for roi in concatenated_df.roiidx.unique():
+        roi_rows = np.where(concatenated_df.roiidx == roi)[0]
+        hemi = concatenated_df.hemi.values[roi_rows[0]]
+        surf = surfL if hemi == 'L' else surfR
+        roi_distances = ciftify.surface.SurfaceGraph(surf).distances(
+            concatenated_df.tvertex.values[roi_rows[0]], limit = radius_search)[0]
+        roi_distances[np.isinf(roi_distances)] = -1
+        distances[roi_rows] = roi_distances[concatenated_df.pvertex.values[roi_rows]]
+    distances[concatenated_df.pvertex.values == concatenated_df.tvertex.values] = 0
+    return distances
+
+class TestReadPINTSummaries(unittest.TestCase):
+
+    def test_summaries_are_concatenated_in_order(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            summary_csvs = [write_summary(tmpdir, 'sub-0{}'.format(i),
+                                [['L', 2, 1, 10, 10 + i, 2.5, 11]]) for i in range(1, 4)]
+            concatenated_df = concat.read_PINT_summaries(summary_csvs, 'pvertex', n_cpus = 2)
+        assert list(concatenated_df.subid) == ['sub-01', 'sub-02', 'sub-03']
+        assert list(concatenated_df.pvertex) == [11, 12, 13]
+        assert concatenated_df.subid.dtype.name == 'category'
+        assert concatenated_df.pvertex.dtype == np.int64
+
+    def test_old_summaries_get_the_extra_columns(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            summary_csv = write_summary(tmpdir, 'sub-01', [['R', 7, 3, 20, 22]],
+                                        columns = ['hemi', 'NETWORK', 'roiidx', 'tvertex', 'ivertex'])
+            concatenated_df = concat.read_PINT_summaries([summary_csv], 'ivertex')
+        assert list(concatenated_df.dist_49) == [0]
+        assert list(concatenated_df.vertex_48) == [22]
+
+@patch('ciftify.niio.load_surf_triangles', side_effect = fake_surf_triangles)
+@patch('ciftify.niio.load_surf_coords', side_effect = fake_surf_coords)
+class TestCalcTvertexDistances(unittest.TestCase):
+
+    surfL = 'fake.L.midthickness.surf.gii'
+    surfR = 'fake.R.midthickness.surf.gii'
+    concatenated_df = pd.DataFrame({
+        'subid': ['sub-01'] * 4 + ['sub-02'] * 4,
+        'hemi': ['L', 'L', 'R', 'R'] * 2,
+        'roiidx': [1, 2, 3, 4] * 2,
+        'tvertex': [0, 12, 12, 24] * 2,
+        'pvertex': [0, 13, 13, 18, 4, 24, 14, 0]})
+
+    def test_matches_the_per_roi_distances(self, mock_coords, mock_triangles):
+        distances = concat.calc_tvertex_distances(self.concatenated_df, 'pvertex',
+                                                  self.surfL, self.surfR)
+        expected = per_roi_distances(self.concatenated_df, self.surfL, self.surfR)
+        assert np.allclose(distances, expected)
+        assert np.allclose(distances[:3], [0, 1, 2])
+        assert np.isclose(distances[4], 4)
+        assert np.isclose(distances[6], 4)
+
+    def test_vertices_beyond_the_limit_are_minus_one(self, mock_coords, mock_triangles):
+        distances = concat.calc_tvertex_distances(self.concatenated_df, 'pvertex',
+                        self.surfL, self.surfR, radius_search = 3)
+        expected = per_roi_distances(self.concatenated_df, self.surfL, self.surfR,
+                                     radius_search = 3)
+        assert np.allclose(distances, expected)
+        assert list(distances[[4, 6, 7]]) == [-1, -1, -1]
+        assert np.allclose(distances[:3], [0, 1, 2])
+
+class TestWriteConcatenatedPint(unittest.TestCase):
+
+    concatenated_df = pd.DataFrame({'subid': ['sub-01', 'sub-02'], 'tvertex': [1, 2],
+                                    'std_distance': [0.5, -1.0]})
+
+    def test_csv_has_only_the_columns_asked_for(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            output_csv = os.path.join(tmpdir, 'concat.csv')
+            concat.write_concatenated_pint(self.concatenated_df, output_csv,
+                                           ['subid', 'std_distance'])
+            written = pd.read_csv(output_csv)
+        assert list(written.columns) == ['subid', 'std_distance']
+        assert list(written.std_distance) == [0.5, -1.0]
+
+    def test_parquet_output(self):
+        pytest.importorskip('pyarrow')
+        with ciftify.utils.TempDir() as tmpdir:
+            output_parquet = os.path.join(tmpdir, 'concat.parquet')
+            concat.write_concatenated_pint(self.concatenated_df, output_parquet,
+                                           ['subid', 'std_distance'])
+            written = pd.read_parquet(output_parquet)
+        assert list(written.columns) == ['subid', 'std_distance']
+        assert list(written.std_distance) == [0.5, -1.0]
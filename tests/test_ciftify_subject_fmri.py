@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+import os
+import io
+import sys
+import unittest
+import logging
+
+import pytest
+from unittest.mock import patch
+
+import ciftify.utils
+import ciftify.bin.ciftify_subject_fmri as subject_fmri
+
+logging.disable(logging.CRITICAL)
+
+class FakeRunSettings:
+    '''the parts of the Settings used by run_batch'''
+    def __init__(self, fmri_label, n_cpus):
+        self.fmri_label = fmri_label
+        self.n_cpus = n_cpus
+
+    def get_log_handler(self, formatter):
+        return logging.NullHandler()
+
+class LoggedRunSettings(FakeRunSettings):
+    '''the parts of the Settings used by run_batch, with a log file for the run'''
+    def __init__(self, fmri_label, n_cpus, log):
+        FakeRunSettings.__init__(self, fmri_label, n_cpus)
+        self.log = log
+
+    def get_log_handler(self, formatter):
+        fh = logging.FileHandler(self.log)
+        fh.setLevel(logging.INFO)
+        fh.setFormatter(formatter)
+        return fh
+
+## the steps are module level functions so that they can be sent to the worker processes
+def logged_transform(settings, tmpdir):
+    subject_fmri.logger.info('transforming {} in {}'.format(settings.fmri_label, os.getpid()))
+    if settings.fmri_label == 'broken':
+        subject_fmri.logger.error('could not transform {}'.format(settings.fmri_label))
+        sys.exit(1)
+    return ('{}_4D.nii.gz'.format(settings.fmri_label),
+            '{}_3D.nii.gz'.format(settings.fmri_label))
+
+def logged_project(settings, tmpdir, atlas_fMRI_4D, atlas_fMRI_3D, subject_files):
+    subject_fmri.logger.info('projecting {} in {}'.format(atlas_fMRI_4D, os.getpid()))
+    if settings.fmri_label == 'unprojectable':
+        subject_fmri.logger.error('could not project {}'.format(settings.fmri_label))
+        sys.exit(1)
+
+class TestReadBatchCsv(unittest.TestCase):
+
+    arguments = {'<func.nii.gz>': None, '<task_label>': None,
+                 '<subject>': 'sub-01', '--SmoothingFWHM': '4'}
+
+    def write_csv(self, tmpdir, text):
+        batch_csv = os.path.join(tmpdir, 'runs.csv')
+        with open(batch_csv, 'w') as f:
+            f.write(text)
+        return batch_csv
+
+    def test_every_run_gets_its_func_and_task_label(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            batch_csv = self.write_csv(tmpdir,
+                'func, task_label\nrun1.nii.gz, rest_1\nrun2.nii.gz, rest_2\n')
+            run_arguments = subject_fmri.read_batch_csv(batch_csv, self.arguments)
+        assert [a['<func.nii.gz>'] for a in run_arguments] == ['run1.nii.gz', 'run2.nii.gz']
+        assert [a['<task_label>'] for a in run_arguments] == ['rest_1', 'rest_2']
+        assert all(a['--SmoothingFWHM'] == '4' for a in run_arguments)
+        assert self.arguments['<task_label>'] is None
+
+    def test_exits_when_task_labels_repeat(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            batch_csv = self.write_csv(tmpdir,
+                'func,task_label\nrun1.nii.gz,rest\nrun2.nii.gz,rest\n')
+            with pytest.raises(SystemExit):
+                subject_fmri.read_batch_csv(batch_csv, self.arguments)
+
+    def test_exits_without_a_func_column(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            batch_csv = self.write_csv(tmpdir, 'task_label\nrest_1\n')
+            with pytest.raises(SystemExit):
+                subject_fmri.read_batch_csv(batch_csv, self.arguments)
+
+@patch('ciftify.bin.ciftify_subject_fmri.SubjectFiles.make_all')
+@patch('ciftify.bin.ciftify_subject_fmri.project_fmri')
+@patch('ciftify.bin.ciftify_subject_fmri.transform_fmri')
+class TestRunBatch(unittest.TestCase):
+
+    def test_subject_files_are_made_between_the_two_steps(self, mock_transform,
+            mock_project, mock_make_all):
+        run_settings = [FakeRunSettings('rest_1', 1), FakeRunSettings('rest_2', 1)]
+        mock_transform.side_effect = lambda settings, tmpdir: (
+            '{}_4D.nii.gz'.format(settings.fmri_label),
+            '{}_3D.nii.gz'.format(settings.fmri_label))
+        made_before_project = []
+        mock_project.side_effect = lambda *args: made_before_project.append(
+            mock_make_all.call_count)
+        with ciftify.utils.TempDir() as tmpdir:
+            subject_fmri.run_batch(run_settings, tmpdir, None)
+            run_tmpdirs = [os.path.join(tmpdir, 'rest_1'), os.path.join(tmpdir, 'rest_2')]
+            assert all(os.path.isdir(run_tmpdir) for run_tmpdir in run_tmpdirs)
+        assert mock_transform.call_count == 2
+        assert mock_make_all.call_count == 2
+        assert mock_project.call_count == 2
+        assert made_before_project == [2, 2]
+        settings, run_tmpdir, atlas_4D, atlas_3D, subject_files = mock_project.call_args_list[1][0]
+        assert settings.fmri_label == 'rest_2'
+        assert run_tmpdir == run_tmpdirs[1]
+        assert (atlas_4D, atlas_3D) == ('rest_2_4D.nii.gz', 'rest_2_3D.nii.gz')
+        assert subject_files.path == tmpdir
+
+@patch('ciftify.bin.ciftify_subject_fmri.SubjectFiles.make_all')
+@patch('ciftify.bin.ciftify_subject_fmri.project_fmri', logged_project)
+@patch('ciftify.bin.ciftify_subject_fmri.transform_fmri', logged_transform)
+class TestRunBatchInParallel(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.NOTSET)
+        self.main_log = io.StringIO()
+        self.main_handler = logging.StreamHandler(self.main_log)
+        subject_fmri.logger.addHandler(self.main_handler)
+
+    def tearDown(self):
+        subject_fmri.logger.removeHandler(self.main_handler)
+        logging.disable(logging.CRITICAL)
+
+    def run_batch(self, tmpdir, fmri_labels):
+        run_settings = [LoggedRunSettings(fmri_label, 2, self.run_log(tmpdir, fmri_label))
+                        for fmri_label in fmri_labels]
+        return subject_fmri.run_batch(run_settings, tmpdir, logging.Formatter('%(message)s'))
+
+    def run_log(self, tmpdir, fmri_label):
+        return os.path.join(tmpdir, '{}.log'.format(fmri_label))
+
+    def read_log(self, tmpdir, fmri_label):
+        with open(self.run_log(tmpdir, fmri_label)) as f:
+            return f.read()
+
+    def test_each_run_logs_to_its_own_file(self, mock_make_all):
+        with ciftify.utils.TempDir() as tmpdir:
+            self.run_batch(tmpdir, ['rest_1', 'rest_2'])
+            logs = {label: self.read_log(tmpdir, label) for label in ['rest_1', 'rest_2']}
+        for fmri_label, other_label in [('rest_1', 'rest_2'), ('rest_2', 'rest_1')]:
+            assert 'transforming {} in'.format(fmri_label) in logs[fmri_label]
+            assert 'projecting {}_4D.nii.gz in'.format(fmri_label) in logs[fmri_label]
+            assert other_label not in logs[fmri_label]
+            ## the steps ran in the worker processes
+            assert ' in {}\n'.format(os.getpid()) not in logs[fmri_label]
+        assert mock_make_all.call_count == 2
+
+    def test_run_logs_start_and_end_like_a_single_run(self, mock_make_all):
+        with ciftify.utils.TempDir() as tmpdir:
+            ret = self.run_batch(tmpdir, ['rest_1', 'rest_2'])
+            logs = {label: self.read_log(tmpdir, label) for label in ['rest_1', 'rest_2']}
+            done = [ciftify.utils.ciftify_log_endswith_done(self.run_log(tmpdir, label))
+                    for label in ['rest_1', 'rest_2']]
+        assert ret == 0
+        assert done == [True, True]
+        for log in logs.values():
+            assert log.index('Starting ciftify_subject_fmri') < log.index('transforming')
+        ## the run headers are only in the run logs
+        assert 'Starting ciftify_subject_fmri' not in self.main_log.getvalue()
+
+    def test_only_finished_runs_are_done(self, mock_make_all):
+        with ciftify.utils.TempDir() as tmpdir:
+            with pytest.raises(SystemExit):
+                self.run_batch(tmpdir, ['rest_1', 'unprojectable'])
+            done = [ciftify.utils.ciftify_log_endswith_done(self.run_log(tmpdir, label))
+                    for label in ['rest_1', 'unprojectable']]
+        assert done == [True, False]
+
+    def test_failed_run_is_reported_by_task_label(self, mock_make_all):
+        with ciftify.utils.TempDir() as tmpdir:
+            with pytest.raises(SystemExit):
+                self.run_batch(tmpdir, ['rest_1', 'broken'])
+            broken_log = self.read_log(tmpdir, 'broken')
+            rest_log = self.read_log(tmpdir, 'rest_1')
+            rest_done = ciftify.utils.ciftify_log_endswith_done(self.run_log(tmpdir, 'rest_1'))
+        assert 'could not transform broken' in broken_log
+        assert 'Run broken failed' in broken_log
+        assert 'transforming rest_1' in rest_log
+        assert 'failed' not in rest_log
+        assert 'runs broken failed' in self.main_log.getvalue()
+        assert not rest_done
+        assert mock_make_all.call_count == 0
+
+class TestSubjectFiles(unittest.TestCase):
+
+    @patch('ciftify.bin.ciftify_subject_fmri.run')
+    def test_atlas_template_is_only_made_once(self, mock_run):
+        def fake_run(cmd):
+            with open(cmd[2], 'w') as f:
+                f.write('fake dlabel')
+        mock_run.side_effect = fake_run
+        with ciftify.utils.TempDir() as tmpdir:
+            subject_files = subject_fmri.SubjectFiles(tmpdir)
+            first = subject_files.atlas_template('Atlas_ROIs.2.nii.gz')
+            second = subject_files.atlas_template('Atlas_ROIs.2.nii.gz')
+        assert first == second == os.path.join(tmpdir, 'temp_template.dlabel.nii')
+        assert mock_run.call_count == 1
+
+class TestMapVolumeToSurface(unittest.TestCase):
+
+    mesh = {'Folder': '/sub-01/MNINonLinear/Native', 'ROI': 'roi',
+            'meshname': 'native', 'tmpdir': '/tmp/native'}
+
+    @patch('ciftify.ribbon.map_volume_to_surface')
+    @patch('ciftify.bin.ciftify_subject_fmri.run')
+    def test_wb_command_is_the_default(self, mock_run, mock_map):
+        subject_fmri.map_volume_to_surface('func.nii.gz', 'rest', 'sub-01', 'L',
+            self.mesh, 1, volume_roi = 'goodvoxels.nii.gz')
+        cmd = mock_run.call_args_list[0][0][0]
+        assert cmd[:2] == ['wb_command', '-volume-to-surface-mapping']
+        assert cmd[-2:] == ['-volume-roi', 'goodvoxels.nii.gz']
+        assert mock_map.call_count == 0
+
+    @patch('ciftify.niio.surf_structure')
+    @patch('ciftify.niio.write_gii_data')
+    @patch('ciftify.ribbon.map_volume_to_surface')
+    @patch('ciftify.bin.ciftify_subject_fmri.run')
+    def test_python_mapping_saves_the_weights_with_the_surfaces(self, mock_run,
+            mock_map, mock_write, mock_structure):
+        subject_fmri.map_volume_to_surface('func.nii.gz', 'rest', 'sub-01', 'L',
+            self.mesh, 1, volume_roi = 'goodvoxels.nii.gz', python_mapping = True)
+        assert mock_run.call_count == 0
+        assert mock_map.call_args[1]['cache_dir'] == '/sub-01/MNINonLinear/Native/ribbon_weights'
+        assert mock_write.call_args[0][0] == '/tmp/native/sub-01.L.rest.native.func.gii'
+
+class TestMaskAndResample(unittest.TestCase):
+
+    src_mesh = {'Folder': '/sub-01/MNINonLinear/Native', 'ROI': 'roi',
+                'meshname': 'native', 'tmpdir': '/tmp/native'}
+    dest_mesh = {'Folder': '/sub-01/MNINonLinear/fsaverage_LR32k', 'ROI': 'atlasroi',
+                 'meshname': '32k_fs_LR', 'tmpdir': '/tmp/32k'}
+
+    @patch('ciftify.resample.resampling_weights')
+    @patch('ciftify.bin.ciftify_subject_fmri.run')
+    def test_wb_command_is_the_default(self, mock_run, mock_weights):
+        subject_fmri.mask_and_resample('rest', 'sub-01', 'L', self.src_mesh,
+                                       self.dest_mesh, 'MSMSulc')
+        cmds = [call[0][0] for call in mock_run.call_args_list]
+        assert [cmd[1] for cmd in cmds] == ['-metric-mask', '-metric-resample', '-metric-mask']
+        assert 'ADAP_BARY_AREA' in cmds[1]
+        assert mock_weights.call_count == 0
+
+    @patch('ciftify.resample.resample_gii_file')
+    @patch('ciftify.resample.mask_gii_file')
+    @patch('ciftify.resample.resampling_weights')
+    @patch('ciftify.bin.ciftify_subject_fmri.run')
+    def test_python_resampling_saves_the_weights_with_the_surfaces(self, mock_run,
+            mock_weights, mock_mask, mock_resample):
+        subject_fmri.mask_and_resample('rest', 'sub-01', 'L', self.src_mesh,
+                                       self.dest_mesh, 'MSMSulc', python_resampling = True)
+        assert mock_run.call_count == 0
+        assert mock_weights.call_args[1]['cache_dir'] == '/sub-01/MNINonLinear/Native/resample_weights'
+        assert mock_resample.call_args[0][1] == '/tmp/32k/sub-01.L.rest.32k_fs_LR.func.gii'
+
+class FakeSmoothingSettings:
+    '''the parts of the Settings used by metric_smoothing'''
+    def __init__(self, python_smoothing):
+        self.subject = type('Subject', (), {'id': 'sub-01'})
+        self.fmri_label = 'rest'
+        self.smoothing = subject_fmri.Smoothing('4')
+        self.python_smoothing = python_smoothing
+
+class TestMetricSmoothing(unittest.TestCase):
+
+    mesh = {'Folder': '/sub-01/MNINonLinear/fsaverage_LR32k', 'ROI': 'atlasroi',
+            'meshname': '32k_fs_LR', 'tmpdir': '/tmp/32k'}
+
+    @patch('ciftify.smoothing.smooth_metric')
+    @patch('ciftify.bin.ciftify_subject_fmri.run')
+    def test_wb_command_is_the_default(self, mock_run, mock_smooth):
+        subject_fmri.metric_smoothing('L', FakeSmoothingSettings(False), self.mesh)
+        cmd = mock_run.call_args[0][0]
+        assert cmd[:2] == ['wb_command', '-metric-smoothing']
+        assert cmd[3:6] == ['/tmp/32k/sub-01.L.rest.32k_fs_LR.func.gii',
+                            str(subject_fmri.Smoothing('4').sigma),
+                            '/tmp/32k/sub-01.L.rest_s4.32k_fs_LR.func.gii']
+        assert cmd[-2] == '-roi'
+        assert mock_smooth.call_count == 0
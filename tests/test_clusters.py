@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import logging
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from unittest.mock import patch
+
+import ciftify.clusters as clusters
+import ciftify.niio
+import ciftify.utils
+
+from tests.mesh_fixtures import grid_coords, grid_triangles
+
+logging.disable(logging.CRITICAL)
+
+def make_brain_models(n_vertices = 25, voxels = None):
+    '''a left cortex (all vertices) and, optionally, a thalamus of the given voxels'''
+    brain_models = nib.cifti2.BrainModelAxis.from_mask(np.ones(n_vertices),
+                                                       name = 'CortexLeft')
+    if voxels is not None:
+        mask = np.zeros((4, 4, 4))
+        mask[tuple(np.array(voxels).T)] = 1
+        brain_models = brain_models + nib.cifti2.BrainModelAxis.from_mask(
+            mask, affine = np.diag([2, 2, 2, 1]), name = 'ThalamusLeft')
+    return brain_models
+
+@patch('ciftify.niio.load_surf_triangles')
+class TestCiftiGraph(unittest.TestCase):
+
+    def make_graph(self, mock_triangles, voxels = None):
+        mock_triangles.return_value = grid_triangles()
+        return clusters.CiftiGraph(make_brain_models(voxels = voxels),
+                                   surfaces = {'L': 'L.surf.gii', 'R': None},
+                                   vertex_areas = {'L': np.ones(25), 'R': np.ones(25)})
+
+    def test_threshold_is_strict(self, mock_triangles):
+        graph = self.make_graph(mock_triangles)
+        data = np.zeros(25)
+        data[[0, 1, 2]] = [2, 3, 3]
+        labels = graph.find_clusters(data, 2, min_area = 0, min_volume = 0)
+        assert list(np.flatnonzero(labels)) == [1, 2]
+
+    def test_small_clusters_are_dropped(self, mock_triangles):
+        graph = self.make_graph(mock_triangles)
+        data = np.zeros(25)
+        data[[0, 1, 2]] = 5
+        data[24] = 5
+        labels = graph.find_clusters(data, 1, min_area = 2, min_volume = 0)
+        assert list(labels[[0, 1, 2]]) == [1, 1, 1]
+        assert labels[24] == 0
+
+    def test_clusters_are_numbered_by_their_first_vertex(self, mock_triangles):
+        graph = self.make_graph(mock_triangles)
+        data = np.zeros(25)
+        data[[20, 21]] = 10
+        data[[3, 4]] = 2
+        labels = graph.find_clusters(data, 1, min_area = 0, min_volume = 0, start = 3)
+        assert labels[3] == 3
+        assert labels[20] == 4
+
+    def test_negative_clusters_are_numbered_after_the_positive(self, mock_triangles):
+        graph = self.make_graph(mock_triangles)
+        data = np.zeros(25)
+        data[[0, 1]] = 5
+        data[[23, 24]] = 5
+        data[[10, 15]] = -5
+        labels = graph.find_signed_clusters(data, -1, 1, min_area = 0, min_volume = 0)
+        assert labels[0] == 1
+        assert labels[24] == 2
+        assert labels[10] == labels[15] == 3
+
+    def test_voxels_only_connect_across_faces(self, mock_triangles):
+        voxels = [[0, 0, 0], [1, 0, 0], [2, 1, 0], [3, 3, 3]]
+        graph = self.make_graph(mock_triangles, voxels = voxels)
+        data = np.hstack((np.zeros(25), np.full(4, 5.0)))
+        labels = graph.find_clusters(data, 1, min_area = 0, min_volume = 16)
+        ## the first two voxels are one cluster of 16 mm^3, the others are too small
+        assert list(labels[25:]) == [1, 1, 0, 0]
+
+    def test_surface_data_fills_every_vertex(self, mock_triangles):
+        graph = self.make_graph(mock_triangles, voxels = [[0, 0, 0]])
+        surf_data = graph.surface_data(np.arange(26), 'L', 25)
+        assert np.array_equal(surf_data, np.arange(25))
+
+@patch('ciftify.niio.load_surf_triangles')
+class TestClustersAtThresholds(unittest.TestCase):
+
+    def test_matches_finding_clusters_at_each_threshold(self, mock_triangles):
+        mock_triangles.return_value = grid_triangles()
+        graph = clusters.CiftiGraph(make_brain_models(voxels = [[0, 0, 0], [1, 0, 0], [3, 3, 3]]),
+                                    surfaces = {'L': 'L.surf.gii', 'R': None},
+                                    vertex_areas = {'L': np.ones(25), 'R': np.ones(25)})
+        data = np.random.RandomState(2).normal(size = 28) * 2
+        thresholds = [(-1, 1), (-0.5, 2), (-2, 0.5), (-1, 1)]
+        all_labels = graph.find_signed_clusters_at_thresholds(data, thresholds,
+                                                              min_area = 2, min_volume = 8)
+        assert len(all_labels) == 4
+        for (min_t, max_t), labels in zip(thresholds, all_labels):
+            expected = graph.find_signed_clusters(data, min_t, max_t,
+                                                  min_area = 2, min_volume = 8)
+            assert np.array_equal(labels, expected)
+
+    def test_threshold_extrema_keeps_the_peaks_past_the_thresholds(self, mock_triangles):
+        extrema = np.array([1, 1, -1, -1, 0], dtype = np.int8)
+        data = np.array([3, 1.5, -3, -1.5, 5])
+        result = clusters.threshold_extrema(extrema, data, -2, 2)
+        assert list(result) == [1, 0, -1, 0, 0]
+
+@patch('ciftify.niio.load_surf_coords')
+@patch('ciftify.niio.load_surf_triangles')
+class TestFindExtrema(unittest.TestCase):
+
+    def make_graph(self, mock_triangles, mock_coords, voxels = None):
+        mock_triangles.return_value = grid_triangles()
+        mock_coords.return_value = grid_coords()
+        return clusters.CiftiGraph(make_brain_models(voxels = voxels),
+                                   surfaces = {'L': 'L.surf.gii', 'R': None},
+                                   vertex_areas = {'L': np.ones(25), 'R': np.ones(25)})
+
+    def test_peaks_further_apart_than_the_distance_are_kept(self, mock_triangles, mock_coords):
+        graph = self.make_graph(mock_triangles, mock_coords)
+        data = np.zeros(25)
+        data[[0, 24]] = [3, 4]
+        extrema = graph.find_extrema(data, 2, 2, -1, 1)
+        assert list(np.flatnonzero(extrema)) == [0, 24]
+        assert np.all(extrema[[0, 24]] == 1)
+
+    def test_smaller_peaks_within_the_distance_are_dropped(self, mock_triangles, mock_coords):
+        graph = self.make_graph(mock_triangles, mock_coords)
+        data = np.zeros(25)
+        data[[0, 2]] = [3, 4]
+        assert list(np.flatnonzero(graph.find_extrema(data, 3, 3, -1, 1))) == [2]
+        assert list(np.flatnonzero(graph.find_extrema(data, 1.5, 1.5, -1, 1))) == [0, 2]
+
+    def test_minima_and_thresholds(self, mock_triangles, mock_coords):
+        graph = self.make_graph(mock_triangles, mock_coords)
+        data = np.zeros(25)
+        data[[0, 12, 24]] = [-3, 0.5, 2]
+        extrema = graph.find_extrema(data, 2, 2, -2, 2)
+        assert extrema[0] == -1
+        assert extrema[12] == 0
+        assert extrema[24] == 1
+
+    def test_volume_peaks_use_the_distance_in_mm(self, mock_triangles, mock_coords):
+        voxels = [[0, 0, 0], [1, 0, 0], [2, 0, 0], [3, 0, 0]]
+        graph = self.make_graph(mock_triangles, mock_coords, voxels = voxels)
+        data = np.hstack((np.zeros(25), [5, 1, 1, 4]))
+        ## the voxels are 2mm apart
+        extrema = graph.find_extrema(data, 1, 5, -1, 1)
+        assert list(extrema[25:]) == [1, 0, 0, 1]
+        extrema = graph.find_extrema(data, 1, 7, -1, 1)
+        assert list(extrema[25:]) == [1, 0, 0, 0]
+
+@patch('ciftify.niio.load_surf_triangles')
+class TestTFCE(unittest.TestCase):
+
+    def make_graph(self, mock_triangles, voxels = None):
+        mock_triangles.return_value = grid_triangles()
+        return clusters.CiftiGraph(make_brain_models(voxels = voxels),
+                                   surfaces = {'L': 'L.surf.gii', 'R': None},
+                                   vertex_areas = {'L': np.full(25, 2.0), 'R': np.ones(25)})
+
+    def thresholded_sum(self, graph, data, E_surface, E_volume, H, dh):
+        '''the TFCE scores from finding the clusters at every threshold'''
+        scores = np.zeros(len(data))
+        exponents = np.where(graph.is_surface, E_surface, E_volume)
+        for sign in [1, -1]:
+            levels = np.floor(sign * data / dh).astype(int)
+            for level in range(1, levels.max() + 1):
+                component, n_components = graph.components(levels >= level)
+                inside = component >= 0
+                extent = np.bincount(component[inside], weights = graph.sizes[inside],
+                                     minlength = n_components)
+                scores[inside] += sign * (extent[component[inside]]**exponents[inside]
+                                          * (level * dh)**H * dh)
+        return scores
+
+    def test_one_vertex(self, mock_triangles):
+        graph = self.make_graph(mock_triangles)
+        data = np.zeros(25)
+        data[12] = 0.35
+        scores = graph.tfce(data, E_surface = 1, H = 2, dh = 0.1)
+        ## thresholds 0.1, 0.2 and 0.3 with an area of 2
+        assert np.isclose(scores[12], 2 * (0.01 + 0.04 + 0.09) * 0.1)
+        assert np.all(np.delete(scores, 12) == 0)
+
+    def test_matches_clusters_at_every_threshold(self, mock_triangles):
+        voxels = [[0, 0, 0], [1, 0, 0], [2, 0, 0], [3, 3, 3]]
+        graph = self.make_graph(mock_triangles, voxels = voxels)
+        data = np.random.RandomState(1).normal(size = 29) * 2
+        scores = graph.tfce(data, E_surface = 1, E_volume = 0.5, H = 2, dh = 0.05)
+        expected = self.thresholded_sum(graph, data, 1, 0.5, 2, 0.05)
+        assert np.allclose(scores, expected)
+        assert np.all(np.sign(scores[scores != 0]) == np.sign(data[scores != 0]))
+
+class TestVolumePeakTable(unittest.TestCase):
+
+    def setUp(self):
+        ## two structures side by side, 2mm voxels
+        left = np.zeros((8, 4, 4))
+        left[:4] = 1
+        right = np.zeros((8, 4, 4))
+        right[4:] = 1
+        affine = np.diag([2, 2, 2, 1])
+        self.brain_models = (
+            nib.cifti2.BrainModelAxis.from_mask(left, affine = affine, name = 'ThalamusLeft') +
+            nib.cifti2.BrainModelAxis.from_mask(right, affine = affine, name = 'ThalamusRight'))
+
+    def volume_data(self, grid):
+        return grid[tuple(self.brain_models.voxel.T)]
+
+    def test_peaks_of_positive_and_negative_clusters(self):
+        grid = np.zeros((8, 4, 4))
+        grid[0:2, 0, 0] = [3, 2]
+        grid[5:8, 3, 3] = [-2, -4, -2]
+        df = clusters.volume_peak_table(self.volume_data(grid), self.brain_models,
+                                        -1, 1, volume_distance = 4, min_volume = 0)
+        assert list(df.clusterID) == [1, 2]
+        assert list(df.structure) == ['THALAMUS_LEFT', 'THALAMUS_RIGHT']
+        assert list(df.loc[1, ['i', 'j', 'k']]) == [6, 3, 3]
+        assert list(df.loc[1, ['x', 'y', 'z']]) == [12, 6, 6]
+        assert list(df.peak_value) == [3, -4]
+        assert list(df.cluster_volume) == [16, 24]
+
+    def test_clusters_cross_structures_and_peaks_are_apart(self):
+        grid = np.zeros((8, 4, 4))
+        grid[:, 1, 1] = [5, 2, 2, 2, 2, 2, 2, 4]
+        df = clusters.volume_peak_table(self.volume_data(grid), self.brain_models,
+                                        -1, 1, volume_distance = 6, min_volume = 0)
+        assert list(df.clusterID) == [1, 1]
+        assert list(df.i) == [0, 7]
+        df = clusters.volume_peak_table(self.volume_data(grid), self.brain_models,
+                                        -1, 1, volume_distance = 20, min_volume = 0)
+        assert list(df.i) == [0]
+
+    def test_nearby_clusters_each_keep_their_peak(self):
+        grid = np.zeros((8, 4, 4))
+        grid[0:4, 1, 1] = [5, 0, 0, 4]
+        df = clusters.volume_peak_table(self.volume_data(grid), self.brain_models,
+                                        -1, 1, volume_distance = 20, min_volume = 0)
+        assert list(df.clusterID) == [1, 2]
+        assert list(df.i) == [0, 3]
+        assert list(df.peak_value) == [5, 4]
+
+    def test_tied_peaks_are_one_row(self):
+        grid = np.zeros((8, 4, 4))
+        grid[0:3, 1, 1] = [3, 3, 2]
+        df = clusters.volume_peak_table(self.volume_data(grid), self.brain_models,
+                                        -1, 1, volume_distance = 4, min_volume = 0)
+        assert len(df) == 1
+        assert df.peak_value[0] == 3
+
+    def test_small_clusters_are_dropped_and_cluster_labels_are_used(self):
+        grid = np.zeros((8, 4, 4))
+        grid[0, 0, 0] = 3
+        grid[4:7, 2, 2] = 3
+        data = self.volume_data(grid)
+        df = clusters.volume_peak_table(data, self.brain_models, -1, 1,
+                                        volume_distance = 2, min_volume = 16)
+        assert list(df.clusterID.unique()) == [1]
+        assert list(df.i) == [4]
+        df = clusters.volume_peak_table(data, self.brain_models, -1, 1,
+                                        volume_distance = 2, min_volume = 16,
+                                        cluster_labels = np.full(len(data), 7))
+        assert list(df.clusterID.unique()) == [7]
+
+class TestSphereMaxima(unittest.TestCase):
+
+    def test_matches_a_maximum_filter_of_the_sphere(self):
+        values = np.random.RandomState(2).rand(9, 8, 7)
+        mask = np.ones(values.shape, dtype = bool)
+        for voxel_sizes in [(2, 2, 2), (1, 1.5, 2)]:
+            for distance in [0, 1, 2, 2.9, 3, 3.5, 4]:
+                footprint = clusters.sphere_footprint(distance, voxel_sizes)
+                expected = np.argwhere(values == ndimage.maximum_filter(values,
+                        footprint = footprint, mode = 'constant', cval = -np.inf))
+                peaks = clusters.sphere_maxima(values, footprint, mask)
+                assert np.array_equal(peaks, expected), (voxel_sizes, distance)
+
+class TestWriteCifti2Dlabel(unittest.TestCase):
+
+    def test_labels_are_named_like_wb_label_import(self):
+        labels = np.array([0, 1, 1, 3, 0])
+        with ciftify.utils.TempDir() as tmpdir:
+            dlabel = os.path.join(tmpdir, 'clust.dlabel.nii')
+            ciftify.niio.write_cifti2_dlabel(dlabel, labels, make_brain_models(5))
+            img = nib.load(dlabel)
+            data = np.asanyarray(img.dataobj)
+            label_table = img.header.get_axis(0).label[0]
+        assert np.array_equal(data[0], labels)
+        assert label_table[0][0] == '???'
+        assert label_table[1][0] == 'LABEL_1'
+        assert label_table[3][0] == 'LABEL_3'
+        assert 2 not in label_table
+
+if __name__ == '__main__':
+    unittest.main()
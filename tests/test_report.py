@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import logging
+
+import numpy as np
+import pandas as pd
+from unittest.mock import patch
+
+import ciftify.utils
+
+import ciftify.report as report
+
+logging.disable(logging.CRITICAL)
+
+class TestOverlapMatrix(unittest.TestCase):
+
+    clust_data = np.array([[1], [1], [1], [2], [2], [0]])
+    atlas_data = np.array([[5], [5], [6], [6], [6], [6]])
+    surf_va = np.array([[1.0], [1.0], [2.0], [1.0], [3.0], [1.0]])
+    atlas_dict = {5: 'first', 6: 'second', 7: 'unused'}
+
+    def test_overlap_is_area_weighted(self):
+        overlap = report.calc_overlap_matrix(self.clust_data, self.atlas_data, self.surf_va)
+        assert overlap.loc[1, 5] == 2.0
+        assert overlap.loc[1, 6] == 2.0
+        assert overlap.loc[2, 5] == 0
+        assert overlap.loc[2, 6] == 4.0
+
+    def test_label_areas(self):
+        areas = report.calc_label_areas(self.clust_data, self.surf_va)
+        assert areas[1] == 4.0
+        assert areas[2] == 4.0
+
+    def test_peak_overlaps_are_fractions_of_cluster_area(self):
+        overlaps = report.calc_peak_overlaps([1, 2, 2], [5, 6, 5], self.clust_data,
+                                             self.atlas_data, self.surf_va)
+        assert np.allclose(overlaps, [0.5, 1.0, 0.0])
+
+    def test_summaries_list_labels_by_percent(self):
+        summaries = report.get_label_overlap_summaries([1, 2, 3], self.clust_data,
+            self.atlas_data, self.atlas_dict, self.surf_va)
+        assert summaries[0] == 'first (50.0%); second (50.0%); '
+        assert summaries[1] == 'second (100.0%); '
+        assert summaries[2] == ''
+
+@patch('ciftify.niio.load_hemisphere_labels')
+class TestAtlasCache(unittest.TestCase):
+
+    def fake_labels(self, filename, wb_structure, map_number = 1):
+        labels = np.array([0, 1, 1, 2]) if wb_structure == 'CORTEX_LEFT' else np.array([2, 2, 0, 1])
+        return labels, {0: '???', 1: 'first', 2: 'second'}
+
+    def test_atlas_is_decoded_once(self, mock_labels):
+        mock_labels.side_effect = self.fake_labels
+        with ciftify.utils.TempDir() as tmpdir:
+            atlas = {'path': os.path.join(tmpdir, 'atlas.dlabel.nii'), 'map_number': 1}
+            with open(atlas['path'], 'w') as f:
+                f.write('fake atlas')
+            with patch.dict(os.environ, {'CIFTIFY_CACHE': tmpdir}):
+                first_data, first_dict = report.load_LR_atlas_labels(atlas)
+                second_data, second_dict = report.load_LR_atlas_labels(atlas)
+        assert mock_labels.call_count == 2
+        assert second_data.dtype == np.int16
+        assert np.array_equal(second_data, [0, 1, 1, 2, 2, 2, 0, 1])
+        assert second_dict == {0: '???', 1: 'first', 2: 'second'}
+
+    def test_changed_atlas_is_decoded_again(self, mock_labels):
+        mock_labels.side_effect = self.fake_labels
+        with ciftify.utils.TempDir() as tmpdir:
+            atlas = {'path': os.path.join(tmpdir, 'atlas.dlabel.nii'), 'map_number': 1}
+            with open(atlas['path'], 'w') as f:
+                f.write('fake atlas')
+            with patch.dict(os.environ, {'CIFTIFY_CACHE': tmpdir}):
+                report.load_atlas_labels(atlas, 'CORTEX_LEFT')
+                os.utime(atlas['path'], (0, 0))
+                report.load_atlas_labels(atlas, 'CORTEX_LEFT')
+        assert mock_labels.call_count == 4
+
+    def test_each_atlas_has_its_own_cache_file(self, mock_labels):
+        mock_labels.side_effect = self.fake_labels
+        with ciftify.utils.TempDir() as tmpdir:
+            atlases = []
+            for name in ['first', 'second']:
+                atlases.append({'path': os.path.join(tmpdir, '{}.dlabel.nii'.format(name)),
+                                'map_number': 1})
+                with open(atlases[-1]['path'], 'w') as f:
+                    f.write('fake atlas')
+            with patch.dict(os.environ, {'CIFTIFY_CACHE': tmpdir}):
+                for atlas in atlases:
+                    report.load_atlas_labels(atlas, 'CORTEX_LEFT')
+                cached = os.listdir(os.path.join(tmpdir, 'atlases'))
+                second_cache = report.atlas_cache_file(atlases[1]['path'], 'atlas_map1')
+                with patch('numpy.load', wraps = np.load) as mock_load:
+                    report.load_atlas_labels(atlases[1], 'CORTEX_LEFT')
+        assert len(cached) == 2
+        assert mock_labels.call_count == 4
+        ## only the second atlas's own file is read
+        assert [call[0][0] for call in mock_load.call_args_list] == [second_cache]
+
+class TestNearestLabels(unittest.TestCase):
+
+    coords = np.array([[0.0, 0, 0], [1.0, 0, 0], [5.0, 0, 0], [9.0, 0, 0]])
+    label_data = np.array([3, 0, 0, 4])
+
+    def test_unlabelled_vertices_are_skipped(self):
+        tree = report.NearestLabelTree(self.coords, self.label_data)
+        labels, distances = tree.query(self.coords)
+        assert list(labels) == [3, 3, 4, 4]
+        assert np.allclose(distances, [0, 1, 4, 0])
+
+    def test_no_labelled_vertices(self):
+        tree = report.NearestLabelTree(self.coords, np.zeros(4))
+        labels, distances = tree.query(self.coords[:2])
+        assert list(labels) == [0, 0]
+        assert np.all(np.isinf(distances))
+
+    @patch('ciftify.niio.load_surf_coords')
+    def test_tree_is_built_once(self, mock_coords):
+        mock_coords.return_value = self.coords
+        with patch.dict(report.NEAREST_LABEL_TREES, clear = True):
+            report.find_nearest_labels([[4.0, 0, 0]], 'surf.gii', 'CORTEX_LEFT', 'atlas', self.label_data)
+            labels, _ = report.find_nearest_labels([[4.0, 0, 0]], 'surf.gii', 'CORTEX_LEFT',
+                                                   'atlas', self.label_data)
+        assert mock_coords.call_count == 1
+        assert list(labels) == [3]
+
+    @patch('ciftify.niio.load_surf_coords')
+    def test_nearest_label_columns(self, mock_coords):
+        mock_coords.return_value = self.coords
+        df = pd.DataFrame({'x': [1.0, 8.0], 'y': [0.0, 0.0], 'z': [0.0, 0.0]})
+        with patch.dict(report.NEAREST_LABEL_TREES, clear = True):
+            df = report.calc_nearest_labels(df, 'surf.gii', 'CORTEX_LEFT', 'atlas',
+                                            self.label_data, {3: 'label_3'})
+        assert list(df.atlas_nearest) == ['label_3', '']
+        assert np.allclose(df.atlas_nearest_mm, [1, 1])
+
+class TestDefineMaps(unittest.TestCase):
+
+    map_names = ['contrast_a', 'contrast_b', 'contrast_c']
+
+    def test_all_maps_by_default(self):
+        assert report.define_maps(None, self.map_names) == [0, 1, 2]
+
+    def test_maps_by_number_or_name(self):
+        assert report.define_maps('3, contrast_a', self.map_names) == [2, 0]
+
+    def test_exits_for_missing_map(self):
+        with self.assertRaises(SystemExit):
+            report.define_maps('4', self.map_names)
+
+def table_of_sums(map_data, outputbase, settings):
+    return [({'scale': settings}, pd.DataFrame({'outputbase': [outputbase],
+                                                'total': [map_data.sum() * settings]}))]
+
+class TestMapJobs(unittest.TestCase):
+
+    map_jobs = [(np.array([1.0, 2.0]), 'out_map1'), (np.array([3.0, 4.0]), 'out_map2')]
+
+    def test_serial_and_parallel_results_match(self):
+        serial = report.run_map_jobs(table_of_sums, self.map_jobs, 10, n_cpus = 1)
+        parallel = report.run_map_jobs(table_of_sums, self.map_jobs, 10, n_cpus = 2)
+        for serial_tables, parallel_tables in zip(serial, parallel):
+            assert serial_tables[0][1].equals(parallel_tables[0][1])
+        assert serial[1][0][1].loc[0, 'total'] == 70.0
+
+    def test_long_table_has_map_columns(self):
+        tables = report.run_map_jobs(table_of_sums, self.map_jobs, 10, n_cpus = 1)
+        with ciftify.utils.TempDir() as tmpdir:
+            outputcsv = os.path.join(tmpdir, 'long.csv')
+            report.write_long_table(outputcsv, [0, 2], ['a', 'b', 'c'], tables)
+            df = pd.read_csv(outputcsv)
+        assert list(df.columns) == ['map_number', 'map_name', 'scale', 'outputbase', 'total']
+        assert list(df.map_number) == [1, 3]
+        assert list(df.map_name) == ['a', 'c']
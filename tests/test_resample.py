@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import shutil
+import logging
+import subprocess
+
+import numpy as np
+import nibabel as nib
+from unittest.mock import patch
+
+import ciftify.resample as resample
+import ciftify.niio
+import ciftify.surface
+import ciftify.utils
+
+logging.disable(logging.CRITICAL)
+
+def icosphere(subdivisions):
+    '''a sphere of radius 100 made by subdividing an icosahedron'''
+    t = (1 + np.sqrt(5)) / 2
+    coords = np.array([[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0],
+                       [0, -1, t], [0, 1, t], [0, -1, -t], [0, 1, -t],
+                       [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]], dtype = float)
+    triangles = np.array([[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11],
+                          [1, 5, 9], [5, 11, 4], [11, 10, 2], [10, 7, 6], [7, 1, 8],
+                          [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9],
+                          [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]])
+    for _ in range(subdivisions):
+        edges = np.sort(np.vstack((triangles[:, [0, 1]], triangles[:, [1, 2]],
+                                   triangles[:, [2, 0]])), axis = 1)
+        edges, midpoint = np.unique(edges, axis = 0, return_inverse = True)
+        midpoint = midpoint.reshape(3, -1).T + coords.shape[0]
+        coords = np.vstack((coords, coords[edges].mean(axis = 1)))
+        a, b, c = triangles.T
+        ab, bc, ca = midpoint.T
+        triangles = np.vstack((np.column_stack((a, ab, ca)), np.column_stack((b, bc, ab)),
+                               np.column_stack((c, ca, bc)), np.column_stack((ab, bc, ca))))
+    coords = 100 * coords / np.linalg.norm(coords, axis = 1, keepdims = True)
+    return coords, triangles
+
+def rotated(coords, angle = 0.3):
+    '''the coordinates rotated around the z axis, so the two meshes do not line up'''
+    c, s = np.cos(angle), np.sin(angle)
+    return coords.dot(np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]]).T)
+
+def smooth_function(coords):
+    return np.sin(coords[:, 0] / 40) + coords[:, 2] / 100
+
+class TestBarycentricWeights(unittest.TestCase):
+
+    def test_vertices_of_the_same_sphere_map_to_themselves(self):
+        coords, triangles = icosphere(2)
+        weights = resample.barycentric_weights(coords, triangles, coords)
+        assert np.allclose(weights.toarray(), np.eye(coords.shape[0]))
+
+    def test_points_are_interpolated_in_their_triangle(self):
+        coords, triangles = icosphere(4)
+        points, _ = icosphere(2)
+        points = rotated(points)
+        weights = resample.barycentric_weights(coords, triangles, points)
+        assert np.all(np.diff(weights.indptr) <= 3)
+        assert np.allclose(np.asarray(weights.sum(axis = 1)).ravel(), 1)
+        assert np.allclose(weights.dot(smooth_function(coords)),
+                           smooth_function(points), atol = 0.01)
+
+class TestAdapBaryAreaWeights(unittest.TestCase):
+
+    def setUp(self):
+        self.high_coords, self.high_triangles = icosphere(4)
+        low_coords, self.low_triangles = icosphere(2)
+        self.low_coords = rotated(low_coords)
+        self.high_areas = ciftify.surface.vertex_areas(self.high_coords, self.high_triangles)
+        self.low_areas = ciftify.surface.vertex_areas(self.low_coords, self.low_triangles)
+
+    def test_downsampling_gathers_from_many_vertices(self):
+        weights = resample.adap_bary_area_weights(self.high_coords, self.high_triangles,
+                self.low_coords, self.low_triangles, self.high_areas, self.low_areas)
+        assert weights.shape == (self.low_coords.shape[0], self.high_coords.shape[0])
+        assert np.diff(weights.indptr).min() > 3
+        assert np.allclose(np.asarray(weights.sum(axis = 1)).ravel(), 1)
+        assert np.allclose(weights.dot(smooth_function(self.high_coords)),
+                           smooth_function(self.low_coords), atol = 0.05)
+
+    def test_upsampling_uses_the_enclosing_triangle(self):
+        weights = resample.adap_bary_area_weights(self.low_coords, self.low_triangles,
+                self.high_coords, self.high_triangles, self.low_areas, self.high_areas)
+        assert np.diff(weights.indptr).max() <= 3
+        assert np.allclose(np.asarray(weights.sum(axis = 1)).ravel(), 1)
+
+    def test_vertices_outside_the_roi_are_not_used(self):
+        roi = self.high_coords[:, 2] > 0
+        weights = resample.adap_bary_area_weights(self.high_coords, self.high_triangles,
+                self.low_coords, self.low_triangles, self.high_areas, self.low_areas, roi)
+        assert weights[:, ~roi].nnz == 0
+        resampled = weights.dot(np.ones(self.high_coords.shape[0]))
+        assert np.allclose(resampled[self.low_coords[:, 2] > 20], 1)
+        assert np.all(resampled[self.low_coords[:, 2] < -20] == 0)
+
+    def test_roi_is_applied_before_choosing_forward_or_reverse(self):
+        ## between meshes of the same density the counts are close, so the roi changes the choice
+        current_coords, current_triangles = icosphere(3)
+        new_coords = rotated(current_coords)
+        roi = np.arange(current_coords.shape[0]) % 3 == 0
+        areas = ciftify.surface.vertex_areas(current_coords, current_triangles)
+        weights = resample.adap_bary_area_weights(current_coords, current_triangles,
+                new_coords, current_triangles, areas, areas, roi)
+        forward = resample.barycentric_weights(current_coords, current_triangles,
+                                               new_coords)[:, roi].tocsr()
+        reverse = resample.barycentric_weights(new_coords, current_triangles,
+                                               current_coords).T.tocsr()[:, roi].tocsr()
+        use_forward = np.diff(forward.indptr) >= np.diff(reverse.indptr)
+        for row in range(weights.shape[0]):
+            chosen = forward if use_forward[row] else reverse
+            assert np.array_equal(np.sort(weights[row, roi].indices), np.sort(chosen[row].indices))
+
+@patch('ciftify.niio.load_surf_triangles')
+@patch('ciftify.niio.load_surf_coords')
+class TestResamplingWeightsCache(unittest.TestCase):
+
+    def test_weights_are_read_from_the_cache_dir(self, mock_coords, mock_triangles):
+        high_coords, high_triangles = icosphere(3)
+        low_coords, low_triangles = icosphere(2)
+        mock_coords.side_effect = lambda surf: high_coords if 'high' in surf else low_coords
+        mock_triangles.side_effect = lambda surf: high_triangles if 'high' in surf else low_triangles
+        with ciftify.utils.TempDir() as tmpdir:
+            surfs = []
+            for name in ['high', 'low']:
+                surfs.append(os.path.join(tmpdir, 'fake.{}.surf.gii'.format(name)))
+                with open(surfs[-1], 'w') as f:
+                    f.write('fake {} sphere'.format(name))
+            cache_dir = os.path.join(tmpdir, 'resample_weights')
+            first = resample.resampling_weights(surfs[0], surfs[1], surfs[0], surfs[1],
+                                                cache_dir = cache_dir)
+            cached = os.listdir(cache_dir)
+            with patch('ciftify.resample.adap_bary_area_weights') as mock_build:
+                second = resample.resampling_weights(surfs[0], surfs[1], surfs[0], surfs[1],
+                                                     cache_dir = cache_dir)
+                assert mock_build.call_count == 0
+        assert len(cached) == 1
+        assert abs(first - second).max() == 0
+
+class TestMatchesWorkbench(unittest.TestCase):
+    '''
+    compares the resampling with wb_command -metric-resample ADAP_BARY_AREA
+    -area-surfs -current-roi between two icospheres, using the stored wb_command
+    output in tests/data/resample (written by running wb_command on the inputs
+    made here) or running wb_command when it is installed
+    '''
+    fixture = os.path.join(os.path.dirname(__file__), 'data', 'resample',
+                           'wb_adap_bary_area.func.gii')
+    ## every vertex within 1% of the range of the metric
+    tolerance = 0.01
+
+    def write_gii(self, filename, *darrays):
+        gii = nib.gifti.GiftiImage(meta = nib.gifti.GiftiMetaData.from_dict(
+            {'AnatomicalStructurePrimary': 'CortexLeft'}))
+        for data, intent in darrays:
+            gii.add_gifti_data_array(nib.gifti.GiftiDataArray(data, intent = intent))
+        nib.save(gii, filename)
+        return filename
+
+    def write_inputs(self, tmpdir):
+        current_coords, current_triangles = icosphere(4)
+        new_coords, new_triangles = icosphere(2)
+        new_coords = rotated(new_coords)
+        spheres = {}
+        for name, coords, triangles in [('current', current_coords, current_triangles),
+                                        ('new', new_coords, new_triangles)]:
+            spheres[name] = self.write_gii(os.path.join(tmpdir, 'L.{}.sphere.surf.gii'.format(name)),
+                (coords.astype(np.float32), 'NIFTI_INTENT_POINTSET'),
+                (triangles.astype(np.int32), 'NIFTI_INTENT_TRIANGLE'))
+        metric_data = smooth_function(current_coords).astype(np.float32)
+        metric = self.write_gii(os.path.join(tmpdir, 'L.metric.func.gii'),
+                                (metric_data, 'NIFTI_INTENT_NORMAL'))
+        roi = self.write_gii(os.path.join(tmpdir, 'L.roi.shape.gii'),
+            ((current_coords[:, 2] > -30).astype(np.float32), 'NIFTI_INTENT_NORMAL'))
+        return spheres, metric, roi, metric_data
+
+    def workbench_output(self, tmpdir, spheres, metric, roi):
+        if os.path.exists(self.fixture):
+            return self.fixture
+        if not shutil.which('wb_command'):
+            self.skipTest('no stored wb_command output and wb_command is not installed')
+        output = os.path.join(tmpdir, 'wb_adap_bary_area.func.gii')
+        subprocess.check_call(['wb_command', '-metric-resample', metric,
+                               spheres['current'], spheres['new'], 'ADAP_BARY_AREA', output,
+                               '-area-surfs', spheres['current'], spheres['new'],
+                               '-current-roi', roi])
+        return output
+
+    def test_matches_wb_command(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            spheres, metric, roi, metric_data = self.write_inputs(tmpdir)
+            expected = ciftify.niio.load_gii_data(
+                self.workbench_output(tmpdir, spheres, metric, roi))
+            weights = resample.resampling_weights(spheres['current'], spheres['new'],
+                spheres['current'], spheres['new'], current_roi = roi, use_cache = False)
+            output = os.path.join(tmpdir, 'L.resampled.func.gii')
+            resample.resample_gii_file(metric, output, weights)
+            resampled = ciftify.niio.load_gii_data(output)
+        assert resampled.shape == expected.shape
+        assert np.allclose(resampled, expected, rtol = 0,
+                           atol = self.tolerance * np.ptp(metric_data))
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import shutil
+import logging
+import subprocess
+
+import numpy as np
+import nibabel as nib
+from unittest.mock import patch
+
+import ciftify.ribbon as ribbon
+import ciftify.niio
+import ciftify.utils
+
+from tests.mesh_fixtures import grid_triangles
+
+logging.disable(logging.CRITICAL)
+
+VOL_SHAPE = (12, 12, 8)
+AFFINE = np.eye(4)
+
+def flat_slab(n = 8):
+    '''
+    a flat square mesh of n x n vertices as the white surface at z ~ 2 and the
+    pial surface at z ~ 5, with coordinates off the voxel grid
+    '''
+    x, y = np.meshgrid(np.linspace(1.3, 9.7, n), np.linspace(1.2, 9.9, n))
+    white = np.column_stack((x.ravel(), y.ravel(), np.full(n * n, 2.0 + np.pi / 10)))
+    pial = white.copy()
+    pial[:, 2] = 5.0 + np.e / 10
+    return white, pial, grid_triangles(n)
+
+def ring_areas(coords, triangles):
+    '''the area of all triangles around each vertex'''
+    edges1 = coords[triangles[:, 1]] - coords[triangles[:, 0]]
+    edges2 = coords[triangles[:, 2]] - coords[triangles[:, 0]]
+    areas = 0.5 * np.linalg.norm(np.cross(edges1, edges2), axis = 1)
+    return np.bincount(triangles.ravel(), weights = np.repeat(areas, 3),
+                       minlength = coords.shape[0])
+
+class TestRibbonWeights(unittest.TestCase):
+
+    def setUp(self):
+        self.white, self.pial, self.triangles = flat_slab()
+
+    def test_weights_add_up_to_the_polyhedron_volume(self):
+        weights = ribbon.build_ribbon_weights(self.white, self.pial, self.triangles,
+                                              VOL_SHAPE, AFFINE, subdivisions = 8)
+        expected = ring_areas(self.white, self.triangles) * (self.pial[0, 2] - self.white[0, 2])
+        found = np.asarray(weights.sum(axis = 1)).ravel()
+        assert weights.shape == (64, np.prod(VOL_SHAPE))
+        assert np.isclose(found.sum(), expected.sum(), rtol = 0.05)
+        assert np.allclose(found, expected, rtol = 0.15)
+
+    def test_only_voxels_between_the_surfaces_are_used(self):
+        weights = ribbon.build_ribbon_weights(self.white, self.pial, self.triangles,
+                                              VOL_SHAPE, AFFINE)
+        i, j, k = np.unravel_index(np.unique(weights.indices), VOL_SHAPE)
+        assert k.min() == 2 and k.max() == 5
+
+    def test_threaded_chunks_match_one_chunk(self):
+        expected = ribbon.build_ribbon_weights(self.white, self.pial, self.triangles,
+                                               VOL_SHAPE, AFFINE)
+        with patch('ciftify.ribbon.POINTS_PER_CHUNK', 500):
+            chunked = ribbon.build_ribbon_weights(self.white, self.pial, self.triangles,
+                                                  VOL_SHAPE, AFFINE, n_cpus = 3)
+        assert abs(expected - chunked).max() == 0
+
+class TestMapVolume(unittest.TestCase):
+
+    def setUp(self):
+        white, pial, triangles = flat_slab()
+        self.weights = ribbon.build_ribbon_weights(white, pial, triangles,
+                                                   VOL_SHAPE, AFFINE)
+
+    def test_constant_volume_maps_to_a_constant(self):
+        vol_data = np.full(VOL_SHAPE + (3,), 7.0)
+        surf_data = ribbon.map_volume(vol_data, self.weights)
+        assert surf_data.shape == (64, 3)
+        assert np.allclose(surf_data, 7.0)
+
+    def test_voxels_outside_the_roi_are_not_used(self):
+        vol_data = np.ones(VOL_SHAPE)
+        vol_data[:, :, 4:] = 100
+        roi = np.ones(VOL_SHAPE)
+        roi[:, :, 4:] = 0
+        surf_data = ribbon.map_volume(vol_data, self.weights, roi)
+        assert surf_data.shape == (64, 1)
+        assert np.allclose(surf_data, 1.0)
+
+    def test_vertices_without_voxels_are_zero(self):
+        roi = np.zeros(VOL_SHAPE)
+        surf_data = ribbon.map_volume(np.ones(VOL_SHAPE), self.weights, roi)
+        assert np.all(surf_data == 0)
+
+@patch('ciftify.niio.load_surf_triangles')
+@patch('ciftify.niio.load_surf_coords')
+class TestRibbonWeightsCache(unittest.TestCase):
+
+    def make_surfaces(self, tmpdir, mock_coords, mock_triangles):
+        white, pial, triangles = flat_slab()
+        mock_coords.side_effect = lambda surf: white if 'white' in surf else pial
+        mock_triangles.return_value = triangles
+        surfs = []
+        for name in ['white', 'pial']:
+            surfs.append(os.path.join(tmpdir, 'fake.{}.surf.gii'.format(name)))
+            with open(surfs[-1], 'w') as f:
+                f.write('fake {} surface'.format(name))
+        return surfs
+
+    def test_weights_are_read_from_the_cache_dir(self, mock_coords, mock_triangles):
+        with ciftify.utils.TempDir() as tmpdir:
+            surfs = self.make_surfaces(tmpdir, mock_coords, mock_triangles)
+            cache_dir = os.path.join(tmpdir, 'ribbon_weights')
+            first = ribbon.ribbon_weights(surfs[0], surfs[1], VOL_SHAPE, AFFINE,
+                                          cache_dir = cache_dir)
+            cached = os.listdir(cache_dir)
+            with patch('ciftify.ribbon.build_ribbon_weights') as mock_build:
+                second = ribbon.ribbon_weights(surfs[0], surfs[1], VOL_SHAPE, AFFINE,
+                                               cache_dir = cache_dir)
+                assert mock_build.call_count == 0
+        assert len(cached) == 1
+        assert abs(first - second).max() == 0
+
+    def test_nothing_is_saved_without_a_cache_dir(self, mock_coords, mock_triangles):
+        with ciftify.utils.TempDir() as tmpdir:
+            surfs = self.make_surfaces(tmpdir, mock_coords, mock_triangles)
+            with patch.dict(os.environ, {'CIFTIFY_CACHE': tmpdir}):
+                ribbon.ribbon_weights(surfs[0], surfs[1], VOL_SHAPE, AFFINE)
+            assert sorted(os.listdir(tmpdir)) == ['fake.pial.surf.gii', 'fake.white.surf.gii']
+
+class TestMatchesWorkbench(unittest.TestCase):
+    '''
+    compares the mapping with wb_command -volume-to-surface-mapping -ribbon-constrained
+    -volume-roi on a curved slab, using the stored wb_command output in
+    tests/data/ribbon_mapping (written by running wb_command on the inputs made here)
+    or running wb_command when it is installed
+    '''
+    fixture = os.path.join(os.path.dirname(__file__), 'data', 'ribbon_mapping',
+                           'wb_ribbon_mapping.func.gii')
+    ## every vertex within 1% of the range of the volume
+    tolerance = 0.01
+
+    def write_inputs(self, tmpdir):
+        n = 8
+        x, y = np.meshgrid(np.linspace(1.3, 9.7, n), np.linspace(1.2, 9.9, n))
+        white = np.column_stack((x.ravel(), y.ravel(), 2.3 + 0.6 * np.sin(x.ravel() / 3)))
+        pial = white + [0, 0, 3.1]
+        triangles = grid_triangles(n)
+        surfs = {}
+        for name, coords in [('white', white), ('pial', pial), ('midthickness', (white + pial) / 2)]:
+            surfs[name] = os.path.join(tmpdir, 'L.{}.surf.gii'.format(name))
+            gii = nib.gifti.GiftiImage(meta = nib.gifti.GiftiMetaData.from_dict(
+                {'AnatomicalStructurePrimary': 'CortexLeft'}))
+            gii.add_gifti_data_array(nib.gifti.GiftiDataArray(
+                coords.astype(np.float32), intent = 'NIFTI_INTENT_POINTSET'))
+            gii.add_gifti_data_array(nib.gifti.GiftiDataArray(
+                triangles.astype(np.int32), intent = 'NIFTI_INTENT_TRIANGLE'))
+            nib.save(gii, surfs[name])
+        i, j, k = np.meshgrid(*[np.arange(dim) for dim in VOL_SHAPE], indexing = 'ij')
+        vol_data = (np.sin(i / 2.0) + j / 4.0 + k).astype(np.float32)
+        volume = os.path.join(tmpdir, 'volume.nii.gz')
+        nib.save(nib.Nifti1Image(vol_data, AFFINE), volume)
+        roi = os.path.join(tmpdir, 'roi.nii.gz')
+        nib.save(nib.Nifti1Image((i + j != 9).astype(np.float32), AFFINE), roi)
+        return surfs, volume, roi, vol_data
+
+    def workbench_output(self, tmpdir, surfs, volume, roi):
+        if os.path.exists(self.fixture):
+            return self.fixture
+        if not shutil.which('wb_command'):
+            self.skipTest('no stored wb_command output and wb_command is not installed')
+        output = os.path.join(tmpdir, 'wb_ribbon_mapping.func.gii')
+        subprocess.check_call(['wb_command', '-volume-to-surface-mapping', volume,
+                               surfs['midthickness'], output, '-ribbon-constrained',
+                               surfs['white'], surfs['pial'], '-volume-roi', roi])
+        return output
+
+    def test_matches_wb_command(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            surfs, volume, roi, vol_data = self.write_inputs(tmpdir)
+            expected = ciftify.niio.load_gii_data(
+                self.workbench_output(tmpdir, surfs, volume, roi))
+            surf_data = ribbon.map_volume_to_surface(volume, surfs['white'],
+                                                     surfs['pial'], volume_roi = roi)
+        assert surf_data.shape == expected.shape
+        assert np.allclose(surf_data, expected, rtol = 0,
+                           atol = self.tolerance * np.ptp(vol_data))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import shutil
+import logging
+import subprocess
+
+import numpy as np
+import nibabel as nib
+from unittest.mock import patch
+
+import ciftify.smoothing as smoothing
+import ciftify.niio
+import ciftify.surface
+import ciftify.utils
+
+from tests.mesh_fixtures import flat_grid, grid_triangles
+
+logging.disable(logging.CRITICAL)
+
+@patch('ciftify.niio.load_surf_triangles')
+@patch('ciftify.niio.load_surf_coords')
+class TestSurfaceSmoothingOperator(unittest.TestCase):
+
+    def setUp(self):
+        self.coords, self.triangles = flat_grid(n = 7)
+
+    def make_surface(self, tmpdir, mock_coords, mock_triangles):
+        mock_coords.return_value = self.coords
+        mock_triangles.return_value = self.triangles
+        surf = os.path.join(tmpdir, 'fake.surf.gii')
+        with open(surf, 'w') as f:
+            f.write('fake surface')
+        return surf
+
+    def test_rows_sum_to_one(self, mock_coords, mock_triangles):
+        with ciftify.utils.TempDir() as tmpdir:
+            surf = self.make_surface(tmpdir, mock_coords, mock_triangles)
+            operator = smoothing.surface_smoothing_operator(surf, 1.0, use_cache = False)
+        assert operator.shape == (49, 49)
+        assert np.allclose(np.asarray(operator.sum(axis = 1)).ravel(), 1)
+
+    def test_constant_data_stays_constant_inside_roi(self, mock_coords, mock_triangles):
+        roi = np.ones(49)
+        roi[:7] = 0
+        with ciftify.utils.TempDir() as tmpdir:
+            surf = self.make_surface(tmpdir, mock_coords, mock_triangles)
+            with patch.dict(os.environ, {'CIFTIFY_CACHE': tmpdir}):
+                smoothed = smoothing.smooth_metric(np.full((49, 3), 5.0), surf, 1.0, roi = roi)
+        assert np.allclose(smoothed[7:], 5.0)
+        assert np.all(smoothed[:7] == 0)
+
+    def test_operator_is_read_from_the_cache(self, mock_coords, mock_triangles):
+        with ciftify.utils.TempDir() as tmpdir:
+            surf = self.make_surface(tmpdir, mock_coords, mock_triangles)
+            first = smoothing.surface_smoothing_operator(surf, 1.0)
+            cached = os.listdir(os.path.join(tmpdir, 'smoothing_weights'))
+            with patch('ciftify.smoothing.surface_smoothing_kernel') as mock_kernel:
+                second = smoothing.surface_smoothing_operator(surf, 1.0)
+                assert mock_kernel.call_count == 0
+        assert len(cached) == 1
+        assert abs(first - second).max() == 0
+
+    def test_kernel_matches_the_dense_distances(self, mock_coords, mock_triangles):
+        mock_coords.return_value = self.coords
+        mock_triangles.return_value = self.triangles
+        with patch('ciftify.smoothing.DISTANCE_CHUNK', 5):
+            kernel = smoothing.surface_smoothing_kernel('fake.surf.gii', 1.0)
+        distances = ciftify.surface.SurfaceGraph('fake.surf.gii').distances(
+            np.arange(49), limit = smoothing.KERNEL_CUTOFF)
+        areas = ciftify.surface.vertex_areas(self.coords, self.triangles)
+        expected = np.where(np.isfinite(distances), np.exp(-distances**2 / 2), 0) * areas
+        expected = expected / expected.sum(axis = 1, keepdims = True)
+        assert np.allclose(kernel.toarray(), expected)
+
+class TestSmoothingCacheDir(unittest.TestCase):
+
+    def test_subject_surfaces_are_cached_next_to_the_surface(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            surf = os.path.join(tmpdir, 'sub-01', 'MNINonLinear', 'sub-01.L.midthickness.surf.gii')
+            with patch.dict(os.environ, {'CIFTIFY_CACHE': os.path.join(tmpdir, 'cache')}):
+                cache_dir = smoothing.smoothing_cache_dir(surf)
+        assert cache_dir == os.path.join(os.path.realpath(tmpdir), 'sub-01',
+                                         'MNINonLinear', 'smoothing_weights')
+
+    def test_ciftify_surfaces_are_cached_in_the_ciftify_cache(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            surf = os.path.join(tmpdir, 'data', 'standard_mesh_atlases', 'L.sphere.surf.gii')
+            os.makedirs(os.path.join(tmpdir, 'data'))
+            with patch.dict(os.environ, {'CIFTIFY_CACHE': os.path.join(tmpdir, 'cache'),
+                                         'CIFTIFY_DATA': os.path.join(tmpdir, 'data')}):
+                cache_dir = smoothing.smoothing_cache_dir(surf)
+        assert cache_dir == os.path.join(tmpdir, 'cache', 'smoothing')
+
+class TestApplyOperator(unittest.TestCase):
+
+    def test_threaded_blocks_match_one_product(self):
+        affine = np.diag([2.0, 2.0, 2.0, 1.0])
+        voxels = np.array([[i, j, k] for i in range(4) for j in range(4) for k in range(3)])
+        operator = smoothing.volume_smoothing_kernel(voxels, affine, 2.0)
+        data = np.random.rand(len(voxels), 10).astype(np.float32)
+        expected = operator.dot(data)
+        assert np.allclose(smoothing.apply_operator(operator, data, n_cpus = 3), expected)
+
+class TestCiftiSmoothingOperator(unittest.TestCase):
+
+    def test_volume_structures_are_smoothed_separately(self):
+        affine = np.diag([2.0, 2.0, 2.0, 1.0])
+        mask = np.zeros((4, 4, 4), dtype = bool)
+        mask[:2] = True
+        brain_models = (nib.cifti2.BrainModelAxis.from_mask(mask, 'thalamus_left', affine) +
+                        nib.cifti2.BrainModelAxis.from_mask(~mask, 'thalamus_right', affine))
+        operator = smoothing.cifti_smoothing_operator(brain_models, 2.0, 2.0, None, None)
+        n_left = mask.sum()
+        assert operator.shape == (64, 64)
+        assert operator[:n_left, n_left:].nnz == 0
+        assert np.allclose(np.asarray(operator.sum(axis = 1)).ravel(), 1)
+
+class TestMatchesWorkbench(unittest.TestCase):
+    '''
+    compares the smoothing with wb_command -metric-smoothing (GEO_GAUSS_AREA) -roi on
+    a curved sheet, using the stored wb_command output in tests/data/smoothing
+    (written by running wb_command on the inputs made here) or running wb_command
+    when it is installed
+    '''
+    fixture = os.path.join(os.path.dirname(__file__), 'data', 'smoothing',
+                           'wb_metric_smoothing.func.gii')
+    sigma = 1.5
+    ## every vertex within 2% of the range of the data (the kernel is cut at 3 sigma)
+    tolerance = 0.02
+
+    def write_gii(self, filename, *arrays, structure = 'CortexLeft'):
+        gii = nib.gifti.GiftiImage(meta = nib.gifti.GiftiMetaData.from_dict(
+            {'AnatomicalStructurePrimary': structure}))
+        for data, intent in arrays:
+            gii.add_gifti_data_array(nib.gifti.GiftiDataArray(data, intent = intent))
+        nib.save(gii, filename)
+        return filename
+
+    def write_inputs(self, tmpdir):
+        n = 16
+        x, y = np.meshgrid(np.linspace(0, 15, n), np.linspace(0, 13.5, n))
+        coords = np.column_stack((x.ravel(), y.ravel(), 2.0 * np.sin(x.ravel() / 4)))
+        surf = self.write_gii(os.path.join(tmpdir, 'L.midthickness.surf.gii'),
+            (coords.astype(np.float32), 'NIFTI_INTENT_POINTSET'),
+            (grid_triangles(n).astype(np.int32), 'NIFTI_INTENT_TRIANGLE'))
+        metric_data = np.column_stack((np.sin(coords[:, 0] / 2) + coords[:, 1] / 5,
+            np.random.RandomState(4).rand(n * n))).astype(np.float32)
+        metric = self.write_gii(os.path.join(tmpdir, 'L.metric.func.gii'),
+            (metric_data[:, 0], 'NIFTI_INTENT_NORMAL'),
+            (metric_data[:, 1], 'NIFTI_INTENT_NORMAL'))
+        roi = self.write_gii(os.path.join(tmpdir, 'L.roi.shape.gii'),
+            ((coords[:, 0] + coords[:, 1] > 4).astype(np.float32), 'NIFTI_INTENT_NORMAL'))
+        return surf, metric, roi, metric_data
+
+    def workbench_output(self, tmpdir, surf, metric, roi):
+        if os.path.exists(self.fixture):
+            return self.fixture
+        if not shutil.which('wb_command'):
+            self.skipTest('no stored wb_command output and wb_command is not installed')
+        output = os.path.join(tmpdir, 'wb_metric_smoothing.func.gii')
+        subprocess.check_call(['wb_command', '-metric-smoothing', surf, metric,
+                               str(self.sigma), output, '-roi', roi])
+        return output
+
+    def test_matches_wb_command(self):
+        with ciftify.utils.TempDir() as tmpdir:
+            surf, metric, roi, metric_data = self.write_inputs(tmpdir)
+            expected = ciftify.niio.load_gii_data(
+                self.workbench_output(tmpdir, surf, metric, roi))
+            operator = smoothing.surface_smoothing_operator(surf, self.sigma,
+                roi = ciftify.niio.load_gii_data(roi)[:, 0], use_cache = False)
+            smoothed = smoothing.apply_operator(operator, metric_data)
+        assert smoothed.shape == expected.shape
+        assert np.allclose(smoothed, expected, rtol = 0,
+                           atol = self.tolerance * np.ptp(metric_data))
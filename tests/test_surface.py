@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import logging
+
+import numpy as np
+import pytest
+from unittest.mock import patch
+
+import ciftify.surface as surface
+
+from tests.mesh_fixtures import flat_grid
+
+logging.disable(logging.CRITICAL)
+
+class TestBuildDistanceGraph(unittest.TestCase):
+
+    def test_diagonal_across_two_triangles_is_straight(self):
+        coords = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0]], dtype = float)
+        triangles = np.array([[0, 1, 2], [1, 3, 2]])
+        graph = surface.build_distance_graph(coords, triangles)
+        assert np.isclose(graph[0, 3], np.sqrt(2))
+
+    def test_graph_is_symmetric(self):
+        coords, triangles = flat_grid()
+        graph = surface.build_distance_graph(coords, triangles)
+        assert abs(graph - graph.T).max() == 0
+
+    def test_edges_are_edge_lengths(self):
+        coords, triangles = flat_grid(spacing = 2.0)
+        graph = surface.build_distance_graph(coords, triangles)
+        assert np.isclose(graph[0, 1], 2.0)
+        assert np.isclose(graph[0, 5], 2.0)
+
+class TestSurfaceGraph(unittest.TestCase):
+
+    @patch('ciftify.niio.load_surf_triangles')
+    @patch('ciftify.niio.load_surf_coords')
+    def test_distances_along_straight_line(self, mock_coords, mock_triangles):
+        coords, triangles = flat_grid()
+        mock_coords.return_value = coords
+        mock_triangles.return_value = triangles
+        surf_graph = surface.SurfaceGraph('fake.surf.gii')
+        distances = surf_graph.distances(0)
+        assert distances.shape == (1, 25)
+        assert np.isclose(distances[0, 4], 4.0)
+        assert np.isclose(distances[0, 0], 0.0)
+
+    @patch('ciftify.niio.load_surf_triangles')
+    @patch('ciftify.niio.load_surf_coords')
+    def test_vertices_beyond_limit_are_inf(self, mock_coords, mock_triangles):
+        coords, triangles = flat_grid()
+        mock_coords.return_value = coords
+        mock_triangles.return_value = triangles
+        surf_graph = surface.SurfaceGraph('fake.surf.gii')
+        distances = surf_graph.distances([0, 24], limit = 2)
+        assert np.isinf(distances[0, 24])
+        assert np.isinf(distances[1, 0])
+        assert np.isclose(distances[1, 23], 1.0)
+
+    @patch('ciftify.niio.load_surf_triangles')
+    @patch('ciftify.niio.load_surf_coords')
+    def test_distances_within_match_the_full_search(self, mock_coords, mock_triangles):
+        coords, triangles = flat_grid(n = 9)
+        mock_coords.return_value = coords
+        mock_triangles.return_value = triangles
+        surf_graph = surface.SurfaceGraph('fake.surf.gii')
+        vertices = np.array([0, 40, 44])
+        source, neighbour, dist = surf_graph.distances_within(vertices, 2.5)
+        within = np.full((3, 81), np.inf)
+        within[source, neighbour] = dist
+        assert np.allclose(within, surf_graph.distances(vertices, limit = 2.5))
+
+@patch('ciftify.niio.load_surf_triangles')
+@patch('ciftify.niio.load_surf_coords')
+class TestGeodesicRois(unittest.TestCase):
+
+    def surf_graph(self, mock_coords, mock_triangles):
+        coords, triangles = flat_grid()
+        mock_coords.return_value = coords
+        mock_triangles.return_value = triangles
+        return surface.SurfaceGraph('fake.surf.gii')
+
+    def test_rois_allow_overlap(self, mock_coords, mock_triangles):
+        rois = self.surf_graph(mock_coords, mock_triangles).geodesic_rois([0, 2], 2)
+        assert rois.shape == (25, 2)
+        assert list(rois[:5, 0]) == [1, 1, 1, 0, 0]
+        assert list(rois[:5, 1]) == [1, 1, 1, 1, 1]
+
+    def test_closest_gives_ties_to_first_roi(self, mock_coords, mock_triangles):
+        rois = self.surf_graph(mock_coords, mock_triangles).geodesic_rois([0, 2], 2,
+                                                overlap_logic = 'CLOSEST')
+        assert list(rois[:5, 0]) == [1, 1, 0, 0, 0]
+        assert list(rois[:5, 1]) == [0, 0, 1, 1, 1]
+
+    def test_exclude_drops_shared_vertices(self, mock_coords, mock_triangles):
+        rois = self.surf_graph(mock_coords, mock_triangles).geodesic_rois([0, 2], 2,
+                                                overlap_logic = 'EXCLUDE')
+        assert list(rois[:5, 0]) == [0, 0, 0, 0, 0]
+        assert list(rois[:5, 1]) == [0, 0, 0, 1, 1]
+
+    def test_gaussian_rois(self, mock_coords, mock_triangles):
+        rois = self.surf_graph(mock_coords, mock_triangles).geodesic_rois([0], 2, sigma = 2)
+        assert np.isclose(rois[0, 0], 1.0)
+        assert np.isclose(rois[1, 0], np.exp(-1 / 8))
+        assert rois[3, 0] == 0
+
+    def test_unknown_overlap_logic(self, mock_coords, mock_triangles):
+        with pytest.raises(ValueError):
+            self.surf_graph(mock_coords, mock_triangles).geodesic_rois([0], 2,
+                                                overlap_logic = 'MAX')
+
+@patch('ciftify.niio.load_surf_triangles')
+@patch('ciftify.niio.load_surf_coords')
+class TestSurfaceRois(unittest.TestCase):
+
+    def surface_rois(self, mock_coords, mock_triangles):
+        coords, triangles = flat_grid()
+        mock_coords.return_value = coords
+        mock_triangles.return_value = triangles
+        return surface.SurfaceRois('L.surf.gii', 'R.surf.gii')
+
+    def test_bilateral_map_of_labels(self, mock_coords, mock_triangles):
+        surface_rois = self.surface_rois(mock_coords, mock_triangles)
+        rois = surface_rois.bilateral_map([0, 24, 4], ['L', 'R', 'L'], 1,
+                                          labels = [2, 3, 5])
+        assert rois.shape == (50,)
+        assert list(rois[:5]) == [2, 2, 0, 5, 5]
+        assert rois[25 + 24] == 3
+        assert rois[25 + 23] == 3
+
+    def test_probmap_divides_by_number_of_rois(self, mock_coords, mock_triangles):
+        surface_rois = self.surface_rois(mock_coords, mock_triangles)
+        rois = surface_rois.bilateral_map([0, 1], ['L', 'L'], 1, probmap = True)
+        assert list(rois[:3]) == [1.0, 1.0, 0.5]
+        assert rois[25:].sum() == 0
+
+    def test_neighbourhoods_are_measured_once(self, mock_coords, mock_triangles):
+        surface_rois = self.surface_rois(mock_coords, mock_triangles)
+        surf_graph = surface_rois.surface_graph('L')
+        with patch.object(surf_graph, 'distances', wraps = surf_graph.distances) as mock_dist:
+            first = surface_rois.roi_distances('L', [0, 12], 2)
+            second = surface_rois.roi_distances('L', [12, 0], 1)
+        assert mock_dist.call_count == 1
+        assert np.array_equal(second[:, 1], np.where(first[:, 0] <= 1, first[:, 0], np.inf))
+        assert mock_coords.call_count == 1
+
+    def test_vertices_outside_surface(self, mock_coords, mock_triangles):
+        surface_rois = self.surface_rois(mock_coords, mock_triangles)
+        with pytest.raises(ValueError):
+            surface_rois.bilateral_map([25], ['L'], 1)
+
+class TestVertexAreas(unittest.TestCase):
+
+    def test_areas_sum_to_surface_area(self):
+        coords, triangles = flat_grid(spacing = 2.0)
+        areas = surface.vertex_areas(coords, triangles)
+        assert np.isclose(areas.sum(), 16 * 4.0)
+
+    def test_corner_vertex_has_third_of_one_triangle(self):
+        coords, triangles = flat_grid()
+        areas = surface.vertex_areas(coords, triangles)
+        assert np.isclose(areas[0], 0.5 / 3)
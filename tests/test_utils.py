@@ -7,6 +7,7 @@ import random
 import copy
 
 import pytest
+from scipy import sparse
 from unittest.mock import patch
 
 import ciftify.utils as utils
@@ -120,6 +121,33 @@ class TestTempDir(unittest.TestCase):
             pass
         assert not os.path.exists(self.path)
 
+class TestCachedSparseMatrix(unittest.TestCase):
+
+    def test_matrix_is_built_once_per_input(self):
+        built = []
+        def build_matrix():
+            built.append(1)
+            return sparse.eye(3, format = 'csr')
+        with utils.TempDir() as tmpdir:
+            input_file = os.path.join(tmpdir, 'input.surf.gii')
+            with open(input_file, 'w') as f:
+                f.write('fake surface')
+            cache_dir = os.path.join(tmpdir, 'cache')
+            cache_file = utils.hashed_cache_file(cache_dir, 'test', [input_file], 'v1')
+            first = utils.cached_sparse_matrix(cache_file, build_matrix)
+            second = utils.cached_sparse_matrix(cache_file, build_matrix)
+            other_file = utils.hashed_cache_file(cache_dir, 'test', [input_file], 'v2')
+            cached = sorted(os.listdir(cache_dir))
+        assert len(built) == 1
+        assert abs(first - second).max() == 0
+        assert cached == [os.path.basename(cache_file)]
+        assert other_file != cache_file
+
+    def test_nothing_is_saved_without_a_cache_file(self):
+        with patch('ciftify.utils.save_sparse_matrix') as mock_save:
+            utils.cached_sparse_matrix(None, lambda: sparse.eye(3, format = 'csr'))
+        assert mock_save.call_count == 0
+
 class TestWorkDirSettings(unittest.TestCase):
 
     def setUp(self):